@@ -10,6 +10,7 @@ import deprecated
 from enum import Enum
 from math import isfinite
 from os.path import realpath
+from StatProfiler import profile_scope
 
 # Dephy library import
 from flexsea import fxUtils as fxu  # pylint: disable=no-name-in-module
@@ -54,6 +55,9 @@ RAD_PER_SEC_PER_GYRO_LSB = np.pi/180/32.8
 G_PER_ACCELEROMETER_LSB = 1./8192
 RAD_PER_CLICK = 2*np.pi/MOTOR_CLICKS_PER_REVOLUTION
 RAD_PER_DEG = np.pi/180.
+
+_PROF_UPDATE = profile_scope("ActPackMan.update")
+_PROF_READ = profile_scope("ActPackMan.read_device")
 ticks_to_motor_radians = lambda x: x*(np.pi/180./45.5111)
 motor_radians_to_ticks = lambda q: q*(180*45.5111/np.pi)
 
@@ -169,10 +173,19 @@ class ActPackMan(object):
         # fetches new data from the device
         if not self.entered:
             raise RuntimeError("ActPackMan updated before __enter__ (which begins the streaming)")
+        _PROF_UPDATE.start()
+        try:
+            self._update()
+        finally:
+            _PROF_UPDATE.stop()
+
+    def _update(self):
         currentTime = time.time()
         if abs(currentTime-self.prevReadTime)<0.25/self.updateFreq:
             print("warning: re-updating twice in less than a quarter of a time-step")
+        _PROF_READ.start()
         self.act_pack = FlexSEA().read_device(self.dev_id) # a c-types struct
+        _PROF_READ.stop()
         self.prevReadTime = currentTime
 
         # Automatically save all the data as a csv file
@@ -1,43 +1,155 @@
 import busio
 import board
 import adafruit_ads1x15.ads1115 as ADS
+from adafruit_ads1x15.ads1x15 import Mode
 from adafruit_ads1x15.analog_in import AnalogIn
+from RingBuffer import SampleRing
+from threading import Thread
 import csv
 import traceback
 import time
 
 class AdcManager(object):
-    def __init__(self, csv_file_name=None):
+    """
+    Reads an ADS1115 over I2C.
+
+    By default update() reads P0 itself, single shot, which takes over a
+    millisecond of the loop. With continuous=True a background thread
+    acquires as fast as the part allows into self.ring (a SampleRing, one
+    column per channel), and update() just picks up the newest sample; mean()
+    and window() give averaged or decimated windows of the recent past.
+    With one channel the ADC converts continuously and the thread reads it
+    once per conversion, at data_rate. With several (e.g. channels=(ADS.P0,
+    ADS.P1) for two load cells) the thread reads them round robin, single
+    shot, since the driver waits two conversions after each channel switch
+    in continuous mode; each sweep is one sample, at the sweep's mid time.
+    A read error skips the sample and backs off one period; update() raises
+    if the thread has died or its newest sample is older than stale_after
+    seconds, rather than returning the last good volts forever.
+    """
+    def __init__(self, csv_file_name=None, continuous=False, channels=(ADS.P0,), ring_capacity=4096,
+            stale_after=0.1):
         self.i2c = busio.I2C(board.SCL, board.SDA)
         self.ads = ADS.ADS1115(self.i2c, data_rate=860)
-        self.chan = AnalogIn(self.ads, ADS.P0)
+        self.channels = list(channels)
+        self.chans = [AnalogIn(self.ads, pin) for pin in self.channels]
+        self.chan = self.chans[0]
         self.save_csv = not (csv_file_name is None)
         self.csv_file_name = csv_file_name
         self.csv_file = None
         self.csv_writer = None
         self.volts = -42.0 # error code
 
+        self.continuous = continuous
+        self.ring = SampleRing(len(self.chans), ring_capacity) if continuous else None
+        self.channel_volts = [self.volts]*len(self.chans)
+        self.sample_time = float('nan')
+        self.read_errors = 0
+        self.last_error = None
+        self.stale_after = stale_after
+        self._t_start = float('nan')
+        self._logged_seq = 0
+        self._stopped = False
+        self.thread = Thread(target=self._acquire, name="AdcManager", daemon=True) if continuous else None
+
     def __enter__(self):
         if self.save_csv:
             with open(self.csv_file_name,'w') as fd:
                 writer = csv.writer(fd)
-                writer.writerow(["pi_time", "voltage", "test_duration"])
+                if self.continuous: # one row per acquired sample
+                    writer.writerow(["pi_time"] + (["voltage"] if len(self.channels) == 1
+                        else ["voltage_P%d"%pin for pin in self.channels]))
+                else:
+                    writer.writerow(["pi_time", "voltage", "test_duration"])
             self.csv_file = open(self.csv_file_name,'a').__enter__()
             self.csv_writer = csv.writer(self.csv_file)
+        self.start()
         return self
 
     def __exit__(self, etype, value, tb):
         """ Closes the file properly """
+        self.stop()
         if self.save_csv:
+            if self.continuous:
+                self._log_samples()
             self.csv_file.__exit__(etype, value, tb)
         if not (etype is None):
             traceback.print_exception(etype, value, tb)
 
+    def start(self):
+        if self.thread is not None and not self.thread.is_alive():
+            if len(self.chans) == 1:
+                self.ads.mode = Mode.CONTINUOUS
+            self._t_start = time.time()
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+            self.ads.mode = Mode.SINGLE
+
+    def _acquire(self):
+        chans, ring = self.chans, self.ring
+        period = 1.0/self.ads.data_rate
+        t_next = time.time()
+        while not self._stopped:
+            if len(chans) == 1: # one read per conversion
+                t_next += period
+                wait = t_next - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                elif wait < -period: # fell behind, don't try to catch up
+                    t_next = time.time()
+            t0 = time.time()
+            try:
+                volts = [chan.voltage for chan in chans]
+            except Exception as e: # pylint: disable=broad-except
+                # I2C glitch (or worse), skip the sample; update() reports it once it goes stale
+                self.read_errors += 1
+                self.last_error = e
+                time.sleep(period)
+                continue
+            ring.push(0.5*(t0 + time.time()), volts)
+
+    def _log_samples(self):
+        times, volts, self._logged_seq = self.ring.since(self._logged_seq)
+        for t, row in zip(times, volts):
+            self.csv_writer.writerow([t] + list(row))
 
     def update(self):
+        if self.continuous:
+            latest = self.ring.latest()
+            if latest is not None:
+                _, self.sample_time, self.channel_volts = latest
+                self.volts = self.channel_volts[0]
+            self._check_thread(latest is not None)
+            if self.save_csv:
+                self._log_samples()
+            return self.volts
         t0=time.time()
         self.volts = self.chan.voltage
         dur = time.time()-t0
         if self.save_csv:
             self.csv_writer.writerow([time.time(),self.volts, dur])
-        return self.volts
\ No newline at end of file
+        return self.volts
+
+    def _check_thread(self, have_sample):
+        if self._stopped or self.thread.ident is None: # not running yet, or stopped on purpose
+            return
+        if not self.thread.is_alive():
+            raise RuntimeError("ADC thread stopped (%d read errors, last %r)"%(
+                self.read_errors, self.last_error)) from self.last_error
+        age = time.time() - (self.sample_time if have_sample else self._t_start)
+        if age > self.stale_after:
+            raise RuntimeError("no ADC sample for %.3f s (%d read errors, last %r)"%(
+                age, self.read_errors, self.last_error)) from self.last_error
+
+    def mean(self, n):
+        """ Per channel mean of the last n samples (continuous mode) """
+        return self.ring.mean(n)
+
+    def window(self, n, step=1):
+        """ (times, volts) of the last n samples, every step-th (continuous mode) """
+        return self.ring.window(n, step)
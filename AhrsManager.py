@@ -3,24 +3,192 @@ import time
 import csv
 import sys, time
 import numpy as np
+from math import sqrt
 from os.path import realpath
 sys.path.append(r'/usr/share/python3-mscl/')    # Path of the MSCL)
 import traceback
 import mscl
-from StatProfiler import SSProfile
+from StatProfiler import SSProfile, profile_scope
+from BinaryLog import BinaryLog
+from RingBuffer import TimestampedRing
+import threading
+from Quaternion import IDENTITY, quat_from_matrix, quat_relative, quat_rotate_inverse, quat_to_euler, sagittal_angle
+
+
+# mscl.MipDataPoint.storedAs() codes
+STORED_AS_FLOAT = 0
+STORED_AS_DOUBLE = 1
+STORED_AS_TIMESTAMP = 3
+STORED_AS_MATRIX = 9
+
+_MATRIX_INDICES = [(i, j) for i in range(3) for j in range(3)]
+
+def _as_python(dataPoint):
+    " Converts one MIP data point to a python float, 3x3 array or None "
+    stored_as = dataPoint.storedAs()
+    if stored_as == STORED_AS_FLOAT:
+        return dataPoint.as_float()
+    if stored_as == STORED_AS_DOUBLE:
+        return dataPoint.as_double()
+    if stored_as == STORED_AS_MATRIX:
+        mat = dataPoint.as_Matrix()
+        return np.array([[mat.as_floatAt(i,j) for j in range(3)] for i in range(3)])
+    if stored_as != STORED_AS_TIMESTAMP:
+        print("no solution for datapoint stored as", stored_as, dataPoint.channelName())
+    return None
+
+def _device_time(packet):
+    " Device timestamp of a packet in seconds, NaN if the device did not send one "
+    try:
+        if packet.deviceTimeValid():
+            return packet.deviceTimestamp().nanoseconds()*1e-9
+    except AttributeError: # older MSCL without device timestamps
+        pass
+    return float('nan')
+
+def _extract_float(dataPoint, arr, k):
+    arr[k] = dataPoint.as_float()
+
+def _extract_double(dataPoint, arr, k):
+    arr[k] = dataPoint.as_double()
+
+def _extract_matrix(dataPoint, arr, k):
+    mat = dataPoint.as_Matrix()
+    row = arr[k]
+    for i, j in _MATRIX_INDICES:
+        row[i, j] = mat.as_floatAt(i, j)
+
+_EXTRACTORS = {
+    STORED_AS_FLOAT: (_extract_float, ()),
+    STORED_AS_DOUBLE: (_extract_double, ()),
+    STORED_AS_MATRIX: (_extract_matrix, (3, 3)),
+}
+
+
+class MipPacketDecoder():
+    """ Decodes MSCL data packets into preallocated NumPy arrays.
+
+    The channel layout of each packet type (keyed by descriptor set and
+    the names of its data points, in order) is resolved once, into a list
+    of per-position extractors, so decoding a packet is a straight walk over
+    its points with no dict building and no storedAs() branching. After decode(packets)
+    returns n, row k < n of data[name] holds the value from the k-th decoded
+    packet and present[name][k] says whether that packet carried the
+    channel. Channels not listed in `channels` (if given) are skipped.
+    """
+
+    def __init__(self, channels=None, capacity=64):
+        self.channels = None if channels is None else frozenset(channels)
+        self.capacity = capacity
+        self.data = dict()
+        self.present = dict()
+        self.n = 0
+        self._layouts = dict()
+
+    def decode(self, packets, last_packet_only=False):
+        npackets = len(packets)
+        if last_packet_only and npackets > 1:
+            packets = [packets[-1]]
+            npackets = 1
+        if npackets > self.capacity:
+            self._grow(npackets)
+        for mask in self.present.values():
+            mask[:npackets] = False
+        for k, packet in enumerate(packets):
+            points = packet.data()
+            key = (packet.descriptorSet(), tuple([dataPoint.channelName() for dataPoint in points]))
+            layout = self._layouts.get(key)
+            if layout is None:
+                layout = self._layouts[key] = self._resolve_layout(points)
+            for dataPoint, slot in zip(points, layout):
+                if slot is not None:
+                    extract, arr, mask = slot
+                    extract(dataPoint, arr, k)
+                    mask[k] = True
+        self.n = npackets
+        return npackets
+
+    def latest(self, name):
+        " Most recent decoded value of a channel, or None "
+        mask = self.present.get(name)
+        if mask is None:
+            return None
+        for k in range(self.n-1, -1, -1):
+            if mask[k]:
+                return self.data[name][k]
+        return None
+
+    def _resolve_layout(self, points):
+        layout = []
+        for dataPoint in points:
+            name = dataPoint.channelName()
+            extractor = _EXTRACTORS.get(dataPoint.storedAs())
+            if extractor is None or (self.channels is not None and name not in self.channels):
+                layout.append(None)
+                continue
+            extract, shape = extractor
+            if name not in self.data:
+                self.data[name] = np.zeros((self.capacity,)+shape)
+                self.present[name] = np.zeros((self.capacity,), dtype=bool)
+            layout.append((extract, self.data[name], self.present[name]))
+        return layout
+
+    def _grow(self, npackets):
+        while self.capacity < npackets:
+            self.capacity *= 2
+        for name in self.data:
+            self.data[name] = np.zeros((self.capacity,)+self.data[name].shape[1:])
+            self.present[name] = np.zeros((self.capacity,), dtype=bool)
+        self._layouts.clear() # layouts hold references to the old arrays
+
+
+_RECURSION_CHUNK = 128 # keeps a**-k finite in _first_order_recursion
+
+def _first_order_recursion(a, u, y0, reset=None):
+    """ Solves y[k] = a*y[k-1] + u[k] along the first axis of u, starting
+    from y[-1] = y0, with y[k] forced to zero wherever reset[k] is True.
+    Uses y[k] = a**k * (a*y0 + sum_j u[j]/a**j), a cumulative sum, so the
+    cost per element is flat no matter how many packets have piled up. """
+    m = u.shape[0]
+    y = np.empty(u.shape)
+    y0 = np.asarray(y0, dtype=float)
+    for s in range(0, m, _RECURSION_CHUNK):
+        e = min(m, s+_RECURSION_CHUNK)
+        k = np.arange(e-s)
+        p = (a**k)[:,np.newaxis]
+        S = np.cumsum(u[s:e]/p, axis=0)
+        if reset is None:
+            y[s:e] = p*(a*y0 + S)
+        else:
+            last = np.maximum.accumulate(np.where(reset[s:e], k, -1))
+            base = np.where((last>=0)[:,np.newaxis], S[np.maximum(last, 0)], -a*y0)
+            y[s:e] = p*(S - base)
+        y0 = y[e-1]
+    return y
 
+_PROF_READ = profile_scope("AhrsManager.readIMUnode")
+_PROF_GET = profile_scope("AhrsManager.get_packets")
 
 class AhrsManager():
-    def __init__(self, csv_file_name=None, dt=0.01, port="/dev/ttyACM0", baud = 921600):
+    def __init__(self, csv_file_name=None, dt=0.01, port="/dev/ttyACM0", baud = 921600,
+        decode_channels=None, batched=False, bin_file_name=None,
+        threaded=False, ring_capacity=1024, poll_period=0.001):
         self.port = realpath(port) # dereference symlinks
         self.save_csv = not (csv_file_name is None)
         self.csv_file_name = csv_file_name
         self.csv_file = None
         self.csv_writer = None
+        self.save_bin = not (bin_file_name is None)
+        self.bin_file_name = bin_file_name
+        self.bin_log = None
+        self.batched = batched
         self.prevTime = 0.0
         self.R = np.eye(3)
         self.init_R = None
         self.R_prime = None
+        self.q = IDENTITY # quaternion of R
+        self.init_q = None
+        self.q_prime = None # quaternion of R_prime
         self.dt = dt
         self.xd = np.zeros((3,1))
         self.x = np.zeros((3,1))
@@ -29,6 +197,20 @@ class AhrsManager():
         self.acc_bias = np.zeros((3,1))
         self.lp_xdd = 0.0
         self.baud = baud
+        self.decoder = MipPacketDecoder(channels=decode_channels)
+
+        # Background acquisition (threaded=True): a reader thread drains the
+        # node into self.ring and the control loop only touches the ring.
+        self.threaded = threaded
+        self.ring = TimestampedRing(ring_capacity) if threaded else None
+        self.poll_period = poll_period
+        self.read_seq = 0 # newest ring sequence number seen by the control loop
+        self.packet_recv_times = np.zeros((0,)) # time.monotonic() of each decoded packet
+        self.packet_device_times = np.zeros((0,)) # device time of each decoded packet, s
+        self._acq_thread = None
+        self._acq_stop = threading.Event()
+        self.read_errors = 0 # exceptions that stopped the reader thread
+        self.last_error = None
 
     def __enter__(self):
         if self.save_csv:
@@ -41,6 +223,8 @@ class AhrsManager():
             self.csv_file = open(self.csv_file_name,'a').__enter__()
             self.csv_writer = csv.writer(self.csv_file)
 
+        if self.save_bin:
+            self.bin_log = BinaryLog(self.bin_file_name, ["pi_time", "qw", "qx", "qy", "qz"]).__enter__()
 
         self.connection = mscl.Connection.Serial(self.port, self.baud)
         self.node = mscl.InertialNode(self.connection)
@@ -68,6 +252,12 @@ class AhrsManager():
         # self.packets = self.node.getDataPackets(0)
         packets = self.node.getDataPackets(0)
 
+        if self.threaded:
+            self._acq_stop.clear()
+            self._acq_thread = threading.Thread(target=self._acquire, daemon=True,
+                name="AhrsManager %s"%self.port)
+            self._acq_thread.start()
+
         return self
 
 
@@ -75,41 +265,32 @@ class AhrsManager():
         """ Closes the file properly """
         if self.save_csv:
             self.csv_file.__exit__(etype, value, tb)
+        if self.save_bin:
+            self.bin_log.__exit__(etype, value, tb)
+        if self._acq_thread is not None:
+            self._acq_stop.set()
+            self._acq_thread.join()
+            self._acq_thread = None
         self.node.setToIdle()
         if not (etype is None):
             traceback.print_exception(etype, value, tb)
 
     def get_sagittal_angle(self):
-        # this is the X-Y plane angle on the device, relative to initial position.
+        " X-Y plane angle on the device in degrees, relative to initial position "
+        return 180/np.pi*sagittal_angle(self.q_prime)
 
-        return 180/np.pi*np.arctan2(self.R_prime[1,0],self.R_prime[0,0])
-        return "%.2f degrees"%(180/np.pi*np.arctan2(self.R_prime[1,0],self.R_prime[0,0]))
-        return "\n%.2f, %.2f, %.2f\n%.2f, %.2f, %.2f\n%.2f, %.2f, %.2f\n\n"%(
-            self.R_prime[0,0], self.R_prime[0,1], self.R_prime[0,2],
-            self.R_prime[1,0], self.R_prime[1,1], self.R_prime[1,2],
-            self.R_prime[2,0], self.R_prime[2,1], self.R_prime[2,2],
-            )
+    def get_orientation_quaternion(self):
+        " (w, x, y, z) orientation relative to the initial orientation "
+        return self.q_prime
 
     def update(self):
         t0=time.time()
 
-        microstrainData = self.readIMUnode(timeout=0)# 0ms
-        # print([microstrainDatum.keys() for microstrainDatum in microstrainData ])
-        for datum in microstrainData:
-            if 'orientMatrix' in datum.keys():
-                self.R = datum['orientMatrix']
-                if self.init_R is None:
-                    self.init_R = np.array(self.R)
-                self.R_prime = self.R@self.init_R.T
-            if 'deltaVelX' in datum.keys():
-                self.xdd = self.R_prime.T@np.array([[datum['deltaVelX'], datum['deltaVelY'], datum['deltaVelZ']]]).T*9.81/self.dt
-                self.lp_xdd += 0.4*(self.xdd-self.lp_xdd)
-                self.xd += (self.xdd - self.xd_forget * self.xd + self.acc_bias) * self.dt
-                if np.linalg.norm(self.xdd - self.lp_xdd)<1e-1:
-                    self.xd*=0
-                    self.acc_bias = -self.lp_xdd
-
-                self.x += (self.xd - self.x_forget * self.x)* self.dt
+        n = self.decode_packets(timeout=0) # 0ms
+        if self.batched:
+            self._update_batched(n)
+        else:
+            self._update_sequential(n)
         # self.R = self.readIMUnode()['orientMatrix']
         # self.R= np.eye(3)
         dur = time.time()-t0
@@ -119,9 +300,123 @@ class AhrsManager():
                 , self.R[1,0], self.R[1,1], self.R[1,2]
                 , self.R[2,0], self.R[2,1], self.R[2,2]
                 ])
+        if self.save_bin:
+            self.bin_log.append(time.time(), *self.q)
         #print(self.R[0,0], self.R[1,1], self.R[2,2])
         return 1
 
+    def _update_sequential(self, n):
+        """ Strapdown integration one packet at a time. Orientation is tracked
+        with scalar quaternion math and the integrator state with plain floats;
+        the packet columns are read out once per tick, and the matrices and
+        state arrays are refreshed once per tick. """
+        if n == 0:
+            return
+        data, present = self.decoder.data, self.decoder.present
+        has_R = present['orientMatrix'][:n].tolist() if 'orientMatrix' in present else [False]*n
+        Rs = data['orientMatrix'][:n].tolist() if 'orientMatrix' in present else None
+        if 'deltaVelX' in present:
+            has_dv = present['deltaVelX'][:n].tolist()
+            dvs = zip(data['deltaVelX'][:n].tolist(), data['deltaVelY'][:n].tolist(), data['deltaVelZ'][:n].tolist())
+        else:
+            has_dv, dvs = [False]*n, [None]*n
+        scale, dt = 9.81/self.dt, self.dt
+        xd_decay, x_decay = self.xd_forget, self.x_forget
+        lp = (np.zeros(3)+np.ravel(self.lp_xdd)).tolist()
+        xd, x, bias = np.ravel(self.xd).tolist(), np.ravel(self.x).tolist(), np.ravel(self.acc_bias).tolist()
+        xdd = None
+        last_R = None
+        for k, dv in zip(range(n), dvs):
+            if has_R[k]:
+                last_R = k
+                self.q = quat_from_matrix(Rs[k])
+                if self.init_q is None:
+                    self.init_q = self.q
+                    self.init_R = np.array(Rs[k])
+                self.q_prime = quat_relative(self.q, self.init_q)
+            if has_dv[k] and self.q_prime is not None:
+                xdd = [a*scale for a in quat_rotate_inverse(self.q_prime, dv)]
+                lp = [l + 0.4*(a - l) for a, l in zip(xdd, lp)]
+                xd = [v + (a - xd_decay*v + b)*dt for v, a, b in zip(xd, xdd, bias)]
+                if sqrt(sum((a - l)**2 for a, l in zip(xdd, lp))) < 1e-1:
+                    xd = [0.0, 0.0, 0.0]
+                    bias = [-l for l in lp]
+                x = [p + (v - x_decay*p)*dt for p, v in zip(x, xd)]
+        if xdd is not None:
+            self.xdd = np.array(xdd).reshape(3,1)
+            self.lp_xdd = np.array(lp).reshape(3,1)
+            self.xd = np.array(xd).reshape(3,1)
+            self.x = np.array(x).reshape(3,1)
+            self.acc_bias = np.array(bias).reshape(3,1)
+        if last_R is not None:
+            self.R = np.array(Rs[last_R])
+            self.R_prime = self.R@self.init_R.T
+
+    def _update_batched(self, n):
+        """ Same result as _update_sequential, but all packets received since
+        the last tick are rotated with one einsum and the filter, bias and
+        zero-velocity recursions are solved in closed form over the batch. """
+        data, present = self.decoder.data, self.decoder.present
+        if 'orientMatrix' in present:
+            has_R = present['orientMatrix'][:n]
+        else:
+            has_R = np.zeros((n,), dtype=bool)
+        orient_rows = np.flatnonzero(has_R)
+        if len(orient_rows) > 0:
+            Rs = data['orientMatrix'][orient_rows]
+            if self.init_R is None:
+                self.init_R = np.array(Rs[0])
+            R_primes = np.einsum('kij,lj->kil', Rs, self.init_R) # R @ init_R.T
+            self.R = np.array(Rs[-1])
+
+        if 'deltaVelX' in present:
+            dv_rows = np.flatnonzero(present['deltaVelX'][:n])
+            # index of the latest orientation at or before each packet, -1 for last tick's R_prime
+            which_R = (np.cumsum(has_R)-1)[dv_rows]
+            if self.R_prime is None:
+                dv_rows, which_R = dv_rows[which_R>=0], which_R[which_R>=0]
+            if len(dv_rows) > 0:
+                if len(orient_rows) > 0:
+                    Rp = np.concatenate([np.full((1,3,3), np.nan) if self.R_prime is None
+                        else self.R_prime[np.newaxis], R_primes])[which_R+1]
+                else:
+                    Rp = np.broadcast_to(self.R_prime, (len(dv_rows),3,3))
+                dv = np.stack([data['deltaVelX'][dv_rows], data['deltaVelY'][dv_rows],
+                    data['deltaVelZ'][dv_rows]], axis=1)
+                self._integrate_delta_velocities(Rp, dv)
+
+        if len(orient_rows) > 0:
+            self.R_prime = R_primes[-1]
+            self.q = quat_from_matrix(self.R.tolist())
+            if self.init_q is None:
+                self.init_q = quat_from_matrix(self.init_R.tolist())
+            self.q_prime = quat_relative(self.q, self.init_q)
+
+    def _integrate_delta_velocities(self, Rp, dv):
+        " Vectorized form of the per-packet deltaVel update, Rp is (m,3,3), dv is (m,3) "
+        m = dv.shape[0]
+        xdd = np.einsum('kji,kj->ki', Rp, dv)*(9.81/self.dt) # R_prime.T @ dv
+        lp = _first_order_recursion(0.6, 0.4*xdd, np.zeros(3)+np.ravel(self.lp_xdd))
+        still = np.linalg.norm(xdd - lp, axis=1) < 1e-1
+
+        # the bias used by packet k comes from the last zero-velocity reset before k
+        k = np.arange(m)
+        last_still = np.maximum.accumulate(np.where(still, k, -1))
+        prev_still = np.concatenate([[-1], last_still[:-1]])
+        bias = np.where((prev_still>=0)[:,np.newaxis], -lp[np.maximum(prev_still, 0)],
+            np.ravel(self.acc_bias))
+
+        xd = _first_order_recursion(1.0-self.xd_forget*self.dt, (xdd+bias)*self.dt,
+            np.ravel(self.xd), reset=still)
+        x = _first_order_recursion(1.0-self.x_forget*self.dt, xd*self.dt, np.ravel(self.x))
+
+        self.xdd = xdd[-1].reshape(3,1)
+        self.lp_xdd = lp[-1].reshape(3,1)
+        self.xd = xd[-1].reshape(3,1)
+        self.x = x[-1].reshape(3,1)
+        if last_still[-1] >= 0:
+            self.acc_bias = -lp[last_still[-1]].reshape(3,1)
+
     def start_cal(self):
         self.t0=time.time()
         self.xd = np.zeros((3,1))
@@ -137,95 +432,65 @@ class AhrsManager():
         self.x_forget = .01
         print('stop cal', self.acc_bias.T)
 
-    def readIMUnode(self, timeout = 0, maxPackets = 0, last_packet_only = False):
-        # SSProfile("Get IMU Data Packets").tic()
-        packets = self.node.getDataPackets(timeout, maxPackets)
-        # SSProfile("Get IMU Data Packets").toc()
-
-        # SSProfile("Read Data Packets").tic() 
-        microstrainData = [] 
-        if len(packets) > 0 and last_packet_only == True:
-            packet = packets[-1]
-
-            microstrainDatum = dict()
-            # SSProfile("Loop Through Datapoints").tic()
-            for dataPoint in packet.data():
-                # print(dataPoint.channelName())
-                
-                if dataPoint.storedAs() == 0:
-                    # SSProfile("Datapoint 0").tic()
-                    microstrainDatum[dataPoint.channelName()] = dataPoint.as_float()
-                    # SSProfile("Datapoint 0").toc()
-                
-                elif dataPoint.storedAs() == 3:
-                    # SSProfile("Datapoint 3").tic()
-                    # print(dir(dataPoint))
-                    # ts = dataPoint.as_Timestamp()
-                    microstrainDatum[dataPoint.channelName()] = None
-                    # SSProfile("Datapoint 3").toc()
-
-                elif dataPoint.storedAs() == 1:
-                    # SSProfile("Datapoint 1").tic()
-                    # print(dir(dataPoint))
-                    ts = dataPoint.as_double()
-                    microstrainDatum[dataPoint.channelName()] = ts
-                    # SSProfile("Datapoint 1").toc()
-                    
-                elif dataPoint.storedAs() == 9:
-                    # SSProfile("Datapoint 9").tic()
-                    mat = dataPoint.as_Matrix()
-                    npmat = np.array([[mat.as_floatAt(i,j) for j in range(3)] for i in range(3)])
-                    microstrainDatum[dataPoint.channelName()] = npmat
-                    # SSProfile("Datapoint 9").toc()
-                else:
-                    print("no solution for datapoint stored as", dataPoint.storedAs(), dataPoint.channelName())
-                    microstrainDatum[dataPoint.channelName()] = None
-
-                # SSProfile("Loop Through Datapoints").toc()
-            microstrainData.append(microstrainDatum)
-        
-        else:
-            for packet in packets:
-                microstrainDatum = dict()
-                # SSProfile("Loop Through Datapoints").tic()
-                for dataPoint in packet.data():
-                    # print(dataPoint.channelName())
-                    
-                    if dataPoint.storedAs() == 0:
-                        # SSProfile("Datapoint 0").tic()
-                        microstrainDatum[dataPoint.channelName()] = dataPoint.as_float()
-                        # SSProfile("Datapoint 0").toc()
-                    
-                    elif dataPoint.storedAs() == 3:
-                        # SSProfile("Datapoint 3").tic()
-                        # print(dir(dataPoint))
-                        # ts = dataPoint.as_Timestamp()
-                        microstrainDatum[dataPoint.channelName()] = None
-                        # SSProfile("Datapoint 3").toc()
-
-                    elif dataPoint.storedAs() == 1:
-                        # SSProfile("Datapoint 1").tic()
-                        # print(dir(dataPoint))
-                        ts = dataPoint.as_double()
-                        microstrainDatum[dataPoint.channelName()] = ts
-                        # SSProfile("Datapoint 1").toc()
-                        
-                    elif dataPoint.storedAs() == 9:
-                        # SSProfile("Datapoint 9").tic()
-                        mat = dataPoint.as_Matrix()
-                        npmat = np.array([[mat.as_floatAt(i,j) for j in range(3)] for i in range(3)])
-                        microstrainDatum[dataPoint.channelName()] = npmat
-                        # SSProfile("Datapoint 9").toc()
-                    else:
-                        print("no solution for datapoint stored as", dataPoint.storedAs(), dataPoint.channelName())
-                        microstrainDatum[dataPoint.channelName()] = None
-
-                    # SSProfile("Loop Through Datapoints").toc()
-                microstrainData.append(microstrainDatum)
-        
-        # SSProfile("Read Data Packets").toc()
-        return microstrainData
+    def _acquire(self):
+        """ Reader thread. Polls the node without blocking, since a blocking
+        MSCL call may hold the GIL, and tags each packet on arrival. An
+        error (serial, MSCL, unplugged USB) ends the thread and is kept in
+        last_error for the control loop to raise. """
+        try:
+            while not self._acq_stop.is_set():
+                packets = self.node.getDataPackets(0)
+                t = time.monotonic()
+                for packet in packets:
+                    self.ring.push(packet, t, _device_time(packet))
+                if len(packets) == 0:
+                    self._acq_stop.wait(self.poll_period)
+        except Exception as e: # pylint: disable=broad-except
+            self.read_errors += 1
+            self.last_error = e
+
+    def _get_packets(self, timeout = 0, maxPackets = 0):
+        """ Packets since the last call, from the ring when threaded (never
+        blocks, timeout is ignored) or straight from the node otherwise """
+        if not self.threaded:
+            packets = self.node.getDataPackets(timeout, maxPackets)
+            self.packet_recv_times = np.full((len(packets),), time.monotonic())
+            self.packet_device_times = np.array([_device_time(p) for p in packets])
+            return packets
+        packets, self.packet_recv_times, self.packet_device_times, self.read_seq = self.ring.since(self.read_seq)
+        if len(packets) == 0 and self.last_error is not None and not self._acq_thread.is_alive():
+            raise RuntimeError("AHRS reader thread for %s stopped: %r"%(self.port, self.last_error)) from self.last_error
+        if maxPackets > 0 and len(packets) > maxPackets:
+            packets = packets[-maxPackets:]
+            self.packet_recv_times = self.packet_recv_times[-maxPackets:]
+            self.packet_device_times = self.packet_device_times[-maxPackets:]
+        return packets
+
+    def latest_packet(self):
+        """ (seq, packet, monotonic receive time, device time) of the newest
+        packet the reader thread has seen, in constant time """
+        return self.ring.latest()
 
+    def readIMUnode(self, timeout = 0, maxPackets = 0, last_packet_only = False):
+        """ Returns a list with one dict per packet, mapping channel names to
+        values. Convenient but slow, prefer decode_packets in the loop. """
+        _PROF_READ.start()
+        try:
+            _PROF_GET.start()
+            packets = self._get_packets(timeout, maxPackets)
+            _PROF_GET.stop()
+            if last_packet_only and len(packets) > 1:
+                packets = [packets[-1]]
+            return [{dataPoint.channelName(): _as_python(dataPoint) for dataPoint in packet.data()}
+                for packet in packets]
+        finally:
+            _PROF_READ.stop()
+
+    def decode_packets(self, timeout = 0, maxPackets = 0, last_packet_only = False):
+        """ Reads packets from the node straight into self.decoder's arrays
+        and returns the number of packets decoded. """
+        return self.decoder.decode(self._get_packets(timeout, maxPackets),
+            last_packet_only=last_packet_only)
 
     def getTotalPackets(self):
         return self.node.totalPackets()
@@ -245,11 +510,91 @@ class AhrsManager():
     def get_euler_angles(self):
         self.roll_usedef = -np.arccos(np.dot(  np.array([0,1,0]) , np.array([self.grav_x,self.grav_y,self.grav_z])  )) + np.pi/2
         self.pitch_usedef = np.arctan2(self.grav_y, self.grav_x)
+        self.yaw_usedef = quat_to_euler(self.q_prime)[2] if self.q_prime is not None else 0.0
         eulerAngles = (self.roll_usedef,self.pitch_usedef,self.yaw_usedef)
         # eulerAngles = extractEulerAngles(R_update)
 
         return eulerAngles
 
+class _FakePoint():
+    def __init__(self, name, value):
+        self.name, self.value = name, value
+    def channelName(self):
+        return self.name
+    def storedAs(self):
+        return STORED_AS_FLOAT
+    def as_float(self):
+        return self.value
+
+class _FakePacket():
+    def __init__(self, descriptor_set, points):
+        self.descriptor_set, self.points = descriptor_set, points
+    def descriptorSet(self):
+        return self.descriptor_set
+    def data(self):
+        return self.points
+
+def test_decoder_layouts():
+    " Packets of one descriptor set with as many, but different, channels "
+    accel = _FakePacket(0x80, [_FakePoint("scaledAccelX", 1.0), _FakePoint("scaledAccelY", 2.0)])
+    gyro = _FakePacket(0x80, [_FakePoint("scaledGyroX", 3.0), _FakePoint("scaledGyroY", 4.0)])
+    decoder = MipPacketDecoder()
+    assert(decoder.decode([accel, gyro]) == 2)
+    assert(list(decoder.present["scaledGyroX"][:2]) == [False, True] and decoder.latest("scaledGyroY") == 4.0)
+    assert(list(decoder.present["scaledAccelX"][:2]) == [True, False] and decoder.latest("scaledAccelY") == 2.0)
+
+class _UnpluggedNode():
+    " Sends one packet, then fails like a node whose USB cable was pulled "
+    def __init__(self):
+        self.calls = 0
+    def getDataPackets(self, timeout, maxPackets=0):
+        self.calls += 1
+        if self.calls > 1:
+            raise OSError("serial port closed")
+        return [_FakePacket(0x80, [_FakePoint("scaledAccelX", 1.0)])]
+
+def test_reader_thread_error():
+    am = AhrsManager(threaded=True)
+    am.node = _UnpluggedNode()
+    am._acq_thread = threading.Thread(target=am._acquire, daemon=True)
+    am._acq_thread.start()
+    am._acq_thread.join(1.0)
+    assert(am.decode_packets() == 1) # what arrived before the error still comes through
+    try:
+        am.decode_packets()
+        assert(False)
+    except RuntimeError as e:
+        assert(isinstance(e.__cause__, OSError) and am.read_errors == 1)
+
+def test_batched_matches_sequential():
+    " Feeds the same synthetic packets through both integration paths "
+    rng = np.random.default_rng(0)
+    n = 300
+    data, present = dict(), dict()
+    c, sn = np.cos(0.1*np.arange(n)), np.sin(0.1*np.arange(n))
+    R = np.zeros((n,3,3))
+    R[:,0,0], R[:,0,1], R[:,1,0], R[:,1,1], R[:,2,2] = c, -sn, sn, c, 1.0
+    data['orientMatrix'] = R
+    present['orientMatrix'] = rng.random(n) < 0.3
+    dv = 1e-3*rng.standard_normal((n,3))
+    dv[100:180] = 0.0 # hold still to trigger zero-velocity resets
+    for i, name in enumerate(["deltaVelX", "deltaVelY", "deltaVelZ"]):
+        data[name] = dv[:,i]
+        present[name] = np.ones(n, dtype=bool)
+    managers = []
+    for batched in [False, True]:
+        am = AhrsManager(batched=batched)
+        am.xd_forget, am.x_forget = 0.01, 0.02
+        assert am.q == IDENTITY # loggable before the first orientation packet
+        for s in range(0, n, 50): # ticks that each saw 50 packets
+            am.decoder.data = {k: v[s:s+50] for k, v in data.items()}
+            am.decoder.present = {k: v[s:s+50] for k, v in present.items()}
+            am._update_batched(50) if batched else am._update_sequential(50)
+        managers.append(am)
+    seq, bat = managers
+    for name in ["R_prime", "q_prime", "lp_xdd", "acc_bias", "xd", "x"]:
+        assert np.allclose(getattr(seq, name), getattr(bat, name), atol=1e-9), name
+
 def main():
     with AhrsManager(csv_file_name="test_ahrs.csv", port="/dev/ttyAhrsB") as am:
         cal=False
@@ -1,7 +1,13 @@
 import socket
-from time import time
+import select
+import struct
+import asyncio
+from collections import namedtuple
+from math import sin, radians, isfinite
+from time import time, sleep
 from SoftRealtimeLoop import SoftRealtimeLoop
-from threading import Thread
+from BinaryLog import BinaryLog, load_binary_log
+from threading import Thread, Event, Lock
 import numpy as np
 
 class TrapezoidalIntegrator:
@@ -16,9 +22,10 @@ class TrapezoidalIntegrator:
         self._val_0 = start_value
         self.value = 0.0
 
-    def update(self, new_value):
-        """Calls one more iteration of trapezoidal integration. Keeps track of time internally."""
-        now = time()
+    def update(self, new_value, t = None):
+        """Calls one more iteration of trapezoidal integration. Keeps track of time internally,
+        unless given the time t the sample was taken."""
+        now = time() if t is None else t
         dt = now - self._t0
         self.value += dt/2*(self._val_0 + new_value)
         
@@ -32,6 +39,317 @@ class TrapezoidalIntegrator:
         self.value = 0.0
 
 
+class OdometryIntegrator:
+    """
+    Integrates a signal over the times it was sampled at (packet arrival
+    times taken at the socket, or device time where there is one) instead of
+    the time update() happens to run, so scheduling jitter does not turn
+    into integration error.
+
+    mode "trapezoid" is the trapezoid rule. mode "simpson" is the composite
+    Simpson rule for uneven spacing, over pairs of intervals; the running
+    value adds the trapezoid over a pair's first half until the pair
+    completes. Pairs more uneven than max_ratio (bursts of coalesced
+    packets) fall back to the trapezoid rule, where Simpson's weights would
+    amplify noise.
+
+    With max_rate set, a sample further than max_rate*dt + tolerance from
+    the last accepted one is rejected as an outlier, and samples whose
+    timestamp does not advance are always rejected. integrate_samples does
+    the same on a recorded stream, vectorized.
+    """
+    MODES = ("trapezoid", "simpson")
+
+    def __init__(self, mode = "trapezoid", max_rate = None, tolerance = 0.0, max_ratio = 4.0):
+        if mode not in self.MODES:
+            raise ValueError("mode must be one of %s"%(self.MODES,))
+        self.simpson = mode == "simpson"
+        self.max_rate = max_rate
+        self.tolerance = tolerance
+        self.max_ratio = max_ratio
+        self.rejected = 0
+        self.reset()
+
+    def reset(self):
+        """Zeroes the integral; the next sample starts it."""
+        self.value = 0.0
+        self._committed = 0.0 # integral up to the start of the current Simpson pair
+        self._t0 = self._y0 = None # start of the pair (last sample for trapezoid)
+        self._t1 = self._y1 = None # middle of the pair
+
+    def update(self, y, t):
+        """Adds the sample y taken at time t, returns the integral."""
+        if self._t0 is None:
+            self._t0, self._y0 = t, y
+            return self.value
+        t_last, y_last = (self._t1, self._y1) if self._t1 is not None else (self._t0, self._y0)
+        dt = t - t_last
+        if dt <= 0 or (self.max_rate is not None and abs(y - y_last) > self.max_rate*dt + self.tolerance):
+            self.rejected += 1
+            return self.value
+        if not self.simpson:
+            self._committed += 0.5*dt*(y_last + y)
+            self._t0, self._y0 = t, y
+            self.value = self._committed
+        elif self._t1 is None:
+            self._t1, self._y1 = t, y
+            self.value = self._committed + 0.5*dt*(self._y0 + y)
+        else:
+            self._committed += _simpson_pair(self._t1 - self._t0, dt, self._y0, self._y1, y, self.max_ratio)
+            self._t0, self._y0 = t, y
+            self._t1 = self._y1 = None
+            self.value = self._committed
+        return self.value
+
+
+def _simpson_pair(h0, h1, y0, y1, y2, max_ratio):
+    """Integral over two uneven intervals of lengths h0, h1"""
+    if h0 > max_ratio*h1 or h1 > max_ratio*h0:
+        return 0.5*(h0*(y0 + y1) + h1*(y1 + y2))
+    h = h0 + h1
+    return h/6*((2 - h1/h0)*y0 + h*h/(h0*h1)*y1 + (2 - h0/h1)*y2)
+
+
+def integrate_samples(t, y, mode = "trapezoid", max_rate = None, tolerance = 0.0, max_ratio = 4.0):
+    """
+    Batch counterpart of OdometryIntegrator: the running integral of a
+    recorded stream at every sample, vectorized. Outliers are found by
+    looking at both neighbors (a sample far from both is a spike), which an
+    online integrator cannot do, so only clean streams integrate exactly
+    alike both ways. Rejected samples repeat the previous integral.
+    """
+    t, y = np.asarray(t, dtype=float), np.asarray(y, dtype=float)
+    keep = np.ones(t.shape, dtype=bool)
+    keep[1:] = np.diff(t) > 0
+    if max_rate is not None and len(t) > 2:
+        dt = np.diff(t)
+        jump = np.abs(np.diff(y)) > max_rate*np.abs(dt) + tolerance
+        spike = np.zeros(t.shape, dtype=bool)
+        spike[1:-1] = jump[:-1] & jump[1:]
+        spike[-1] = jump[-1]
+        keep &= ~spike
+    tk, yk = t[keep], y[keep]
+    out = np.zeros(tk.shape)
+    if len(tk) > 1:
+        h = np.diff(tk)
+        trap = 0.5*h*(yk[1:] + yk[:-1])
+        if mode == "trapezoid":
+            out[1:] = np.cumsum(trap)
+        elif mode == "simpson":
+            m = (len(tk) - 1)//2 # complete pairs
+            h0, h1 = h[0:2*m:2], h[1:2*m:2]
+            y0, y1, y2 = yk[0:2*m:2], yk[1:2*m:2], yk[2:2*m+1:2]
+            uneven = (h0 > max_ratio*h1) | (h1 > max_ratio*h0)
+            hs = h0 + h1
+            with np.errstate(divide='ignore', invalid='ignore'):
+                simpson = hs/6*((2 - h1/h0)*y0 + hs*hs/(h0*h1)*y1 + (2 - h0/h1)*y2)
+            pairs = np.where(uneven, trap[0:2*m:2] + trap[1:2*m:2], simpson)
+            out[2::2] = np.cumsum(pairs)
+            out[1::2] = out[0:len(tk)-1:2] + trap[0::2]
+        else:
+            raise ValueError("mode must be one of %s"%(OdometryIntegrator.MODES,))
+    full = np.zeros(t.shape)
+    full[keep] = out
+    # rejected samples take the integral of the last kept one
+    last_kept = np.maximum.accumulate(np.where(keep, np.arange(len(t)), 0))
+    return full[last_kept]
+
+
+# Treadmill status packets are 32 bytes: a format byte, right and left belt
+# speeds in mm/s, 4 unused bytes, the incline in 1/100 deg, then padding.
+# All big-endian int16.
+BERTEC_PACKET = struct.Struct(">xhh4xh21x")
+BERTEC_PACKET_SIZE = BERTEC_PACKET.size
+
+BERTEC_LOG_COLUMNS = ["time", "speed_left", "speed_right", "incline"]
+# speed noise allowed on top of max_accel*dt when rejecting outliers, m/s
+ODOMETRY_TOLERANCE = 0.05
+
+BertecState = namedtuple("BertecState", ["time", "belt_speed", "incline", "packets"])
+BertecState.__doc__ = """ One consistent reading: belt_speed is (left, right) in m/s, incline in
+deg, time the local time.time() of the recv that produced it and packets
+the number of packets received so far. """
+
+class BertecStreamParser:
+    """
+    Frames the TCP byte stream from the treadmill into 32 byte packets.
+    recv_into a reusable buffer, so partial packets are kept for the next read
+    and several coalesced packets are handled in one go; only the newest is
+    decoded, the older ones are just counted.
+    """
+    def __init__(self, capacity=64):
+        self.buf = bytearray(capacity*BERTEC_PACKET_SIZE)
+        self._view = memoryview(self.buf)
+        self.fill = 0 # bytes of an incomplete packet at the start of buf
+        self.packets = 0
+        self.skipped = 0 # complete packets superseded within one read
+        self.partial_reads = 0 # reads that ended mid-packet
+        self.speed_right = self.speed_left = self.incline = 0.0
+
+    def recv_from(self, sock):
+        """ One recv_into from sock. Returns the number of new complete
+        packets, or None if the peer closed the connection. socket timeouts
+        propagate. """
+        nbytes = sock.recv_into(self._view[self.fill:])
+        if nbytes == 0:
+            return None
+        return self.consume(nbytes)
+
+    def recv_buffer(self):
+        " Where the next read should go, followed by consume(nbytes) "
+        return self._view[self.fill:]
+
+    def feed(self, data):
+        " Same as recv_from, for bytes that were read some other way "
+        data = memoryview(data)
+        new = 0
+        while len(data):
+            n = min(len(data), len(self.buf) - self.fill)
+            self._view[self.fill:self.fill+n] = data[:n]
+            new += self.consume(n)
+            data = data[n:]
+        return new
+
+    def consume(self, nbytes):
+        " Accounts for nbytes written into buf right after the previous fill "
+        fill = self.fill + nbytes
+        n = fill//BERTEC_PACKET_SIZE
+        end = n*BERTEC_PACKET_SIZE
+        if n:
+            right, left, incline = BERTEC_PACKET.unpack_from(self.buf, end - BERTEC_PACKET_SIZE)
+            self.speed_right, self.speed_left, self.incline = right/1000, left/1000, incline/100.0
+            self.packets += n
+            self.skipped += n - 1
+        if fill > end:
+            self.partial_reads += 1
+            if n:
+                self.buf[:fill-end] = self._view[end:fill]
+        self.fill = fill - end
+        return n
+
+
+# Speed command packets are 64 bytes: a format byte, nine big-endian int16
+# (right and left speed and two unused speeds in mm/s, right and left and two
+# unused accelerations in mm/s^2, incline), the bitwise complement of those
+# 18 bytes as a check, then zero padding.
+BERTEC_COMMAND = struct.Struct(">B9h")
+BERTEC_COMMAND_SIZE = 64
+_COMPLEMENT = bytes(255 - i for i in range(256))
+_INT16_MAX = 32767
+
+def _check_setpoint(values):
+    if not all(isfinite(v) for v in values):
+        raise ValueError("Bertec setpoint must be finite, got %r"%(values,))
+
+class BertecCommandPacket:
+    """
+    A reusable command packet, rewritten in place by pack().
+    """
+    def __init__(self, min_speed=-3.0, max_speed=3.0):
+        self.buf = bytearray(BERTEC_COMMAND_SIZE)
+        self.min_speed, self.max_speed = min_speed*1000, max_speed*1000 # mm/s
+
+    def pack(self, speedR, speedL, incline=0, accR=0.2, accL=0.2):
+        """Speeds in m/s, accelerations in m/s^2. Speeds are clamped to
+        [min_speed, max_speed], accelerations to [0, 32.767] and incline to
+        the int16 range. Returns the packet buffer."""
+        _check_setpoint((speedR, speedL, incline, accR, accL))
+        lo, hi = self.min_speed, self.max_speed
+        speedR = round(min(hi, max(lo, speedR*1000)))
+        speedL = round(min(hi, max(lo, speedL*1000)))
+        accR = round(min(_INT16_MAX, max(0, accR*1000)))
+        accL = round(min(_INT16_MAX, max(0, accL*1000)))
+        incline = round(min(_INT16_MAX, max(-_INT16_MAX - 1, incline)))
+        BERTEC_COMMAND.pack_into(self.buf, 0, 0, speedR, speedL, 0, 0,
+            accR, accL, 0, 0, incline)
+        self.buf[19:37] = self.buf[1:19].translate(_COMPLEMENT)
+        return self.buf
+
+
+def _send_all(sock, data):
+    """
+    sock.sendall that never gives up partway. The Bertec socket has a read
+    timeout (or is non-blocking for asyncio), and a sendall timing out
+    after part of a command went out would break the command framing.
+    """
+    view = memoryview(data)
+    while view:
+        try:
+            n = sock.send(view)
+        except (socket.timeout, BlockingIOError):
+            select.select((), (sock,), ())
+            continue
+        view = view[n:]
+
+
+class BertecCommandChannel:
+    """
+    Sends speed commands from a background thread at most max_rate times a
+    second. set() only stores the setpoint, so a control loop can call it
+    every tick; setpoints that arrive while the writer waits replace each
+    other and only the newest is sent. With skip_repeats, a setpoint equal to
+    the last one sent is not sent again.
+    """
+    def __init__(self, sock, max_rate=20.0, min_speed=-3.0, max_speed=3.0,
+            skip_repeats=True, send_lock=None):
+        self.sock = sock
+        self.period = 1.0/max_rate
+        self.packet = BertecCommandPacket(min_speed, max_speed)
+        self.skip_repeats = skip_repeats
+        self.send_lock = send_lock if send_lock is not None else Lock()
+        self._pending = None
+        self._pending_lock = Lock()
+        self._wake = Event()
+        self.last_sent = None
+        self.sent = 0
+        self.coalesced = 0 # setpoints replaced before they were sent
+        self.send_errors = 0
+        self.last_error = None
+        self._stopped = False
+        self.thread = Thread(target=self._run, name="BertecCommandChannel", daemon=True)
+        self.thread.start()
+
+    def set(self, speedR, speedL, incline=0, accR=0.2, accL=0.2):
+        """Never blocks on the socket. Raises ValueError for a NaN or
+        infinite value, which would otherwise only fail in the writer."""
+        _check_setpoint((speedR, speedL, incline, accR, accL))
+        with self._pending_lock:
+            if self._pending is not None:
+                self.coalesced += 1
+            self._pending = (speedR, speedL, incline, accR, accL)
+        self._wake.set()
+
+    def _run(self):
+        next_send = 0.0
+        while not self._stopped:
+            if not self._wake.wait(0.1):
+                continue
+            wait = next_send - time()
+            if wait > 0:
+                sleep(wait) # later set() calls coalesce meanwhile
+            self._wake.clear()
+            with self._pending_lock:
+                setpoint, self._pending = self._pending, None
+            if setpoint is None or (self.skip_repeats and setpoint == self.last_sent):
+                continue
+            try:
+                packet = self.packet.pack(*setpoint)
+                with self.send_lock:
+                    _send_all(self.sock, packet)
+            except (OSError, ValueError, struct.error) as e:
+                self.send_errors += 1
+                self.last_error = e
+                continue
+            self.last_sent = setpoint
+            self.sent += 1
+            next_send = time() + self.period
+
+    def close(self):
+        self._stopped = True
+        self._wake.set()
+        self.thread.join()
+
+
 class Bertec:
     """
     A class for reading Bertec speed and incline over the network 
@@ -39,60 +357,162 @@ class Bertec:
     Katharine Walters 08/23
 
     Modified 11/1/2023 to also track distance and elevation. - Kevin Best
+
+    The packets can be read three ways, chosen with transport:
+        "thread"  (default) a background thread reads them as they arrive
+        "poll"    no thread, the control loop calls poll() every tick
+        "asyncio" run_async() is a coroutine to run as a task
+    All three go through the same parser and publish the same BertecState.
+    BertecSim.BertecSimulator stands in for the treadmill PC.
+
+    Distance and elevation are integrated over the times the packets were
+    read off the socket, with odometry "trapezoid" or "simpson" (see
+    OdometryIntegrator); max_accel (m/s^2) rejects speed readings that jump
+    faster than the belts can. With log_file every published state is
+    recorded, and reintegrate_log recomputes the odometry from the recording.
     """
-    def __init__(self, viconPC_IP = '141.212.77.30', viconPC_BertecPort = 4000):
+    TRANSPORTS = ("thread", "poll", "asyncio")
+
+    def __init__(self, viconPC_IP = '141.212.77.30', viconPC_BertecPort = 4000, command_rate = 20.0,
+            transport = "thread", min_speed = -3.0, max_speed = 3.0, odometry = "trapezoid",
+            max_accel = None, log_file = None):
+        if transport not in self.TRANSPORTS:
+            raise ValueError("transport must be one of %s"%(self.TRANSPORTS,))
         self.destinationIP = viconPC_IP
         self.destinationPort = viconPC_BertecPort
+        self.transport = transport
 
         # Setup TCP
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
         self.sock.connect((self.destinationIP, self.destinationPort))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if transport == "asyncio":
+            self.sock.setblocking(False)
+        else:
+            self.sock.settimeout(0.1) # lets the reader thread notice stop()
 
-        self.thread = Thread(target=self._update, args = ())
+        self.thread = Thread(target=self._update, args = ()) if transport == "thread" else None
         self.stopped = False
+        self.closed = False # the treadmill PC ended the connection
 
-        self.belt_speed = [0,0]
-        self.incline = 0.0
+        self.parser = BertecStreamParser()
+        self.state = BertecState(time(), (0.0, 0.0), 0.0, 0)
 
-        # Instantiate trapezoidal integrators to keep track of 
-        self._distance_integrator = TrapezoidalIntegrator(self._calculate_absolute_velocity())
-        self._elevation_integrator = TrapezoidalIntegrator(self._calculate_vertical_velocity())
+        # Speed commands, sent from their own thread once set_belt_speed is used
+        self.command_rate = command_rate
+        self.commands = None
+        self._command_packet = BertecCommandPacket(min_speed, max_speed)
+        self._send_lock = Lock()
+
+        # Integrators to keep track of distance and elevation, fed packet arrival times
+        self._distance_integrator = OdometryIntegrator(odometry, max_accel, ODOMETRY_TOLERANCE)
+        self._elevation_integrator = OdometryIntegrator(odometry, max_accel, ODOMETRY_TOLERANCE)
+
+        self.log = BinaryLog(log_file, BERTEC_LOG_COLUMNS).__enter__() if log_file else None
 
     def start(self):
-        self.thread.start()
+        if self.thread is not None:
+            self.thread.start()
         return self
     
     def stop(self):
         self.stopped = True
+        if self.commands is not None:
+            self.commands.close()
+
+    def close(self):
+        self.stop()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+        if self.log is not None:
+            self.log.__exit__(None, None, None)
+            self.log = None
+        if self.sock.fileno() >= 0:
+            self.sock.close()
+            print("Bertec closed")
 
     def __del__(self):
-        self.thread.join()
-        self.sock.close()
-        print("Bertec closed")
+        if hasattr(self, "log"): # __init__ completed
+            self.close()
 
-    def _update(self):
-        while True:
-            if self.stopped:
-                break
-            packet = self.sock.recv(32)
-            data = list(packet)
-            belt_speedR = int.from_bytes(data[1:3],'big', signed=True)/1000
-            belt_speedL = int.from_bytes(data[3:5],'big', signed=True)/1000
-            self.belt_speed = [belt_speedL, belt_speedR]
-            self.incline = int.from_bytes(data[9:11],'big',signed=True)/100.0
+    def _received(self, n, t):
+        """Publishes the parser's newest packet after a read at time t that
+        produced n new packets (None if the connection closed)."""
+        if n is None:
+            if not self.closed:
+                print("Bertec connection closed by the treadmill PC")
+            self.closed = True
+            return
+        if n:
+            parser = self.parser
+            # one tuple swap, so readers never see speed and incline from different packets
+            self.state = BertecState(t, (parser.speed_left, parser.speed_right),
+                parser.incline, parser.packets)
             self._update_odometer()
+            if self.log is not None:
+                self.log.append(t, parser.speed_left, parser.speed_right, parser.incline)
+
+    def _update(self):
+        parser = self.parser
+        while not self.stopped and not self.closed:
+            try:
+                self._received(parser.recv_from(self.sock), time())
+            except socket.timeout:
+                continue
+
+    def poll(self, timeout = 0.0):
+        """
+        For transport="poll": reads everything the treadmill has sent so far,
+        waiting up to timeout seconds for the first bytes, and returns the
+        latest BertecState.
+        """
+        sock = self.sock
+        while not self.closed and select.select((sock,), (), (), timeout)[0]:
+            self._received(self.parser.recv_from(sock), time())
+            timeout = 0.0
+        return self.state
+
+    async def run_async(self):
+        """
+        For transport="asyncio": reads packets until stop() or the connection
+        closes, e.g. asyncio.create_task(bertec.run_async()).
+        """
+        loop = asyncio.get_running_loop()
+        parser = self.parser
+        while not self.stopped and not self.closed:
+            try:
+                nbytes = await asyncio.wait_for(loop.sock_recv_into(self.sock, parser.recv_buffer()), 0.1)
+            except asyncio.TimeoutError:
+                continue
+            self._received(parser.consume(nbytes) if nbytes else None, time())
+
+    @property
+    def belt_speed(self):
+        """[left, right] in m/s"""
+        return list(self.state.belt_speed)
+
+    @property
+    def incline(self):
+        return self.state.incline
+
+    def get_state(self):
+        """The latest BertecState, speeds and incline from the same packet."""
+        return self.state
 
     def _update_odometer(self):
-        """This method uses trapezoidal integration to track distance covered and elevation gained."""
-        self._elevation_integrator.update(self._calculate_vertical_velocity())
-        self._distance_integrator.update(self._calculate_absolute_velocity())
+        """Integrates the latest state to track distance covered and elevation gained."""
+        t = self.state.time
+        self._elevation_integrator.update(self._calculate_vertical_velocity(), t)
+        self._distance_integrator.update(self._calculate_absolute_velocity(), t)
 
     def _calculate_vertical_velocity(self):
-        avg_belt_speed = np.mean(self.belt_speed)
-        return avg_belt_speed*np.sin(np.deg2rad(self.incline))
+        state = self.state
+        left, right = state.belt_speed
+        return 0.5*(left + right)*sin(radians(state.incline))
     
     def _calculate_absolute_velocity(self):
-        return np.abs(np.mean(self.belt_speed))
+        left, right = self.state.belt_speed
+        return abs(0.5*(left + right))
 
     @property
     def distance(self):
@@ -117,54 +537,143 @@ class Bertec:
         self._distance_integrator.reset()
         self._elevation_integrator.reset()
 
+    def set_belt_speed(self, speedR, speedL, incline = 0, accR = 0.2, accL = 0.2):
+        """
+        Queues a speed command and returns immediately. Commands go out at
+        most command_rate times a second, newest first (see BertecCommandChannel).
+        """
+        if self.commands is None:
+            self.commands = BertecCommandChannel(self.sock, self.command_rate,
+                self._command_packet.min_speed/1000, self._command_packet.max_speed/1000,
+                send_lock=self._send_lock)
+        self.commands.set(speedR, speedL, incline, accR, accL)
+
     def _write_command(self, speedR, speedL, incline = 0, accR = 0.2, accL = 0.2):
         """
-        Write speed to treadmill. Code adoptted from MATLAB Bertec GUI 
+        Write speed to treadmill, blocking until sent. Code adoptted from MATLAB Bertec GUI 
         at https://github.com/UM-LoCoLab/SelfPacedTMVicon
         """
+        packet = self._command_packet.pack(speedR, speedL, incline, accR, accL)
+        with self._send_lock:
+            _send_all(self.sock, packet)
 
-        speedL = speedL*1000        # Speed in mm/s
-        speedR = speedR*1000
-
-        maxVel = 3000       # Max speed 3.0 m/s
-        minVel = -3000
-
-        # Speed range check
-        speedL = min(maxVel, max(minVel, speedL))
-        speedR = min(maxVel, max(minVel, speedR))
-
-        accR = accR*1000   # Acceleration in mm/s^2
-        accL = accL*1000
-
-        # Formating packet payload 
-        format = 0
-        speedLL = 0
-        speedRR = 0
-        accRR = 0
-        accLL = 0
+def reintegrate_log(file_name, odometry = "simpson", max_accel = None):
+    """
+    Recomputes the odometry of a recording made with Bertec(log_file=...).
+    Returns (time, distance in km, elevation in m), one per recorded state.
+    """
+    columns, data = load_binary_log(file_name)
+    t, left, right, incline = (data[:, columns.index(c)] for c in BERTEC_LOG_COLUMNS)
+    speed = 0.5*(left + right)
+    distance = integrate_samples(t, np.abs(speed), odometry, max_accel, ODOMETRY_TOLERANCE)/1000.0
+    elevation = integrate_samples(t, speed*np.sin(np.radians(incline)), odometry, max_accel, ODOMETRY_TOLERANCE)
+    return t, distance, elevation
 
-        aux = int16toBytes([speedR, speedL, speedRR, speedLL, accR, accL, accRR, accLL, incline])
-        secCheck = 255*np.ones((len(aux), ), dtype=int) - aux
-        padding = np.zeros((27, ), dtype=int)
-        fullPayload = [format, *aux, *secCheck, *padding]
 
-        # Send packet
-        packed_data = struct.pack('B' * len(fullPayload), *fullPayload)
-        self.sock.sendall(packed_data)
+def test_stream_parser():
+    packets = bytearray()
+    for i in range(5):
+        packet = bytearray(BERTEC_PACKET_SIZE)
+        struct.pack_into(">hh", packet, 1, 1000 + i, -500 - i) # right, left
+        struct.pack_into(">h", packet, 9, 250 + i)
+        packets += packet
+    parser = BertecStreamParser(capacity=2)
+    assert(parser.feed(packets[:20]) == 0 and parser.fill == 20) # a partial packet
+    assert(parser.feed(packets[20:100]) == 3) # coalesced, ends mid-packet
+    assert((parser.speed_right, parser.speed_left, parser.incline) == (1.002, -0.502, 2.52))
+    assert(parser.feed(packets[100:]) == 2 and parser.fill == 0)
+    assert((parser.speed_right, parser.incline, parser.packets) == (1.004, 2.54, 5))
+    a, b = socket.socketpair()
+    a.sendall(packets[:70])
+    assert(parser.recv_from(b) == 2 and parser.speed_right == 1.001)
+    a.close()
+    b.close()
 
-def int16toBytes(intVec):
-    """
-    A function that converts a vector of int16 (N*1) to a vector of bytes of twice the length (2N*1). 
-    Jiefu Zhang 11/23
-    """
-    byteVec = []
-    for int16Data in intVec:
-        data = round(int16Data)
-        dataInByte = data.to_bytes(2, byteorder='big')
-        aux = [dataInByte[0], dataInByte[1]]    
-        byteVec.extend(aux)
-    return byteVec
+def test_command_channel():
+    packet = BertecCommandPacket(min_speed=0.0, max_speed=1.8)
+    buf = packet.pack(0.5, 2.5, incline=3, accR=0.25)
+    assert(len(buf) == BERTEC_COMMAND_SIZE and buf[0] == 0 and not any(buf[37:]))
+    assert(struct.unpack_from(">9h", buf, 1) == (500, 1800, 0, 0, 250, 200, 0, 0, 3))
+    assert(all(a + b == 255 for a, b in zip(buf[1:19], buf[19:37])))
+    a, b = socket.socketpair()
+    channel = BertecCommandChannel(a, max_rate=10.0)
+    channel.set(1.0, 1.0)
+    sleep(0.02) # sent right away, the next send is due 0.1 s later
+    for i in range(50): # setpoints from a fast control loop meanwhile
+        channel.set(1.0 + 0.01*i, 1.0)
+    sleep(0.15)
+    channel.set(1.49, 1.0) # a repeat
+    sleep(0.15)
+    channel.close()
+    assert(channel.sent == 2 and channel.coalesced == 49 and channel.last_sent[0] == 1.49)
+    b.settimeout(0.1)
+    sent = b.recv(1024)
+    assert(len(sent) == 2*BERTEC_COMMAND_SIZE and struct.unpack_from(">h", sent, 65)[0] == 1490)
+    a.close()
+    b.close()
+    # bad setpoints are refused, clamped, or at worst counted, and the writer keeps going
+    assert(struct.unpack_from(">9h", packet.pack(1.0, 1.0, incline=1e6, accR=40), 1)[4:] == (32767, 200, 0, 0, 32767))
+    a, b = socket.socketpair()
+    channel = BertecCommandChannel(a, max_rate=100.0)
+    try:
+        channel.set(float('nan'), 1.0)
+        assert(False)
+    except ValueError:
+        pass
+    with channel._pending_lock: # as if it had slipped past set()
+        channel._pending = (float('nan'), 1.0, 0, 0.2, 0.2)
+    channel._wake.set()
+    sleep(0.05)
+    channel.set(0.8, 0.8)
+    sleep(0.05)
+    channel.close()
+    assert(channel.send_errors == 1 and isinstance(channel.last_error, ValueError))
+    assert(channel.sent == 1 and channel.last_sent[0] == 0.8)
+    b.settimeout(0.1)
+    assert(struct.unpack_from(">h", b.recv(1024), 1)[0] == 800)
+    a.close()
+    b.close()
+    # a send that outlasts the socket timeout is resumed, not cut short
+    a, b = socket.socketpair()
+    a.settimeout(0.01)
+    data = bytes(range(256))*4096
+    received = bytearray()
+    def read_slowly():
+        sleep(0.05)
+        while len(received) < len(data):
+            received.extend(b.recv(65536))
+    reader = Thread(target=read_slowly)
+    reader.start()
+    _send_all(a, data)
+    reader.join()
+    assert(received == data)
+    a.close()
+    b.close()
 
+def test_odometry_integrator():
+    rng = np.random.default_rng(0)
+    # speed ramping like a belt, read at jittery packet arrival times
+    t = np.cumsum(rng.uniform(0.5e-3, 1.5e-3, 2001))
+    t[1000:1004] = t[1000] + np.arange(4)*1e-5 # a burst of coalesced packets
+    v = 1.0 + 0.5*np.sin(2*t)
+    exact = (t[-1] - 0.25*np.cos(2*t[-1])) - (t[0] - 0.25*np.cos(2*t[0]))
+    errors = {}
+    for mode in OdometryIntegrator.MODES:
+        online = OdometryIntegrator(mode)
+        running = [online.update(y, tk) for tk, y in zip(t, v)]
+        batch = integrate_samples(t, v, mode)
+        assert(np.allclose(running, batch, rtol=0, atol=1e-12))
+        errors[mode] = abs(batch[-1] - exact)
+    assert(errors["simpson"] < errors["trapezoid"]/10)
+    # a corrupted reading and a repeated timestamp are skipped
+    v_bad, t_bad = v.copy(), t.copy()
+    v_bad[500] = 30.0
+    t_bad[700] = t_bad[699]
+    online = OdometryIntegrator("trapezoid", max_rate=5.0, tolerance=0.05)
+    for tk, y in zip(t_bad, v_bad):
+        online.update(y, tk)
+    batch = integrate_samples(t_bad, v_bad, "trapezoid", max_rate=5.0, tolerance=0.05)
+    assert(online.rejected == 2 and abs(online.value - exact) < 1e-5 and abs(batch[-1] - online.value) < 1e-12)
 
 if __name__ == '__main__':
     bertec = Bertec()
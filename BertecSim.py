@@ -0,0 +1,165 @@
+"""
+A local stand-in for the Bertec treadmill PC's remote control port, so that
+BertecMan can be run and measured without the treadmill.
+
+BertecSimulator listens on a TCP port and streams 32 byte status packets to
+the connected client at a fixed rate. The belts follow the speed commands
+the client sends (64 byte packets, see BertecCommandPacket) at the
+commanded accelerations, with a little speed ripple, and the speeds are
+quantized to mm/s like the real ones. When the sender falls behind its
+schedule it catches up with several packets in one send, the way a busy
+treadmill PC does.
+
+With counter=True the right belt speed field carries a packet counter
+instead of a speed, and the send time of every packet is kept in
+sent_times, so a client can measure its own latency.
+"""
+
+import socket
+import struct
+import threading
+from time import time, sleep
+import numpy as np
+from BertecMan import BERTEC_PACKET_SIZE, BERTEC_COMMAND, BERTEC_COMMAND_SIZE
+
+_STATUS = struct.Struct(">xhh4xh")
+
+class BertecSimulator:
+    def __init__(self, host="127.0.0.1", port=4000, rate=1000.0, speed=(0.0, 0.0), incline=0.0,
+            ripple=0.002, counter=False, max_packets=1000000, seed=0):
+        """ speed is the initial (left, right) belt speed in m/s, ripple the
+        standard deviation of the speed noise in m/s """
+        self.rate = rate
+        self.speed_left, self.speed_right = speed
+        self.target = (self.speed_left, self.speed_right)
+        self.acc = (0.2, 0.2) # left, right, m/s^2
+        self.incline = incline
+        self.ripple = ripple
+        self.counter = counter
+        self.sent_times = np.zeros((max_packets,)) if counter else None
+        self.packets = 0
+        self.commands = 0
+        self.bad_commands = 0
+        self._rng = np.random.default_rng(seed)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.server.settimeout(0.1)
+        self.port = self.server.getsockname()[1]
+        self._stopped = False
+        self.thread = threading.Thread(target=self._serve, name="BertecSimulator", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self._stopped = True
+        if self.thread.is_alive():
+            self.thread.join()
+        self.server.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, etype, value, tb):
+        self.close()
+
+    def _serve(self):
+        while not self._stopped:
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.setblocking(False)
+            try:
+                self._stream(conn)
+            except OSError: # the client went away
+                pass
+            finally:
+                conn.close()
+
+    def _read_commands(self, conn, pending):
+        try:
+            data = conn.recv(4096)
+        except BlockingIOError:
+            return pending
+        if not data:
+            raise ConnectionResetError()
+        pending += data
+        while len(pending) >= BERTEC_COMMAND_SIZE:
+            fields = BERTEC_COMMAND.unpack_from(pending, 0)
+            check = all(a + b == 255 for a, b in zip(pending[1:19], pending[19:37]))
+            del pending[:BERTEC_COMMAND_SIZE]
+            if not check:
+                self.bad_commands += 1
+                continue
+            _, right, left, _, _, acc_right, acc_left, _, _, incline = fields
+            self.target = (left/1000, right/1000)
+            self.acc = (max(acc_left, 1)/1000, max(acc_right, 1)/1000)
+            self.incline = incline/100.0 # assumed 1/100 deg, like the status packets
+            self.commands += 1
+        return pending
+
+    def _step(self, dt):
+        left, right = self.target
+        acc_left, acc_right = self.acc
+        self.speed_left += min(max(left - self.speed_left, -acc_left*dt), acc_left*dt)
+        self.speed_right += min(max(right - self.speed_right, -acc_right*dt), acc_right*dt)
+
+    def _stream(self, conn):
+        period = 1.0/self.rate
+        out = bytearray(64*BERTEC_PACKET_SIZE)
+        pending = bytearray()
+        t_next = time()
+        while not self._stopped:
+            pending = self._read_commands(conn, pending)
+            now = time()
+            due = min(int((now - t_next)/period) + 1, 64) if now >= t_next else 0
+            if due == 0:
+                sleep(min(t_next - now, 0.001))
+                continue
+            ripple = self._rng.normal(0.0, self.ripple, (due, 2)) if self.ripple else np.zeros((due, 2))
+            for i in range(due):
+                self._step(period)
+                if self.counter:
+                    right = self.packets % 32768
+                    if self.packets < len(self.sent_times):
+                        self.sent_times[self.packets] = now
+                else:
+                    right = round((self.speed_right + ripple[i, 1])*1000)
+                left = round((self.speed_left + ripple[i, 0])*1000)
+                _STATUS.pack_into(out, i*BERTEC_PACKET_SIZE, right, left, round(self.incline*100))
+                self.packets += 1
+            view = memoryview(out)[:due*BERTEC_PACKET_SIZE]
+            while len(view):
+                try:
+                    view = view[conn.send(view):]
+                except BlockingIOError: # the client is not reading, wait for it
+                    sleep(0.001)
+            t_next += due*period
+            if now - t_next > 1.0: # far behind, drop the backlog instead of bursting
+                t_next = now
+
+
+def test_simulator():
+    from BertecMan import Bertec
+    with BertecSimulator(port=0, rate=500.0, speed=(1.0, 1.0), incline=2.0, ripple=0.0) as sim:
+        bertec = Bertec("127.0.0.1", sim.port, transport="poll", command_rate=50.0)
+        t_end = time() + 0.2
+        while time() < t_end:
+            bertec.poll(0.01)
+        assert(bertec.get_belt_speed() == [1.0, 1.0] and bertec.get_treadmill_incline() == 2.0)
+        assert(bertec.parser.packets > 50)
+        bertec.set_belt_speed(1.1, 1.1, incline=300, accR=1.0, accL=1.0)
+        t_end = time() + 0.3
+        while time() < t_end:
+            bertec.poll(0.01)
+        assert(sim.commands == 1 and sim.bad_commands == 0 and bertec.get_treadmill_incline() == 3.0)
+        assert(bertec.get_belt_speed() == [1.1, 1.1] and bertec.distance > 0)
+        bertec.close()
+
+if __name__ == '__main__':
+    test_simulator()
@@ -0,0 +1,78 @@
+"""
+A fixed-width binary log that buffers rows in a preallocated NumPy array and
+writes them to disk in blocks, so the real-time loop only pays a memory copy
+per row. Files are a header line naming the columns, followed by raw
+little-endian float64 records. Read them back with load_binary_log.
+"""
+
+import numpy as np
+
+_MAGIC = b"NLMBIN1 "
+
+class BinaryLog():
+    def __init__(self, file_name, columns, capacity=1024):
+        self.file_name = file_name
+        self.columns = list(columns)
+        self.buffer = np.zeros((capacity, len(self.columns)), dtype='<f8')
+        self.n = 0
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.file_name, 'wb')
+        self.file.write(_MAGIC + ",".join(self.columns).encode("ascii") + b"\n")
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.flush()
+        self.file.close()
+        self.file = None
+
+    def append(self, *row):
+        self.buffer[self.n] = row
+        self.n += 1
+        if self.n == self.buffer.shape[0]:
+            self.flush()
+
+    def extend(self, rows):
+        " Appends a 2D array of rows "
+        rows = np.asarray(rows)
+        while rows.shape[0] > 0:
+            k = min(rows.shape[0], self.buffer.shape[0]-self.n)
+            self.buffer[self.n:self.n+k] = rows[:k]
+            self.n += k
+            rows = rows[k:]
+            if self.n == self.buffer.shape[0]:
+                self.flush()
+
+    def flush(self):
+        if self.n > 0:
+            self.file.write(self.buffer[:self.n].tobytes())
+            self.file.flush()
+            self.n = 0
+
+
+def load_binary_log(file_name):
+    """ Returns (columns, data) where data has one row per record """
+    with open(file_name, 'rb') as fd:
+        header = fd.readline()
+        if not header.startswith(_MAGIC):
+            raise ValueError("%s is not a BinaryLog file" % file_name)
+        columns = header[len(_MAGIC):].decode("ascii").strip().split(",")
+        data = np.frombuffer(fd.read(), dtype='<f8')
+    return columns, data.reshape(-1, len(columns))
+
+
+def test_binary_log():
+    import os, tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        name = os.path.join(tmpdir, "log.bin")
+        with BinaryLog(name, ["t", "a", "b"], capacity=4) as log:
+            for i in range(6):
+                log.append(i, 2*i, 3*i)
+            log.extend(np.ones((7,3)))
+        columns, data = load_binary_log(name)
+    assert(columns == ["t", "a", "b"])
+    assert(data.shape == (13, 3) and data[5, 2] == 15 and data[-1, 0] == 1)
+
+if __name__ == '__main__':
+    test_binary_log()
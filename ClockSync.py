@@ -0,0 +1,158 @@
+"""
+Clock offset and drift estimation between two synch endpoints, NTP style.
+
+Each message from the peer carries its send time t3 on the peer's clock,
+the sequence number `echo` of our latest message it had received, and the
+hold time it kept that message before replying. With t1 our send time for
+`echo` and t4 our arrival time,
+
+    offset = ((t3 - hold - t1) + (t3 - t4))/2   peer clock minus local clock
+    delay  = (t4 - t1) - hold                   round trip spent on the wire
+
+and the offset sample is wrong by at most the path asymmetry, itself at
+most delay/2. ClockOffsetFilter tracks (offset, drift) with a two-state
+Kalman filter whose measurement variance grows with how far a sample's
+delay is above the recent minimum, so queued-up exchanges barely count.
+"""
+
+from math import sqrt
+
+class ClockOffsetFilter():
+    def __init__(self, offset_noise=1e-12, drift_noise=1e-14, jitter=20e-6,
+            min_delay_leak=1e-5, gate=5.0, max_rejects=50):
+        """
+        offset_noise, drift_noise: random walk spectral densities of the
+            offset (s^2/s) and of the drift ((s/s)^2/s)
+        jitter: standard deviation of a minimum-delay offset sample, s
+        min_delay_leak: how fast the minimum delay is allowed to creep up
+            after route changes, s/s
+        gate: innovations beyond this many standard deviations are rejected,
+            until max_rejects in a row suggest the peer's clock was stepped
+        """
+        self.q_offset, self.q_drift = offset_noise, drift_noise
+        self.r0 = jitter*jitter
+        self.min_delay_leak = min_delay_leak
+        self.gate2 = gate*gate
+        self.max_rejects = max_rejects
+        self.reset()
+
+    def reset(self):
+        self.rejected = 0
+        self.steps = 0 # times the peer's clock jumped and the filter started over
+        self._restart()
+
+    def _restart(self):
+        self.offset = 0.0 # peer minus local, at local time self.t
+        self.drift = 0.0 # d(offset)/dt
+        self.t = None
+        self.min_delay = float('inf')
+        self.samples = 0
+        self._rejects_in_row = 0
+
+    def update_exchange(self, t1, t3, hold, t4):
+        """ t1, t4 local, t3 peer clock, hold in seconds. Returns True if the
+        sample was used. """
+        return self.update(t4, 0.5*((t3 - hold - t1) + (t3 - t4)), (t4 - t1) - hold)
+
+    def update(self, t, offset, delay):
+        " One offset sample taken at local time t over a round trip of delay "
+        if delay < 0:
+            return False
+        if self.t is None:
+            self.min_delay = delay
+            self.offset, self.drift, self.t = offset, 0.0, t
+            self._p00, self._p01, self._p11 = self.r0 + 0.25*delay*delay, 0.0, (100e-6)**2
+            self.samples = 1
+            return True
+        dt = t - self.t
+        if dt < 0:
+            return False
+        self.min_delay = min(delay, self.min_delay + self.min_delay_leak*dt)
+        excess = 0.5*(delay - self.min_delay)
+
+        # predict, F = [[1, dt], [0, 1]]
+        p01, p11 = self._p01, self._p11
+        p00 = self._p00 + 2*dt*p01 + dt*dt*p11 + self.q_offset*dt
+        p01 = p01 + dt*p11
+        p11 = p11 + self.q_drift*dt
+        predicted = self.offset + self.drift*dt
+
+        s = p00 + self.r0 + excess*excess
+        y = offset - predicted
+        if y*y > self.gate2*s and self.samples > 8:
+            self.rejected += 1
+            self._rejects_in_row += 1
+            if self._rejects_in_row >= self.max_rejects:
+                self.steps += 1
+                self._restart()
+                return self.update(t, offset, delay)
+            return False
+        self._rejects_in_row = 0
+
+        k0, k1 = p00/s, p01/s
+        self.offset = predicted + k0*y
+        self.drift += k1*y
+        self._p00 = p00 - k0*p00
+        self._p01 = p01 - k0*p01
+        self._p11 = p11 - k1*p01
+        self.t = t
+        self.samples += 1
+        return True
+
+    ## Conversions
+
+    def offset_at(self, t_local):
+        return self.offset + self.drift*(t_local - self.t)
+
+    def to_local(self, t_peer):
+        " The local time at which the peer's clock read t_peer "
+        if self.t is None:
+            return float('nan')
+        return self.t + (t_peer - self.offset - self.t)/(1.0 + self.drift)
+
+    def to_peer(self, t_local):
+        if self.t is None:
+            return float('nan')
+        return t_local + self.offset_at(t_local)
+
+    def uncertainty(self):
+        " Standard deviation of the offset estimate, s "
+        return sqrt(self._p00) if self.t is not None else float('inf')
+
+    def report(self):
+        if self.t is None:
+            print("ClockOffsetFilter: no exchanges yet")
+            return
+        print("ClockOffsetFilter: peer - local %.6f s +- %.1f us, drift %.2f ppm, min delay %.1f us, %d samples, %d rejected, %d steps"%(
+            self.offset, self.uncertainty()*1e6, self.drift*1e6, self.min_delay*1e6, self.samples, self.rejected, self.steps))
+
+
+def test_clock_offset_filter():
+    import numpy as np
+    rng = np.random.default_rng(0)
+    true_offset, true_drift = 0.3, 50e-6
+    def peer_clock(t):
+        return t + true_offset + true_drift*t
+    clock = ClockOffsetFilter()
+    t = 1000.0
+    for i in range(20000): # 20 s at 1 kHz, with exponential queueing delays
+        t1 = t
+        t2 = t1 + 100e-6 + rng.exponential(200e-6)
+        hold = rng.uniform(0.0, 1e-3)
+        t4 = t2 + hold + 100e-6 + rng.exponential(200e-6)
+        clock.update_exchange(t1, peer_clock(t2 + hold), hold, t4)
+        t += 1e-3
+    assert(abs(clock.offset_at(t) - (true_offset + true_drift*t)) < 50e-6)
+    assert(abs(clock.drift - true_drift) < 5e-6)
+    assert(abs(clock.to_local(peer_clock(t + 0.5)) - (t + 0.5)) < 50e-6)
+    assert(abs(clock.to_local(clock.to_peer(t)) - t) < 1e-9)
+    # a stepped peer clock is rejected at first, then re-acquired
+    true_offset += 1.0
+    for i in range(200):
+        t1 = t
+        clock.update_exchange(t1, peer_clock(t1 + 300e-6), 0.0, t1 + 600e-6)
+        t += 1e-3
+    assert(clock.steps == 1 and clock.rejected >= 50 and abs(clock.offset_at(t) - (true_offset + true_drift*t)) < 50e-6)
+
+if __name__ == '__main__':
+    test_clock_offset_filter()
@@ -4,11 +4,12 @@ from ActPackMan import ActPackMan
 from SoftRealtimeLoop import SoftRealtimeLoop
 from ActPackMan import FlexSEA
 from ActPackMan import _ActPackManStates
-from IIR2Filter import IIR2Filter
+from LinearFilter import KinematicKalmanFilter
 import numpy as np
 import math
 import time
-import csv
+from enum import Enum
+from EB51Parameters import EB51Parameters, SSParameterStore, default_parameter_path
 
 from flexsea import fxEnums as fxe  # pylint: disable=no-name-in-module
 
@@ -29,10 +30,51 @@ MAX_MOTOR_TORQUE = MAX_CURRENT_AMPS * NM_PER_AMP
 INERTIA_G_M2 = 0.12  # Motor rotational moment of inertia in grams per meter squared
 DEG_PER_RAD = 180/np.pi
 MAX_BATTERY_CURRENT_AMPS = 11 
+RAD_PER_ANKLE_CLICK = 2*np.pi/pow(2,14)
+ANKLE_ANGLE_VARIANCE = RAD_PER_ANKLE_CLICK**2/12  # Quantization noise of the ankle encoder
+ANKLE_JERK_NOISE = 1e5  # White jerk spectral density for the ankle estimator, (rad/s^3)^2/Hz
+
+class _RealignStates(Enum):
+    WINDING = 1   # voltage applied, waiting for the belt to take up slack
+    BACKOFF = 2   # waiting out retry_delay after a failed attempt
+    SETTLING = 3  # gains restored, waiting settle_time before use
+    DONE = 4
+    FAILED = 5
+
+_REALIGN_FINISHED = (_RealignStates.DONE, _RealignStates.FAILED)
+
+class _RealignProgress(object):
+    """ Book-keeping for one run of the EB51Man realignment state machine """
+    def __init__(self, controller_state, timeout, max_attempts, retry_delay,
+        winding_voltage, current_threshold, settle_time):
+        self.controller_state = controller_state
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.winding_voltage = winding_voltage
+        self.current_threshold = current_threshold
+        self.settle_time = settle_time
+        self.state = None
+        self.attempt = 0
+        self.ticks = 0
+        self.t_start = self.t_state = self.t_attempt = time.time()
+        self.attempt_durations = []
+        self.last_error = None
+
+    def enter(self, state, now):
+        self.state = state
+        self.t_state = now
+
+    def status(self, now):
+        return dict(state=self.state.name, attempt=self.attempt,
+            max_attempts=self.max_attempts, ticks=self.ticks,
+            elapsed=now - self.t_start, time_in_state=now - self.t_state,
+            attempt_durations=list(self.attempt_durations), last_error=self.last_error)
 
 class EB51Man(ActPackMan):
     def __init__(self, devttyACMport, whichAnkle, dt,
-    slack = 0.08, vars_to_log=EB51_DEFAULT_VARIABLES, csv_file_name = None, **kwargs):
+    slack = 0.08, vars_to_log=EB51_DEFAULT_VARIABLES, csv_file_name = None,
+    ankle_jerk_noise = ANKLE_JERK_NOISE, param_filepath = None, param_store = None, **kwargs):
 
         super(EB51Man, self).__init__(devttyACMport, csv_file_name = csv_file_name, vars_to_log = vars_to_log, **kwargs)
 
@@ -47,50 +89,19 @@ class EB51Man(ActPackMan):
         if whichAnkle == 'left':
             self.slack = (-1)*self.slack
 
-        self.prevOutputAngle = np.pi/2
+        # Ankle angle, velocity and acceleration estimated from the encoder and device timestamps
+        self.ankleFilter = KinematicKalmanFilter(ankle_jerk_noise, ANKLE_ANGLE_VARIANCE, x0=np.pi/2)
         self.currOutputAngle = np.pi/2
-        self.prevOutputVel = 0
         self.currOutputVel = 0
-        self.prevTime = time.time()
-        self.currTime = time.time()
+        self.currOutputAcc = 0
         
-        if whichAnkle == 'right':
-            param_filepath = "/home/pi/MBLUE/device_side/parameters/MBLUE_Ankle_params_right.csv"
-        elif whichAnkle == 'left':
-            param_filepath = "/home/pi/MBLUE/device_side/parameters/MBLUE_Ankle_params_left.csv"
-
-        with open(param_filepath, 'r') as params_file:
-            params_reader = csv.reader(params_file)
-            params = []
-            for row in params_reader:
-                params.append(row) 
-
-        # Fitting break points 
-        self.break1 = float(params[1][0])
-        self.break2 = float(params[1][1])
-        self.break3 = float(params[1][2])
-        self.break4 = float(params[1][3])
-
-        # Fitting parameters where a is deg 2, b is deg 1, c is deg 0
-        self.angleL1b = float(params[3][1])  # Positive slope linear fit
-        self.angleL1c = float(params[3][2])
-        self.angleQa = float(params[4][0])  # Quadratic fit
-        self.angleQb = float(params[4][1])
-        self.angleQc = float(params[4][2])  
-        self.angleL2b = float(params[5][1])  # Negative slope linear fit
-        self.angleL2c = float(params[5][2])
-        
-        # Fitting parameters
-        self.gearL1 = float(params[7][1])  # Positive constant gear ratio
-        self.gearL2a = float(params[8][0])  # Degree 1
-        self.gearL2b = float(params[8][1])  # Degree 0
-        self.gearL3 = float(params[9][1])   # Negative constant gear ratio        
-
-        # Ankle angle where gear ratio flips signs
-        self.beltInflectionAngle =  (-1)*self.gearL2b/self.gearL2a + self.break2   
-        
-        self.calibrationOffset = 0
-        self.calibrationRealignmentComplete = False
+        self.realign = None  # state of a non-blocking calibration realignment
+
+        # Belt model parameters, parsed once per process and cached on disk by SSParameterStore
+        self.param_store = SSParameterStore() if param_store is None else param_store
+        if param_filepath is None:
+            param_filepath = default_parameter_path(whichAnkle)
+        self.set_parameters(self.param_store.load(param_filepath))
 
         self.kp = 0
         self.ki = 0
@@ -111,13 +122,9 @@ class EB51Man(ActPackMan):
         self.gear_ratio = self._calculate_gear_ratio()  # Update gear ratio for ankle angle output
         # self.mot_acc = self.FilterMotAcc.filter(self.get_motor_acceleration_radians_per_second_squared())
 
-        if (self.get_output_angle_radians() != self.currOutputAngle) or ((time.time() - self.currTime ) > 0.016):
-            self.prevOutputAngle = self.currOutputAngle
-            self.prevOutputVel = self.currOutputVel
-            self.prevTime = self.currTime
-            self.currTime = time.time()
-            self.currOutputAngle = self.get_output_angle_radians()
-            self.currOutputVel = (self.currOutputAngle - self.prevOutputAngle)/(self.currTime - self.prevTime)
+        # state_time is the device clock in ms, so repeated reads of one packet are not new samples
+        self.currOutputAngle, self.currOutputVel, self.currOutputAcc = self.ankleFilter.update(
+            self.get_output_angle_radians(), self.act_pack.state_time*1e-3)
 
     # Gain setting and control mode switching
 
@@ -149,6 +156,28 @@ class EB51Man(ActPackMan):
         self.ff = ff
         super().set_impedance_gains_real_unit_KB(kp=kp, ki=ki, K=K, B=B, ff=ff)
 
+    # Belt model parameters
+
+    def set_parameters(self, params):
+        """ Swaps in a belt model without reopening the device. params is
+        either an EB51Parameters or the name of a profile in the parameter
+        store. The calibration offset was measured against the old model, so
+        calibration must be realigned before position control is used again;
+        a realignment in progress starts over from its first attempt. """
+        if not isinstance(params, EB51Parameters):
+            params = self.param_store.get(params)
+        self.params = params
+        for name, value in zip(params._fields, params):
+            setattr(self, name, value)
+        self.beltInflectionAngle = params.belt_inflection_angle
+        self.calibrationOffset = 0
+        self.calibrationRealignmentComplete = False
+        if self.realign is not None and self.realign.state not in _REALIGN_FINISHED:
+            self._restart_realign(time.time()) # measure against the new model
+
+    def get_parameters(self):
+        return self.params
+
     # Private functions
 
     def _calculate_gear_ratio(self):  
@@ -167,45 +196,113 @@ class EB51Man(ActPackMan):
         print("Warning: gear ratio not updated")
         return self.gear_ratio
 
-    def realign_calibration(self):  # Needs to be completed 
-        " Call function to realign calibration when motor turned on "
-        print("Realign calibration")
-        self.calibrationOffset = 0
-        controller_state = self._state
-
-        winding_voltage = 0.8
-        if self.whichAnkle == 'right':
-            winding_voltage = (-1) * winding_voltage 
-        self.set_voltage_qaxis_volts(winding_voltage)
+    def realign_calibration(self, **kwargs):
+        """ Blocking realignment, for use before the main loop starts.
+        Runs the same state machine as step_realign_calibration in a private
+        100 Hz loop. Returns True on success. """
+        self.start_realign_calibration(**kwargs)
         loop = SoftRealtimeLoop(dt = 0.01, report=False, fade=0.01)
         for t in loop:
             self.update()
-            # print("voltage ", self.get_voltage_qaxis_volts(), " current ", self.get_current_qaxis_amps()) 
-            if abs(self.get_current_qaxis_amps()) > 1.6:
-                # print("Current threshold hit")
+            if self.step_realign_calibration() in _REALIGN_FINISHED:
                 break
-
-        self.set_voltage_qaxis_volts(0.0)
+        if self.realign.state is not _RealignStates.DONE:
+            self.set_voltage_qaxis_volts(0.0)
+        return self.calibrationRealignmentComplete
+
+    def start_realign_calibration(self, timeout=3.0, max_attempts=5, retry_delay=2.0,
+        winding_voltage=0.8, current_threshold=1.6, settle_time=0.05):
+        """ Begins a non-blocking calibration realignment. Call
+        step_realign_calibration once per control tick, after update(), until
+        it returns DONE or FAILED. Each attempt winds the belt with a small
+        voltage until the current threshold is hit or timeout seconds pass. """
+        print("Realign calibration")
+        if self.whichAnkle == 'right':
+            winding_voltage = (-1) * abs(winding_voltage)
+        self.realign = _RealignProgress(self._state, timeout, max_attempts, retry_delay,
+            winding_voltage, current_threshold, settle_time)
+        self.calibrationOffset = 0
+        self.calibrationRealignmentComplete = False
+        self._begin_realign_attempt(time.time())
+        return self.realign.state
+
+    def step_realign_calibration(self):
+        " Advances the realignment by at most one transition. Never sleeps. "
+        rl = self.realign
+        if rl is None or rl.state in _REALIGN_FINISHED:
+            return None if rl is None else rl.state
+        now = time.time()
+        rl.ticks += 1
+
+        if rl.state is _RealignStates.WINDING:
+            if abs(self.get_current_qaxis_amps()) > rl.current_threshold:
+                self.set_voltage_qaxis_volts(0.0)
+                self._finish_realign_attempt(now)
+            elif now - rl.t_attempt > rl.timeout:
+                self.set_voltage_qaxis_volts(0.0)
+                self._fail_realign_attempt(now, "current threshold not reached in %g s"%rl.timeout)
+
+        elif rl.state is _RealignStates.BACKOFF:
+            if now >= rl.t_state + rl.retry_delay:
+                self._begin_realign_attempt(now)
+
+        elif rl.state is _RealignStates.SETTLING:
+            if now >= rl.t_state + rl.settle_time:
+                rl.enter(_RealignStates.DONE, now)
+                print("Belt calibration realignment complete")
+
+        return rl.state
+
+    def get_realignment_status(self):
+        " Progress and timing of the current (or last) realignment, as a dict "
+        if self.realign is None:
+            return None
+        return self.realign.status(time.time())
+
+    def _restart_realign(self, now):
+        " Starts the current realignment over from its first attempt, keeping its settings "
+        rl = self.realign
+        rl.attempt = 0
+        rl.attempt_durations = []
+        rl.last_error = None
+        rl.t_start = now
+        self._begin_realign_attempt(now)
+
+    def _begin_realign_attempt(self, now):
+        rl = self.realign
+        rl.attempt += 1
+        rl.t_attempt = now
+        rl.enter(_RealignStates.WINDING, now)
+        self.set_voltage_qaxis_volts(rl.winding_voltage)
+
+    def _finish_realign_attempt(self, now):
+        rl = self.realign
         ankle_angle = self.get_output_angle_radians()
-        model_motor_angle = self.get_desired_motor_angle_radians(ankle_angle)
         actual_motor_angle = self.get_motor_angle_radians()
-        
+        try:
+            self.calibrationOffset = 0
+            model_motor_angle = self.get_desired_motor_angle_radians(ankle_angle)
+        except RuntimeError as e: # ankle outside the belt model
+            return self._fail_realign_attempt(now, str(e))
         self.calibrationOffset = actual_motor_angle - model_motor_angle
-        # print("model_motor_angle ", model_motor_angle, " actual_motor_angle ", actual_motor_angle, " calibration offset ", self.calibrationOffset)
-        # print("belt inflection angle ", self.beltInflectionAngle)
-
-        if abs(self.get_desired_motor_angle_radians(ankle_angle) - actual_motor_angle) > 0.5:
-            print("Warning: calibration realignment failed, trying again")
-            time.sleep(2)
-            self.realign_calibration() 
-        self.calibrationRealignmentComplete = True 
-        self._state = controller_state 
-        FlexSEA().set_gains(self.dev_id, self.kp, self.ki, self.kd, self.K, self.B, self.ff)
-
-        time.sleep(0.05)
-        print("Belt calibration realingment complete")
 
+        rl.attempt_durations.append(now - rl.t_attempt)
+        self.calibrationRealignmentComplete = True
+        self._state = rl.controller_state
+        FlexSEA().set_gains(self.dev_id, self.kp, self.ki, self.kd, self.K, self.B, self.ff)
+        rl.enter(_RealignStates.SETTLING, now)
 
+    def _fail_realign_attempt(self, now, reason):
+        rl = self.realign
+        rl.attempt_durations.append(now - rl.t_attempt)
+        rl.last_error = reason
+        self.calibrationOffset = 0
+        if rl.attempt >= rl.max_attempts:
+            print("Warning: calibration realignment failed after %d attempts (%s)"%(rl.attempt, reason))
+            rl.enter(_RealignStates.FAILED, now)
+        else:
+            print("Warning: calibration realignment failed (%s), trying again"%reason)
+            rl.enter(_RealignStates.BACKOFF, now)
 
     # Motor-side variables
 
@@ -235,13 +332,16 @@ class EB51Man(ActPackMan):
     def get_output_angle_radians(self):
         if (self.act_pack is None):
             raise RuntimeError("ActPackMan not updated before state is queried.")
-        return self.act_pack.ank_ang * 2*np.pi / pow(2,14)
+        return self.act_pack.ank_ang * RAD_PER_ANKLE_CLICK
+
+    def get_filtered_output_angle_radians(self):
+        return self.currOutputAngle
 
     def get_output_velocity_radians_per_second(self):  
         return self.currOutputVel
 
     def get_output_acceleration_radians_per_second_squared(self):  
-        return (self.currOutputVel - self.prevOutputVel)/(self.currTime - self.prevTime)
+        return self.currOutputAcc
 
     def get_output_torque_newton_meters(self): 
         return self.get_motor_torque_newton_meters()*self.gear_ratio
@@ -0,0 +1,187 @@
+""" Calibration profiles for the Dephy ExoBoot (EB51Man) belt/ankle model """
+
+import os
+import csv
+import struct
+import hashlib
+from math import isfinite
+from collections import namedtuple
+
+DEFAULT_PARAMETER_DIRECTORY = "/home/pi/MBLUE/device_side/parameters"
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "NeuroLocoMiddleware", "eb51")
+
+EB51_PARAMETER_FIELDS = (
+    "break1", "break2", "break3", "break4", # Fitting break points
+    "angleL1b", "angleL1c", # Positive slope linear fit, deg 1 and deg 0
+    "angleQa", "angleQb", "angleQc", # Quadratic fit, deg 2, 1 and 0
+    "angleL2b", "angleL2c", # Negative slope linear fit, deg 1 and deg 0
+    "gearL1", # Positive constant gear ratio
+    "gearL2a", "gearL2b", # Linear gear ratio, deg 1 and deg 0
+    "gearL3", # Negative constant gear ratio
+)
+
+# (row, column) of each field in the MBLUE_Ankle_params_*.csv files
+_CSV_LAYOUT = (
+    (1, 0), (1, 1), (1, 2), (1, 3),
+    (3, 1), (3, 2),
+    (4, 0), (4, 1), (4, 2),
+    (5, 1), (5, 2),
+    (7, 1),
+    (8, 0), (8, 1),
+    (9, 1),
+)
+
+_CACHE_MAGIC = b"EB51"
+_CACHE_VERSION = 1
+_CACHE_STRUCT = struct.Struct("<4sH%dd" % len(EB51_PARAMETER_FIELDS))
+
+
+class EB51Parameters(namedtuple("EB51Parameters", EB51_PARAMETER_FIELDS)):
+    """ An immutable, validated set of belt model parameters """
+    __slots__ = ()
+
+    @property
+    def belt_inflection_angle(self):
+        " Ankle angle where gear ratio flips signs "
+        return (-1)*self.gearL2b/self.gearL2a + self.break2
+
+    def validate(self):
+        for name, value in zip(self._fields, self):
+            if not isfinite(value):
+                raise ValueError("EB51 parameter %s is not finite (%r)" % (name, value))
+        if not (self.break1 < self.break2 < self.break3 < self.break4):
+            raise ValueError("EB51 break points must be strictly increasing, got %r" % (
+                (self.break1, self.break2, self.break3, self.break4),))
+        if self.gearL2a == 0:
+            raise ValueError("EB51 parameter gearL2a must be nonzero")
+        return self
+
+
+def default_parameter_path(whichAnkle):
+    return os.path.join(DEFAULT_PARAMETER_DIRECTORY, "MBLUE_Ankle_params_%s.csv" % whichAnkle)
+
+
+def parse_parameter_csv(text):
+    " Parses the contents of an MBLUE_Ankle_params_*.csv file "
+    rows = list(csv.reader(text.splitlines()))
+    try:
+        return EB51Parameters(*[float(rows[r][c]) for r, c in _CSV_LAYOUT])
+    except (IndexError, ValueError) as e:
+        raise ValueError("Malformed EB51 parameter file: %s" % e)
+
+
+class EB51ParameterStore():
+    """ Loads each calibration profile once and keeps it by name.
+
+    Parsed profiles are cached in memory and on disk in a packed binary form
+    keyed by the SHA-1 of the source csv, so restarts and repeated device
+    construction skip csv parsing and validation. Looking a profile up by
+    name never touches the file system, which makes it safe to swap
+    profiles from inside the control loop.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIRECTORY):
+        self.cache_dir = cache_dir
+        self._by_hash = dict()
+        self._profiles = dict()
+
+    def load(self, path, name=None):
+        " Loads (or fetches from cache) the profile in path, registering it under name "
+        with open(path, 'rb') as fd:
+            raw = fd.read()
+        key = hashlib.sha1(raw).hexdigest()
+        params = self._by_hash.get(key)
+        if params is None:
+            params = self._read_cache(key)
+        if params is None:
+            params = parse_parameter_csv(raw.decode("utf-8")).validate()
+            self._write_cache(key, params)
+        self._by_hash[key] = params
+        self._profiles[path if name is None else name] = params
+        return params
+
+    def add(self, name, params):
+        " Registers an already-built profile, e.g. one fit online "
+        self._profiles[name] = EB51Parameters(*params).validate()
+        return self._profiles[name]
+
+    def get(self, name):
+        try:
+            return self._profiles[name]
+        except KeyError:
+            raise KeyError("EB51 parameter profile %r has not been loaded" % name)
+
+    def names(self):
+        return list(self._profiles.keys())
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, key + ".bin")
+
+    def _read_cache(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._cache_path(key), 'rb') as fd:
+                magic, version, *values = _CACHE_STRUCT.unpack(fd.read())
+        except (OSError, struct.error):
+            return None
+        if magic != _CACHE_MAGIC or version != _CACHE_VERSION:
+            return None
+        return EB51Parameters(*values)
+
+    def _write_cache(self, key, params):
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = self._cache_path(key) + ".tmp%d" % os.getpid()
+            with open(tmp, 'wb') as fd:
+                fd.write(_CACHE_STRUCT.pack(_CACHE_MAGIC, _CACHE_VERSION, *params))
+            os.replace(tmp, self._cache_path(key))
+        except OSError as e:
+            print("Warning: could not cache EB51 parameters (%s)" % e)
+
+
+class SSParameterStore(EB51ParameterStore):
+    """ Singleton parameter store shared by every EB51Man in the process """
+    _instance = None
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = EB51ParameterStore(*args, **kwargs)
+        return cls._instance
+
+
+def test_parameter_store():
+    import tempfile
+    text = "\n".join([
+        "break1,break2,break3,break4",
+        "0.9,1.4,1.9,2.4",
+        "fit,b,c",
+        ",-10.0,5.0",
+        "0.5,-2.0,3.0",
+        ",4.0,-1.0",
+        "gear,b,",
+        ",30.0,",
+        "-20.0,10.0,",
+        ",-15.0,",
+    ])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "params.csv")
+        with open(path, 'w') as fd:
+            fd.write(text)
+        store = EB51ParameterStore(cache_dir=os.path.join(tmpdir, "cache"))
+        params = store.load(path, name="right")
+        assert(params.break3 == 1.9 and params.gearL2b == 10.0)
+        assert(abs(params.belt_inflection_angle - 1.9) < 1e-12)
+        assert(len(os.listdir(store.cache_dir)) == 1)
+        # a fresh store reads the binary cache instead of the csv
+        assert(EB51ParameterStore(cache_dir=store.cache_dir).load(path) == params)
+        assert(store.get("right") is params)
+        try:
+            store.add("bad", params._replace(break2=0.0))
+            assert(False)
+        except ValueError:
+            pass
+
+if __name__ == '__main__':
+    test_parameter_store()
@@ -1,14 +1,120 @@
+"""
+Values that survive restarts, kept in small files.
+
+Files are always replaced whole (written to a temp file, then os.replace),
+so losing power mid-write leaves the old or the new value, never a
+truncated file. With write-behind, assignments only touch memory and one
+background thread writes whatever changed, at most every FLUSH_INTERVAL
+seconds, so counters can be bumped from the control loop.
+"""
+
+import atexit
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError: # Windows: locks only serialize the threads of one process
+    fcntl = None
+
+FLUSH_INTERVAL = 0.2 # s, write-behind coalescing window
+
+# Open file description locks (Linux) belong to one open file, so two
+# MappedFileGlobals on the same file exclude each other even in one process,
+# and closing some other handle on the file does not drop them. Elsewhere
+# lockf locks belong to the whole process, so the objects of one process
+# share a lock per file (_file_locks) instead.
+_OFD_SETLKW = getattr(fcntl, "F_OFD_SETLKW", None)
+_FLOCK = struct.Struct("@hhqqi") # struct flock: type, whence, start, len, pid
+_FLOCK_PADDING = b"\0"*(-_FLOCK.size % 8)
+_file_locks = {} # realpath -> threading.Lock, without _OFD_SETLKW
+_file_locks_lock = threading.Lock()
+
+def _lock_range(fil, exclusive, start, length):
+    if _OFD_SETLKW is None:
+        fcntl.lockf(fil, fcntl.LOCK_EX if exclusive else fcntl.LOCK_UN, length, start)
+    else:
+        flock = _FLOCK.pack(fcntl.F_WRLCK if exclusive else fcntl.F_UNLCK, os.SEEK_SET, start, length, 0)
+        fcntl.fcntl(fil, _OFD_SETLKW, flock + _FLOCK_PADDING)
+
+
+def _atomic_write(name, data):
+    tmp = "%s.tmp%d_%d" % (name, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, 'wb') as fil:
+            fil.write(data)
+            fil.flush()
+            os.fsync(fil.fileno())
+        os.replace(tmp, name)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class _WriteBehind():
+    """ The one thread that flushes dirty write-behind values. A value
+    that fails to write (disk full, folder gone) stays dirty and is tried
+    again on the next pass; the failures are counted in errors and the
+    newest kept in last_error. """
+    def __init__(self):
+        self._dirty = set()
+        self._wake = threading.Condition()
+        self._thread = None
+        self.errors = 0
+        self.last_error = None
+
+    def schedule(self, obj):
+        with self._wake:
+            if not self._dirty:
+                self._wake.notify()
+            self._dirty.add(obj)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="FileGlobal", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self._dirty:
+                    self._wake.wait()
+            time.sleep(FLUSH_INTERVAL) # let more updates land in the same write
+            self.flush()
+
+    def flush(self):
+        with self._wake:
+            dirty, self._dirty = self._dirty, set()
+        failed = set()
+        for obj in dirty:
+            try:
+                obj.flush()
+            except OSError as e:
+                failed.add(obj)
+                self.errors += 1
+                self.last_error = e
+        if failed:
+            with self._wake:
+                self._dirty |= failed
+
+_write_behind = _WriteBehind()
 
 
 class FileGlobalInt():
-    def __init__(self, name, default=0):
+    def __init__(self, name, default=0, write_behind=False):
+        """ write_behind: assignments return right away and the file is
+        written in the background (see FLUSH_INTERVAL) """
         self.name=name
+        self.write_behind = write_behind
+        self._lock = threading.Lock()
         try:
             fil = open(name, 'r')
         except FileNotFoundError:
-            fil = open(name, 'x')
-            with fil:
-                fil.write("%d"%default)
+            _atomic_write(name, b"%d"%default)
             fil = open(name, 'r')
         with fil:
             self._datum = int(fil.read())
@@ -20,10 +126,246 @@ class FileGlobalInt():
     @datum.setter
     def datum(self, value):
         self._datum=value
-        with open(self.name, 'w') as fil:
-            fil.write("%d"%self._datum)
+        if self.write_behind:
+            _write_behind.schedule(self)
+        else:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            _atomic_write(self.name, b"%d"%self._datum)
+
+
+class FileGlobalStore():
+    """
+    Many named values (ints, floats, small records; anything json can hold)
+    in one json file. store["trials"] += 1 updates a dict, and the file is
+    written behind. Use as a context manager, or call flush(), to be sure
+    the last values reach the disk before moving on.
+    """
+    def __init__(self, name, defaults=None):
+        self.name = name
+        self._lock = threading.Lock()
+        try:
+            with open(name, 'r') as fil:
+                self._values = json.load(fil)
+        except FileNotFoundError:
+            self._values = {}
+        missing = {key: value for key, value in (defaults or {}).items() if key not in self._values}
+        if missing or not os.path.exists(name):
+            self._values.update(missing)
+            self.flush()
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        _write_behind.schedule(self)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def keys(self):
+        return self._values.keys()
+
+    def flush(self):
+        with self._lock:
+            data = json.dumps(self._values, indent=1, sort_keys=True).encode("utf-8")
+            _atomic_write(self.name, data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.flush()
+
+
+_MAPPED_MAGIC = b"NLMFG1\n"
+_TYPE_CODES = {int: 'q', float: 'd'}
+
+class MappedFileGlobals():
+    """
+    Named ints and floats in a memory-mapped file: reading or assigning one
+    is a memory access into the mapping, and the OS writes the pages back
+    on its own. flush() forces them out (msync).
+
+    fields maps each name to its default, whose type (int or float) fixes
+    the slot's type. The file is a json header of names and types, then one
+    8 byte slot per field. Opening an existing file with different fields
+    rebuilds it (atomically), keeping the values of the fields in common.
 
+    Several processes can map the same file (with the same fields) and see
+    each other's values right away. add() and compare_and_swap() hold an
+    fcntl lock on just that field's slot, so counters shared between e.g.
+    the two ankles' controllers never lose an increment, and other
+    processes' updates to different fields don't wait on them. locked()
+    holds the whole file for updates spanning several fields. Threads
+    sharing one object take turns on all of its fields.
+    """
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = {key: (_TYPE_CODES[type(value)], value) for key, value in fields.items()}
+        self._slots = {key: i for i, key in enumerate(self.fields)}
+        header = self._header()
+        self._offset = len(header)
+        if _OFD_SETLKW is None:
+            # held while opening too, since closing any handle on the file drops our lockf locks
+            with _file_locks_lock:
+                self._thread_lock = _file_locks.setdefault(os.path.realpath(name), threading.Lock())
+        else:
+            self._thread_lock = threading.Lock()
+        # one process at a time creates or rebuilds the file and maps it
+        with self._thread_lock, open(name + ".lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            data = None
+            try:
+                with open(name, 'rb') as fil:
+                    data = fil.read()
+            except FileNotFoundError:
+                pass
+            if data is None or not data.startswith(header):
+                _atomic_write(name, header + self._initial_values(data))
+            self._file = open(name, 'r+b')
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        whole = memoryview(self._map)
+        values = whole[len(header):]
+        self._views = {'q': values.cast('q'), 'd': values.cast('d')}
+        self._buffers = [whole, values] + list(self._views.values()) # released on close
+        self._access = {key: (self._views[code], self._slots[key]) for key, (code, _) in self.fields.items()}
 
+    def _header(self):
+        names = json.dumps([[key, code] for key, (code, _) in self.fields.items()]).encode("utf-8")
+        header = _MAPPED_MAGIC + struct.pack("<I", len(names)) + names
+        return header + b"\n"*(-len(header) % 8) # 8 byte aligned slots
+
+    def _initial_values(self, old):
+        " Slot values for a new file, carried over from the old one where possible "
+        previous = {}
+        if old is not None and old.startswith(_MAPPED_MAGIC):
+            try:
+                n = struct.unpack_from("<I", old, len(_MAPPED_MAGIC))[0]
+                start = len(_MAPPED_MAGIC) + 4
+                fields = json.loads(old[start:start+n])
+                offset = start + n + (-(start + n) % 8)
+                for i, (key, code) in enumerate(fields):
+                    previous[key] = (code, struct.unpack_from("<"+code, old, offset + 8*i)[0])
+            except (ValueError, struct.error):
+                previous = {}
+        data = bytearray()
+        for key, (code, default) in self.fields.items():
+            value = previous[key][1] if key in previous and previous[key][0] == code else default
+            data += struct.pack("<"+code, value)
+        return bytes(data)
+
+    def __getitem__(self, key):
+        view, i = self._access[key]
+        return view[i]
+
+    def __setitem__(self, key, value):
+        view, i = self._access[key]
+        view[i] = value
+
+    def __contains__(self, key):
+        return key in self._access
+
+    def keys(self):
+        return self.fields.keys()
+
+    @contextmanager
+    def locked(self, key=None):
+        """ Holds key's slot (the whole file for None) against other
+        processes, objects and threads using these locks """
+        with self._thread_lock:
+            if fcntl is None:
+                yield self
+                return
+            start, length = (0, 0) if key is None else (self._offset + 8*self._slots[key], 8)
+            _lock_range(self._file, True, start, length)
+            try:
+                yield self
+            finally:
+                _lock_range(self._file, False, start, length)
+
+    def add(self, key, delta=1):
+        " Adds delta to key, atomically across processes; returns the new value "
+        view, i = self._access[key]
+        with self.locked(key):
+            view[i] += delta
+            return view[i]
+
+    def compare_and_swap(self, key, expected, value):
+        " Sets key to value if it still holds expected; returns whether it did "
+        view, i = self._access[key]
+        with self.locked(key):
+            if view[i] != expected:
+                return False
+            view[i] = value
+            return True
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            for buffer in reversed(self._buffers):
+                buffer.release()
+            self._views = self._access = self._buffers = None
+            self._map.close()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.close()
+
+
+class SharedCounter():
+    """ A FileGlobalInt that several processes can use at once: datum reads
+    straight from a shared mapping, increment() can't lose updates """
+    def __init__(self, name, default=0):
+        self.name = name
+        self._globals = MappedFileGlobals(name, {"datum": int(default)})
+
+    @property
+    def datum(self):
+        return self._globals["datum"]
+
+    @datum.setter
+    def datum(self, value):
+        with self._globals.locked("datum"):
+            self._globals["datum"] = value
+
+    def increment(self, delta=1):
+        return self._globals.add("datum", delta)
+
+    def close(self):
+        self._globals.close()
+
+
+def _count_up(name, n):
+    counter = SharedCounter(name)
+    for i in range(n):
+        counter.increment()
+    counter.close()
+
+def _count_up_slowly(name, n):
+    """ Increments with a read, a pause and a write, to make any gap in
+    the locking lose updates """
+    counter = SharedCounter(name)
+    for i in range(n):
+        with counter._globals.locked("datum"):
+            value = counter.datum
+            time.sleep(0.0002)
+            counter._globals["datum"] = value + 1
+    counter.close()
 
 def test_integer():
     x = FileGlobalInt("test_file_global_integer.txt")
@@ -33,5 +375,97 @@ def test_integer():
     x.datum=0
     print("%d"%x.datum)
 
+def test_write_behind():
+    import tempfile
+    folder = tempfile.mkdtemp()
+    name = os.path.join(folder, "trials.txt")
+    x = FileGlobalInt(name, default=7, write_behind=True)
+    for i in range(1000):
+        x.datum += 1
+    assert(open(name).read() == "7") # not written yet
+    time.sleep(2*FLUSH_INTERVAL)
+    assert(open(name).read() == "1007" and FileGlobalInt(name).datum == 1007)
+    name = os.path.join(folder, "store.json")
+    with FileGlobalStore(name, {"trials": 0, "gains": [1.0, 0.1]}) as store:
+        store["trials"] += 1
+        store["subject"] = {"id": "AB01", "mass": 71.5}
+    store = FileGlobalStore(name, {"trials": 0, "speed": 1.2})
+    assert(store["trials"] == 1 and store["gains"] == [1.0, 0.1] and store["subject"]["mass"] == 71.5 and store["speed"] == 1.2)
+    assert(sorted(os.listdir(folder)) == ["store.json", "trials.txt"]) # no temp files left
+    name = os.path.join(folder, "mapped.bin")
+    with MappedFileGlobals(name, {"trials": 0, "last_speed": 0.0}) as mapped:
+        mapped["trials"] += 3
+        mapped["last_speed"] = 1.25
+    with MappedFileGlobals(name, {"trials": 0, "last_speed": 0.0, "falls": 0}) as mapped:
+        assert(mapped["trials"] == 3 and mapped["last_speed"] == 1.25 and mapped["falls"] == 0)
+
+def test_write_behind_errors():
+    import shutil
+    import tempfile
+    folder = tempfile.mkdtemp()
+    name = os.path.join(folder, "trials.txt")
+    x = FileGlobalInt(name, write_behind=True)
+    shutil.rmtree(folder) # e.g. a removed USB stick
+    errors = _write_behind.errors
+    x.datum = 3
+    time.sleep(2*FLUSH_INTERVAL)
+    assert(_write_behind.errors > errors and isinstance(_write_behind.last_error, OSError))
+    os.mkdir(folder) # it comes back: the value is retried, and later values still get written
+    time.sleep(2*FLUSH_INTERVAL)
+    assert(open(name).read() == "3")
+    x.datum = 4
+    time.sleep(2*FLUSH_INTERVAL)
+    assert(open(name).read() == "4" and os.listdir(folder) == ["trials.txt"])
+    shutil.rmtree(folder)
+
+def test_shared_counter():
+    import tempfile
+    import multiprocessing
+    name = os.path.join(tempfile.mkdtemp(), "trial_counter.bin")
+    counter = SharedCounter(name, default=100)
+    workers = [multiprocessing.Process(target=_count_up, args=(name, 2000)) for i in range(4)]
+    for worker in workers:
+        worker.start()
+    threads = [threading.Thread(target=_count_up, args=(name, 500)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for i in range(1000):
+        counter.increment()
+    for worker in workers + threads:
+        worker.join()
+    assert(counter.datum == 100 + 4*2000 + 2*500 + 1000)
+    counter.datum = 5
+    other = SharedCounter(name)
+    assert(other.datum == 5 and counter._globals.compare_and_swap("datum", 5, 6))
+    assert(not other._globals.compare_and_swap("datum", 5, 7) and other.datum == 6)
+    other.close()
+    counter.close()
+
+def test_locks_between_objects():
+    import tempfile
+    name = os.path.join(tempfile.mkdtemp(), "trial_counter.bin")
+    counter = SharedCounter(name)
+    threads = [threading.Thread(target=_count_up_slowly, args=(name, 200)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(counter.datum == 800)
+    # the whole file excludes single fields, also between objects of one process
+    other = SharedCounter(name)
+    with counter._globals.locked():
+        thread = threading.Thread(target=other.increment)
+        thread.start()
+        thread.join(0.1)
+        assert(thread.is_alive() and counter.datum == 800)
+    thread.join()
+    assert(counter.datum == 801)
+    other.close()
+    counter.close()
+
 if __name__ == '__main__':
     test_integer()
+    test_write_behind()
+    test_write_behind_errors()
+    test_shared_counter()
+    test_locks_between_objects()
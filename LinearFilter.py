@@ -181,3 +181,107 @@ def DiscreteBiQuad(ωn,ζn, ωd,ζd, dt):
 	sys.Cd = sys.C
 	sys.Dd = sys.D
 	return sys
+
+
+class KinematicKalmanFilter():
+
+	""" A constant-acceleration Kalman filter for a single angle, driven by
+	the actual sample timestamps rather than a fixed time step.
+
+	The state is (position, velocity, acceleration), the process noise is
+	white jerk and the measurement is position only. The 3x3 covariance is
+	kept as six scalars and the predict/correct equations are unrolled, so
+	each update is a fixed number of float operations and allocates no
+	arrays. It is the variable-dt counterpart of running a triple integrator
+	LinearFilter through a steady-state observer.
+	"""
+
+	def __init__(self, jerk_noise, measurement_noise, x0=0.0, v0=0.0, a0=0.0,
+			p0=(1.0, 1e2, 1e4)):
+		"""Summary
+
+		Args:
+			jerk_noise (float): white jerk power spectral density, (units/s^3)^2/Hz
+			measurement_noise (float): position measurement variance, units^2
+			x0, v0, a0 (float, optional): initial position, velocity, acceleration
+			p0 (tuple, optional): initial variances of the three states
+		"""
+		self.q = jerk_noise
+		self.r = measurement_noise
+		self.reset(x0, v0, a0, p0)
+
+	def reset(self, x0=0.0, v0=0.0, a0=0.0, p0=(1.0, 1e2, 1e4)):
+		self.pos, self.vel, self.acc = x0, v0, a0
+		self._p00, self._p11, self._p22 = p0
+		self._p01 = self._p02 = self._p12 = 0.0
+		self.t = None
+
+	def predict(self, dt):
+		""" Propagates the state and covariance forward by dt seconds. """
+		a, b = dt, 0.5*dt*dt
+		p00, p01, p02 = self._p00, self._p01, self._p02
+		p11, p12, p22 = self._p11, self._p12, self._p22
+
+		self.pos += a*self.vel + b*self.acc
+		self.vel += a*self.acc
+
+		# F P F^T, with F = [[1, a, b], [0, 1, a], [0, 0, 1]]
+		r00 = p00 + a*p01 + b*p02
+		r01 = p01 + a*p11 + b*p12
+		r02 = p02 + a*p12 + b*p22
+		r11 = p11 + a*p12
+		r12 = p12 + a*p22
+
+		# + Q for continuous white jerk
+		q = self.q
+		dt2 = dt*dt
+		dt3 = dt2*dt
+		self._p00 = r00 + a*r01 + b*r02 + q*dt3*dt2/20.
+		self._p01 = r01 + a*r02 + q*dt2*dt2/8.
+		self._p02 = r02 + q*dt3/6.
+		self._p11 = r11 + a*r12 + q*dt3/3.
+		self._p12 = r12 + q*dt2/2.
+		self._p22 = p22 + q*dt
+
+	def correct(self, z):
+		""" Fuses one position measurement. """
+		n00, n01, n02 = self._p00, self._p01, self._p02
+		s = n00 + self.r
+		k0, k1, k2 = n00/s, n01/s, n02/s
+		innovation = z - self.pos
+		self.pos += k0*innovation
+		self.vel += k1*innovation
+		self.acc += k2*innovation
+		self._p00 = n00 - k0*n00
+		self._p01 = n01 - k0*n01
+		self._p02 = n02 - k0*n02
+		self._p11 -= k1*n01
+		self._p12 -= k1*n02
+		self._p22 -= k2*n02
+
+	def update(self, z, t):
+		""" Predicts to time t (seconds) and corrects with measurement z.
+		Samples that do not advance the clock are ignored, so re-reading a
+		stale device packet does not corrupt the derivative estimates.
+		"""
+		if self.t is None:
+			self.pos, self.t = z, t
+			return self.pos, self.vel, self.acc
+		dt = t - self.t
+		if dt <= 0.0:
+			return self.pos, self.vel, self.acc
+		self.t = t
+		self.predict(dt)
+		self.correct(z)
+		return self.pos, self.vel, self.acc
+
+
+def test_kinematic_kalman_filter():
+	kf = KinematicKalmanFilter(jerk_noise=1e3, measurement_noise=1e-8)
+	ω, res = 2*np.pi*1.0, 2*np.pi/2**14
+	for i in range(2000):
+		t = i*1e-3 + 2e-4*(i%3) # jittery timestamps
+		z = round(np.sin(ω*t)/res)*res # quantized like the ankle encoder
+		kf.update(z, t)
+	assert(abs(kf.vel - ω*np.cos(ω*t)) < 0.05*ω)
+	assert(abs(kf.acc + ω**2*np.sin(ω*t)) < 0.2*ω**2)
@@ -0,0 +1,183 @@
+"""
+Link statistics for the synch transports (UdpBinarySynch, ZmqBinarySynch).
+
+A LinkStats object is fed the sequence numbers, echoes and timestamps of the
+messages on one link and keeps running counts of loss, reordering,
+duplicates and peer restarts, plus windows of recent round-trip times and
+one-way delay estimates. Everything is O(1) per message. Percentiles and exports are
+computed only when asked for.
+"""
+
+import json
+import numpy as np
+
+_SEQ_MODULUS = 1 << 32
+_MASK_BITS = 64 # reorder window: older sequence numbers mean the peer restarted
+
+def _seq_diff(a, b):
+    " a - b for 32-bit wrapping sequence numbers, in [-2**31, 2**31) "
+    return (a - b + (1 << 31)) % _SEQ_MODULUS - (1 << 31)
+
+
+class LinkStats():
+    def __init__(self, name, window=4096):
+        self.name = name
+        self.window = window
+        self._send_seq = np.full((window,), -1, dtype=np.int64)
+        self._send_time = np.zeros((window,))
+        self.rtt = np.full((window,), np.nan) # seconds, most recent `window` samples
+        self.one_way = np.full((window,), np.nan) # (rtt - peer hold time)/2, seconds
+        self.n_rtt = 0
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.sent = 0
+        self.received = 0 # unique messages from the peer
+        self.lost = 0 # sequence numbers skipped and not (yet) seen late
+        self.reordered = 0 # arrived after a newer message
+        self.duplicates = 0
+        self.resets = 0 # peer restarts, seen as a jump back past the reorder window
+        self.superseded = 0 # valid data messages the drain loop discarded for a newer one
+        self.rejected = 0 # messages that failed validation
+        self._max_seq = None
+        self._seen_mask = 0
+        self._last_echo = None
+
+    ## Hot path
+
+    def on_send(self, seq, t):
+        i = seq % self.window
+        self._send_seq[i] = seq
+        self._send_time[i] = t
+        self.sent += 1
+
+    def on_receive(self, seq, echo, hold, t_recv):
+        """ seq and echo from the peer's header, hold is how long the peer
+        held the echoed message before replying, t_recv is the local arrival
+        time on the same clock passed to on_send """
+        if self._max_seq is None:
+            self._max_seq, self._seen_mask = seq, 1
+            self.received += 1
+        else:
+            d = _seq_diff(seq, self._max_seq)
+            if d > 0:
+                self.lost += d - 1
+                self._seen_mask = ((self._seen_mask << d) | 1) & ((1 << _MASK_BITS) - 1) if d < _MASK_BITS else 1
+                self._max_seq = seq
+                self.received += 1
+            elif d == 0:
+                self.duplicates += 1
+            elif -d >= _MASK_BITS: # the peer started counting over
+                self._max_seq, self._seen_mask = seq, 1
+                self.resets += 1
+                self.received += 1
+            elif self._seen_mask & (1 << -d):
+                self.duplicates += 1
+            else:
+                self._seen_mask |= 1 << -d
+                self.reordered += 1
+                if self.lost > 0: # not counted lost if older than the first message
+                    self.lost -= 1
+                self.received += 1
+
+        if echo != self._last_echo:
+            self._last_echo = echo
+            i = echo % self.window
+            if self._send_seq[i] == echo:
+                rtt = t_recv - self._send_time[i]
+                j = self.n_rtt % self.window
+                self.rtt[j] = rtt
+                self.one_way[j] = 0.5*(rtt - hold)
+                self.n_rtt += 1
+
+    def sent_at(self, seq):
+        " Local send time of our message seq, or None if it left the window "
+        i = seq % self.window
+        return self._send_time[i] if self._send_seq[i] == seq else None
+
+    def on_drain(self, n_data):
+        if n_data > 1:
+            self.superseded += n_data - 1
+
+    ## Queries
+
+    def rtt_percentiles(self, percentiles=(50, 90, 99, 99.9)):
+        " Round-trip time percentiles in seconds over the recent window "
+        samples = self.rtt[:min(self.n_rtt, self.window)]
+        if len(samples) == 0:
+            return {p: float('nan') for p in percentiles}
+        return dict(zip(percentiles, np.percentile(samples, percentiles)))
+
+    def loss_ratio(self):
+        total = self.received + self.lost
+        return self.lost/total if total > 0 else 0.0
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        n = min(self.n_rtt, self.window)
+        one_way = self.one_way[:n]
+        return dict(name=self.name, sent=self.sent, received=self.received,
+            lost=self.lost, loss_ratio=self.loss_ratio(), reordered=self.reordered,
+            duplicates=self.duplicates, resets=self.resets, superseded=self.superseded,
+            rejected=self.rejected,
+            rtt_samples=self.n_rtt,
+            rtt_ms={str(p): v*1e3 for p, v in self.rtt_percentiles(percentiles).items()},
+            rtt_min_ms=float(np.min(self.rtt[:n]))*1e3 if n else float('nan'),
+            one_way_ms=float(np.median(one_way))*1e3 if n else float('nan'))
+
+    def report(self):
+        s = self.summary()
+        print("LinkStats %s: sent %d, received %d, lost %d (%.2f%%), reordered %d, duplicates %d, resets %d, superseded %d, rejected %d"%(
+            s['name'], s['sent'], s['received'], s['lost'], 100*s['loss_ratio'],
+            s['reordered'], s['duplicates'], s['resets'], s['superseded'], s['rejected']))
+        print("\tRTT ms: min %.3f, "%s['rtt_min_ms'] + ", ".join(
+            "p%s %.3f"%(p, v) for p, v in s['rtt_ms'].items()) + ", one-way ~%.3f"%s['one_way_ms'])
+
+    def to_json(self):
+        return json.dumps(self.summary())
+
+    def export(self, file_name):
+        """ Writes the summary plus the raw recent RTT and one-way samples,
+        oldest first, as JSON """
+        n = min(self.n_rtt, self.window)
+        order = (np.arange(n) + (self.n_rtt - n)) % self.window
+        with open(file_name, 'w') as fd:
+            json.dump(dict(summary=self.summary(), rtt_s=self.rtt[order].tolist(),
+                one_way_s=self.one_way[order].tolist()), fd)
+
+
+def test_link_stats():
+    stats = LinkStats("test", window=16)
+    for seq in range(1, 11):
+        stats.on_send(seq, 0.1*seq)
+    # the peer receives our 1..10, echoes them back with 2 ms of hold time
+    for seq, echo in [(1, 1), (2, 2), (4, 3), (3, 4), (3, 4), (6, 5), (7, 6)]:
+        stats.on_receive(seq, echo, 0.002, 0.1*echo + 0.012)
+    stats.on_drain(3)
+    assert((stats.received, stats.lost, stats.reordered, stats.duplicates) == (6, 1, 1, 1))
+    assert(stats.superseded == 2 and stats.n_rtt == 6)
+    assert(abs(stats.rtt_percentiles((50,))[50] - 0.012) < 1e-9)
+    assert(abs(stats.summary()['one_way_ms'] - 5.0) < 1e-6)
+    # sequence numbers wrap at 2**32
+    stats.reset_counts()
+    stats.on_receive(_SEQ_MODULUS-1, 0, 0.0, 0.0)
+    stats.on_receive(1, 0, 0.0, 0.0)
+    assert(stats.lost == 1 and stats.received == 2)
+    # a message older than the first one is not a recovered loss
+    stats.reset_counts()
+    stats.on_receive(10, 0, 0.0, 0.0)
+    stats.on_receive(9, 0, 0.0, 0.0)
+    assert((stats.lost, stats.reordered, stats.received) == (0, 1, 2))
+
+def test_peer_restart():
+    stats = LinkStats("restart")
+    for seq in list(range(1, 5001)) + list(range(1, 1001)): # the peer restarts at 5000
+        stats.on_receive(seq, 0, 0.0, 0.0)
+    assert((stats.lost, stats.resets, stats.reordered, stats.duplicates) == (0, 1, 0, 0))
+    assert(stats.received == 6000 and stats.loss_ratio() == 0.0)
+    stats.on_receive(1002, 0, 0.0, 0.0) # counting resumes from the new sequence
+    stats.on_receive(1001, 0, 0.0, 0.0)
+    assert((stats.lost, stats.reordered) == (0, 1))
+
+if __name__ == '__main__':
+    test_link_stats()
+    test_peer_restart()
@@ -1,13 +1,15 @@
 from GrayDemoCommon import *
+from SensorConversion import SensorConversion, FUTEK_100NM
 
 
 # Offers conversions to output torque and position
 class Big100NmFutek(ADC):
     def __init__(self, csv_file_name=None):
         super().__init__(csv_file_name=csv_file_name)
+        self.torque = SensorConversion.from_spec(FUTEK_100NM)
 
     def get_torque(self):
-        return (self.volts-2.5)*40.
+        return self.torque(self.volts)
 
 class Small50to1ActPack(ActPacMan):
     def __init__(self, devttyACMport, baudRate, csv_file_name=None,
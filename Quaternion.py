@@ -0,0 +1,206 @@
+"""
+Unit quaternion helpers for orientation tracking.
+
+Quaternions are (w, x, y, z) with the Hamilton convention, and
+quat_to_matrix(q) is the rotation matrix R that the quaternion stands for,
+so quat_multiply(a, b) corresponds to Ra @ Rb and quat_relative(q, q0) to
+R @ R0.T. The scalar functions take and return plain tuples of floats and
+use only the math module, so they allocate no NumPy arrays and are meant for
+per-packet use in the real-time loop. The *_batch functions take (N, 4)
+arrays (or (N, 3, 3) for matrices) and are meant for logs.
+"""
+
+import time
+from math import sqrt, atan2, asin, pi
+import numpy as np
+
+IDENTITY = (1.0, 0.0, 0.0, 0.0)
+
+## Scalar fast paths
+
+def quat_from_matrix(R):
+    """ Quaternion of a 3x3 rotation matrix. R may be a nested list (fastest,
+    e.g. from ndarray.tolist()) or anything indexable as R[i][j]. """
+    (r00, r01, r02), (r10, r11, r12), (r20, r21, r22) = R
+    tr = r00+r11+r22
+    if tr > 0:
+        s = 2*sqrt(tr+1.0)
+        return 0.25*s, (r21-r12)/s, (r02-r20)/s, (r10-r01)/s
+    if r00 > r11 and r00 > r22:
+        s = 2*sqrt(1.0+r00-r11-r22)
+        return (r21-r12)/s, 0.25*s, (r01+r10)/s, (r02+r20)/s
+    if r11 > r22:
+        s = 2*sqrt(1.0+r11-r00-r22)
+        return (r02-r20)/s, (r01+r10)/s, 0.25*s, (r12+r21)/s
+    s = 2*sqrt(1.0+r22-r00-r11)
+    return (r10-r01)/s, (r02+r20)/s, (r12+r21)/s, 0.25*s
+
+def quat_to_matrix(q):
+    " 3x3 rotation matrix of a unit quaternion, as a NumPy array "
+    w, x, y, z = q
+    return np.array([
+        [1-2*(y*y+z*z), 2*(x*y-w*z), 2*(x*z+w*y)],
+        [2*(x*y+w*z), 1-2*(x*x+z*z), 2*(y*z-w*x)],
+        [2*(x*z-w*y), 2*(y*z+w*x), 1-2*(x*x+y*y)]])
+
+def quat_conjugate(q):
+    w, x, y, z = q
+    return w, -x, -y, -z
+
+def quat_multiply(a, b):
+    " Hamilton product a*b, the rotation b followed by a "
+    aw, ax, ay, az = a
+    bw, bx, by, bz = b
+    return (aw*bw - ax*bx - ay*by - az*bz,
+        aw*bx + ax*bw + ay*bz - az*by,
+        aw*by - ax*bz + ay*bw + az*bx,
+        aw*bz + ax*by - ay*bx + az*bw)
+
+def quat_relative(q, q0):
+    " q * conj(q0), the quaternion of R @ R0.T "
+    aw, ax, ay, az = q
+    bw, bx, by, bz = q0
+    return (aw*bw + ax*bx + ay*by + az*bz,
+        -aw*bx + ax*bw - ay*bz + az*by,
+        -aw*by + ax*bz + ay*bw - az*bx,
+        -aw*bz - ax*by + ay*bx + az*bw)
+
+def quat_rotate(q, v):
+    " R @ v for the rotation R of q, with v a 3-tuple "
+    w, x, y, z = q
+    vx, vy, vz = v
+    # v + 2 w (u x v) + 2 u x (u x v), with u = (x, y, z)
+    tx = 2*(y*vz - z*vy)
+    ty = 2*(z*vx - x*vz)
+    tz = 2*(x*vy - y*vx)
+    return (vx + w*tx + y*tz - z*ty,
+        vy + w*ty + z*tx - x*tz,
+        vz + w*tz + x*ty - y*tx)
+
+def quat_rotate_inverse(q, v):
+    " R.T @ v for the rotation R of q "
+    return quat_rotate(quat_conjugate(q), v)
+
+def quat_to_euler(q):
+    " (roll, pitch, yaw) in radians, for R = Rz(yaw) @ Ry(pitch) @ Rx(roll) "
+    w, x, y, z = q
+    roll = atan2(2*(w*x + y*z), 1 - 2*(x*x + y*y))
+    sp = 2*(w*y - z*x)
+    pitch = asin(1.0 if sp > 1.0 else -1.0 if sp < -1.0 else sp)
+    yaw = atan2(2*(w*z + x*y), 1 - 2*(y*y + z*z))
+    return roll, pitch, yaw
+
+def sagittal_angle(q):
+    " X-Y plane angle in radians, arctan2(R[1,0], R[0,0]) of the rotation of q "
+    w, x, y, z = q
+    return atan2(2*(x*y + w*z), 1 - 2*(y*y + z*z))
+
+## Batch versions, (N, 4) arrays
+
+def quat_from_matrix_batch(R):
+    R = np.asarray(R)
+    q = np.empty(R.shape[:-2]+(4,))
+    r00, r11, r22 = R[...,0,0], R[...,1,1], R[...,2,2]
+    # Choose the largest of 4w^2, 4x^2, 4y^2, 4z^2 per row for stability
+    d = np.stack([1+r00+r11+r22, 1+r00-r11-r22, 1-r00+r11-r22, 1-r00-r11+r22], axis=-1)
+    case = np.argmax(d, axis=-1)
+    s = 2*np.sqrt(np.maximum(np.take_along_axis(d, case[...,np.newaxis], -1)[...,0], 1e-300))
+    w_ = (R[...,2,1]-R[...,1,2], R[...,0,2]-R[...,2,0], R[...,1,0]-R[...,0,1])
+    xy, xz, yz = R[...,0,1]+R[...,1,0], R[...,0,2]+R[...,2,0], R[...,1,2]+R[...,2,1]
+    q[...,0] = np.choose(case, [0.25*s, w_[0]/s, w_[1]/s, w_[2]/s])
+    q[...,1] = np.choose(case, [w_[0]/s, 0.25*s, xy/s, xz/s])
+    q[...,2] = np.choose(case, [w_[1]/s, xy/s, 0.25*s, yz/s])
+    q[...,3] = np.choose(case, [w_[2]/s, xz/s, yz/s, 0.25*s])
+    return q
+
+def quat_to_matrix_batch(q):
+    w, x, y, z = np.moveaxis(np.asarray(q), -1, 0)
+    return np.stack([
+        np.stack([1-2*(y*y+z*z), 2*(x*y-w*z), 2*(x*z+w*y)], axis=-1),
+        np.stack([2*(x*y+w*z), 1-2*(x*x+z*z), 2*(y*z-w*x)], axis=-1),
+        np.stack([2*(x*z-w*y), 2*(y*z+w*x), 1-2*(x*x+y*y)], axis=-1)], axis=-2)
+
+def quat_multiply_batch(a, b):
+    aw, ax, ay, az = np.moveaxis(np.asarray(a), -1, 0)
+    bw, bx, by, bz = np.moveaxis(np.asarray(b), -1, 0)
+    return np.stack([aw*bw - ax*bx - ay*by - az*bz,
+        aw*bx + ax*bw + ay*bz - az*by,
+        aw*by - ax*bz + ay*bw + az*bx,
+        aw*bz + ax*by - ay*bx + az*bw], axis=-1)
+
+def quat_relative_batch(q, q0):
+    return quat_multiply_batch(q, np.asarray(q0)*np.array([1.0, -1.0, -1.0, -1.0]))
+
+def quat_to_euler_batch(q):
+    " (N, 3) array of roll, pitch, yaw "
+    w, x, y, z = np.moveaxis(np.asarray(q), -1, 0)
+    return np.stack([np.arctan2(2*(w*x + y*z), 1 - 2*(x*x + y*y)),
+        np.arcsin(np.clip(2*(w*y - z*x), -1.0, 1.0)),
+        np.arctan2(2*(w*z + x*y), 1 - 2*(y*y + z*z))], axis=-1)
+
+def sagittal_angle_batch(q):
+    w, x, y, z = np.moveaxis(np.asarray(q), -1, 0)
+    return np.arctan2(2*(x*y + w*z), 1 - 2*(y*y + z*z))
+
+
+def _random_rotations(n, seed=0):
+    q = np.random.default_rng(seed).standard_normal((n, 4))
+    q /= np.linalg.norm(q, axis=1)[:,np.newaxis]
+    return q, quat_to_matrix_batch(q)
+
+def test_quaternion():
+    q, R = _random_rotations(200)
+    q0, R0 = tuple(q[0]), R[0]
+    for qi, Ri in zip(q, R):
+        qi = quat_from_matrix(Ri.tolist())
+        assert np.allclose(quat_to_matrix(qi), Ri)
+        rel = quat_relative(qi, q0)
+        Rp = Ri @ R0.T
+        assert np.allclose(quat_to_matrix(rel), Rp)
+        assert np.allclose(quat_to_matrix(quat_multiply(qi, q0)), Ri @ R0)
+        assert abs(sagittal_angle(rel) - np.arctan2(Rp[1,0], Rp[0,0])) < 1e-9
+        assert np.allclose(quat_rotate_inverse(rel, (1.0, 2.0, 3.0)), Rp.T @ [1.0, 2.0, 3.0])
+        roll, pitch, yaw = quat_to_euler(rel)
+        Rx = np.array([[1,0,0],[0,np.cos(roll),-np.sin(roll)],[0,np.sin(roll),np.cos(roll)]])
+        Ry = np.array([[np.cos(pitch),0,np.sin(pitch)],[0,1,0],[-np.sin(pitch),0,np.cos(pitch)]])
+        Rz = np.array([[np.cos(yaw),-np.sin(yaw),0],[np.sin(yaw),np.cos(yaw),0],[0,0,1]])
+        assert np.allclose(Rz @ Ry @ Rx, Rp)
+    qb = quat_from_matrix_batch(R)
+    assert np.allclose(np.abs(np.sum(qb*q, axis=1)), 1.0) # same rotation, up to sign
+    rel = quat_relative_batch(qb, qb[0])
+    assert np.allclose(quat_to_matrix_batch(rel), R @ R0.T)
+    assert np.allclose(sagittal_angle_batch(rel), [sagittal_angle(quat_relative(tuple(a), tuple(qb[0]))) for a in qb])
+    assert np.allclose(quat_to_euler_batch(rel)[5], quat_to_euler(tuple(rel[5])))
+
+def benchmark(n=20000):
+    """ Per-packet cost of tracking the sagittal angle relative to the first
+    orientation, matrix path (as AhrsManager did) vs. quaternion path """
+    q, R = _random_rotations(n, seed=1)
+    rows = [Ri for Ri in R]
+    t0 = time.perf_counter()
+    init_R = None
+    for Ri in rows:
+        R_ = np.array(Ri)
+        if init_R is None:
+            init_R = np.array(R_)
+        R_prime = R_ @ init_R.T
+        angle = np.arctan2(R_prime[1,0], R_prime[0,0])
+    t_matrix = (time.perf_counter()-t0)/n
+    t0 = time.perf_counter()
+    init_q = None
+    for Ri in rows:
+        q_ = quat_from_matrix(Ri.tolist())
+        if init_q is None:
+            init_q = q_
+        angle = sagittal_angle(quat_relative(q_, init_q))
+    t_quat = (time.perf_counter()-t0)/n
+    t0 = time.perf_counter()
+    sagittal_angle_batch(quat_relative_batch(quat_from_matrix_batch(R), quat_from_matrix(R[0].tolist())))
+    t_batch = (time.perf_counter()-t0)/n
+    print("matrix path: %.2f us/packet, quaternion path: %.2f us/packet (%.1fx), batch: %.3f us/packet"%(
+        t_matrix*1e6, t_quat*1e6, t_matrix/t_quat, t_batch*1e6))
+    return t_matrix, t_quat, t_batch
+
+if __name__ == '__main__':
+    test_quaternion()
+    benchmark()
@@ -0,0 +1,164 @@
+"""
+Bounded ring buffers for handing samples from a device reader thread to the
+real-time loop. The writer never blocks on the reader: when the reader falls
+behind by more than the capacity, the oldest items are overwritten and
+counted as dropped.
+"""
+
+import threading
+import numpy as np
+
+
+class TimestampedRing():
+    """ A ring of arbitrary objects, each tagged with a sequence number, a
+    local receive time and a device time (NaN when the device has none).
+    Sequence numbers start at 1 and never wrap, so a reader can ask for
+    everything since the last sequence number it saw. """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self._items = [None]*capacity
+        self.recv_times = np.full((capacity,), np.nan)
+        self.device_times = np.full((capacity,), np.nan)
+        self.seq = 0 # sequence number of the newest item
+        self.dropped = 0 # items overwritten before any reader asked for them
+        self._read_seq = 0
+        self._lock = threading.Lock()
+
+    def push(self, item, recv_time, device_time=float('nan')):
+        with self._lock:
+            i = self.seq % self.capacity
+            self._items[i] = item
+            self.recv_times[i] = recv_time
+            self.device_times[i] = device_time
+            self.seq += 1
+            if self.seq - self._read_seq > self.capacity:
+                self.dropped += 1
+                self._read_seq += 1
+
+    def latest(self):
+        """ Returns (seq, item, recv_time, device_time) for the newest item,
+        or None if nothing was pushed yet """
+        with self._lock:
+            if self.seq == 0:
+                return None
+            i = (self.seq-1) % self.capacity
+            return self.seq, self._items[i], self.recv_times[i], self.device_times[i]
+
+    def since(self, seq):
+        """ Returns (items, recv_times, device_times, newest_seq) for all items
+        newer than seq that are still in the ring, oldest first. Pass the
+        returned newest_seq back in on the next call. """
+        with self._lock:
+            head = self.seq
+            start = max(seq, head - self.capacity)
+            self._read_seq = max(self._read_seq, head)
+            idx = np.arange(start, head) % self.capacity
+            items = [self._items[i] for i in idx]
+            return items, self.recv_times[idx], self.device_times[idx], head
+
+
+class SampleRing():
+    """ A ring of numeric samples, one row of channels values per sample,
+    each with a time. It also keeps running sums, so the latest sample and
+    the mean of the last n samples both cost the same whatever n is. """
+
+    def __init__(self, channels=1, capacity=4096):
+        self.capacity = capacity
+        self.values = np.zeros((capacity, channels))
+        self.times = np.zeros((capacity,))
+        self._sums = np.zeros((capacity, channels)) # running sum up to and including each sample
+        self._total = np.zeros((channels,))
+        self.seq = 0 # number of samples pushed so far
+        self.dropped = 0 # samples overwritten before since() returned them
+        self._read_seq = 0
+        self._lock = threading.Lock()
+
+    def push(self, t, values):
+        with self._lock:
+            i = self.seq % self.capacity
+            self.values[i] = values
+            self._total += self.values[i]
+            self._sums[i] = self._total
+            self.times[i] = t
+            self.seq += 1
+            if self.seq - self._read_seq > self.capacity:
+                self.dropped += 1
+                self._read_seq += 1
+
+    def latest(self):
+        """ Returns (seq, time, values) for the newest sample, or None if
+        nothing was pushed yet """
+        with self._lock:
+            if self.seq == 0:
+                return None
+            i = (self.seq-1) % self.capacity
+            return self.seq, self.times[i], self.values[i].copy()
+
+    def mean(self, n):
+        """ Mean of the last n samples (fewer if there are not that many,
+        at most capacity-1), or None if nothing was pushed yet """
+        with self._lock:
+            n = min(n, self.seq, self.capacity-1)
+            if n <= 0:
+                return None
+            total = self._sums[(self.seq-1) % self.capacity]
+            if self.seq > n:
+                total = total - self._sums[(self.seq-1-n) % self.capacity]
+            return total/n
+
+    def window(self, n, step=1):
+        """ Returns (times, values) of the last n samples, oldest first,
+        keeping every step-th one counting back from the newest """
+        with self._lock:
+            n = min(n, self.seq, self.capacity)
+            idx = np.arange(self.seq-1, self.seq-1-n, -step)[::-1] % self.capacity
+            return self.times[idx], self.values[idx]
+
+    def since(self, seq):
+        """ Returns (times, values, newest_seq) for all samples newer than
+        seq that are still in the ring, oldest first. Pass the returned
+        newest_seq back in on the next call. """
+        with self._lock:
+            head = self.seq
+            start = max(seq, head - self.capacity)
+            self._read_seq = max(self._read_seq, head)
+            idx = np.arange(start, head) % self.capacity
+            return self.times[idx], self.values[idx], head
+
+
+def test_timestamped_ring():
+    ring = TimestampedRing(capacity=4)
+    assert(ring.latest() is None)
+    for i in range(3):
+        ring.push("p%d"%i, 0.1*i, float(i))
+    items, recv, dev, seq = ring.since(0)
+    assert(items == ["p0", "p1", "p2"] and seq == 3 and dev[-1] == 2.0)
+    for i in range(3, 10):
+        ring.push("p%d"%i, 0.1*i)
+    items, recv, dev, seq = ring.since(seq)
+    assert(items == ["p6", "p7", "p8", "p9"] and seq == 10 and ring.dropped == 3)
+    assert(ring.latest()[:2] == (10, "p9"))
+    assert(ring.since(seq)[0] == [])
+
+def test_sample_ring():
+    ring = SampleRing(channels=2, capacity=8)
+    assert(ring.latest() is None and ring.mean(4) is None)
+    for i in range(5):
+        ring.push(0.01*i, (i, -i))
+    seq, t, values = ring.latest()
+    assert(seq == 5 and t == 0.04 and list(values) == [4, -4])
+    assert(list(ring.mean(2)) == [3.5, -3.5] and list(ring.mean(100)) == [2, -2])
+    times, values, seq = ring.since(0)
+    assert(seq == 5 and list(values[:, 0]) == [0, 1, 2, 3, 4])
+    for i in range(5, 20):
+        ring.push(0.01*i, (i, -i))
+    assert(list(ring.mean(3)) == [18, -18] and list(ring.mean(100)) == [16, -16])
+    times, values = ring.window(6, step=2)
+    assert(list(values[:, 0]) == [15, 17, 19] and np.allclose(times, [0.15, 0.17, 0.19]))
+    times, values, seq = ring.since(seq)
+    assert(seq == 20 and list(values[:, 0]) == list(range(12, 20)) and ring.dropped == 7)
+
+if __name__ == '__main__':
+    test_timestamped_ring()
+    test_sample_ring()
@@ -0,0 +1,208 @@
+"""
+A sampling profiler for the real-time loop: every 1/rate seconds it looks at
+the stack of the loop's thread and counts it, without any tic/toc in the
+code. Pass one to SoftRealtimeLoop(profiler=...) and each sample is also put
+under the loop phase it landed in:
+    sleep    waiting for the next tick
+    body     running the loop body, within its time step
+    overrun  still running the body after the next tick was due
+The counts are written as collapsed stacks (one "phase;outer;...;inner count"
+line per stack), the input of flamegraph.pl, speedscope and similar tools.
+
+Samples are taken from a helper thread (sys._current_frames) by default, or
+with use_signal=True from a SIGALRM interval timer, in the main thread only.
+The helper thread needs the GIL to take a sample, and a busy loop body only
+hands it over every switch interval, which would bias the samples toward
+sleep; while sampling, the switch interval is lowered to a quarter period.
+Either way taking a sample stalls the loop for a moment, and the profiler
+measures how long: report() prints the cost per sample and the fraction of
+the run spent sampling, to check it is acceptable during a real trial.
+"""
+
+import os
+import sys
+import signal
+import threading
+import time
+from time import perf_counter_ns
+
+
+class SamplingProfiler():
+    PHASES = ("sleep", "body", "overrun")
+
+    def __init__(self, rate=250.0, file_name=None, use_signal=False, max_depth=64):
+        self.period = 1.0/rate
+        self.file_name = file_name
+        self.use_signal = use_signal
+        self.max_depth = max_depth
+        self.stacks = {} # (phase, frames...) -> samples
+        self.phase_samples = dict.fromkeys(self.PHASES, 0)
+        self.samples = 0
+        self.overhead_ns = 0 # time spent taking samples
+        self.running = False
+        self._names = {} # code object -> frame name
+        self._sleeping = True
+        self._deadline = float('inf')
+        self._thread_id = None
+        self._thread = None
+        self._t_start = self._t_stop = None
+        self._switch_interval = None
+
+    ## Hooks for the loop
+
+    def enter_sleep(self):
+        self._sleeping = True
+
+    def enter_body(self, deadline):
+        " deadline: time.time() at which the body should be done "
+        self._deadline = deadline
+        self._sleeping = False
+
+    ## Sampling
+
+    def start(self):
+        """ Starts sampling the calling thread """
+        if self.running:
+            return self
+        self.running = True
+        self._thread_id = threading.get_ident()
+        self._t_start = time.time()
+        if self.use_signal:
+            signal.signal(signal.SIGALRM, self._on_signal)
+            signal.setitimer(signal.ITIMER_REAL, self.period, self.period)
+        else:
+            self._switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(min(self._switch_interval, self.period/4))
+            self._thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops sampling and writes file_name, if any """
+        if not self.running:
+            return
+        self.running = False
+        if self.use_signal:
+            signal.setitimer(signal.ITIMER_REAL, 0, 0)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        else:
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            sys.setswitchinterval(self._switch_interval)
+        self._t_stop = time.time()
+        if self.file_name is not None:
+            self.write(self.file_name)
+
+    def _on_signal(self, signum, frame):
+        self._sample(frame)
+
+    def _run(self):
+        next_sample = time.time()
+        while self.running:
+            next_sample += self.period
+            wait = next_sample - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                next_sample = time.time()
+            frame = sys._current_frames().get(self._thread_id) # pylint: disable=protected-access
+            if frame is None:
+                break # the loop's thread is gone
+            self._sample(frame)
+
+    def _sample(self, frame):
+        t0 = perf_counter_ns()
+        if self._sleeping:
+            phase = "sleep"
+        elif time.time() > self._deadline:
+            phase = "overrun"
+        else:
+            phase = "body"
+        names = self._names
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            name = names.get(code)
+            if name is None:
+                name = names[code] = "%s (%s:%d)"%(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            stack.append(name)
+            frame = frame.f_back
+        stack.append(phase)
+        key = tuple(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.phase_samples[phase] += 1
+        self.samples += 1
+        self.overhead_ns += perf_counter_ns() - t0
+
+    ## Results
+
+    def collapsed(self):
+        """ The samples as collapsed stack lines, most frequent first """
+        return ["%s %d"%(";".join(name.replace(";", ",") for name in stack), count)
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1])]
+
+    def write(self, file_name):
+        with open(file_name, 'w') as fil:
+            fil.write("\n".join(self.collapsed()) + "\n")
+
+    def duration(self):
+        if self._t_start is None:
+            return 0.0
+        return (self._t_stop if self._t_stop is not None else time.time()) - self._t_start
+
+    def overhead(self):
+        """ (seconds per sample, fraction of the run spent sampling) """
+        if self.samples == 0:
+            return float('nan'), 0.0
+        duration = self.duration()
+        return self.overhead_ns*1e-9/self.samples, self.overhead_ns*1e-9/duration if duration > 0 else float('nan')
+
+    def report(self):
+        per_sample, fraction = self.overhead()
+        print("SamplingProfiler: %d samples over %.1f s (%s), %.1f us per sample, %.3f %% of the run spent sampling"%(
+            self.samples, self.duration(), "SIGALRM" if self.use_signal else "thread", per_sample*1e6, fraction*100))
+        if self.samples:
+            print("\t" + ", ".join("%s %.1f %%"%(phase, 100.0*self.phase_samples[phase]/self.samples) for phase in self.PHASES))
+        if self.file_name is not None:
+            print("\tcollapsed stacks in %s"%self.file_name)
+
+
+def _busy(seconds):
+    t_end = time.time() + seconds
+    while time.time() < t_end:
+        pass
+
+def test_sampling_profiler():
+    import tempfile
+    from SoftRealtimeLoop import SoftRealtimeLoop
+    switch_interval = sys.getswitchinterval()
+    for use_signal in (False, True):
+        with tempfile.TemporaryDirectory() as folder:
+            file_name = os.path.join(folder, "loop.collapsed")
+            profiler = SamplingProfiler(rate=1000.0, file_name=file_name, use_signal=use_signal)
+            loop = SoftRealtimeLoop(dt=0.01, profiler=profiler)
+            for i, t in enumerate(loop):
+                _busy(0.015 if i % 4 == 3 else 0.004) # every 4th tick overruns
+                if i == 40:
+                    loop.stop()
+            assert(not profiler.running and profiler.samples > 200)
+            shares = {phase: profiler.phase_samples[phase]/profiler.samples for phase in profiler.PHASES}
+            assert(all(share > 0.1 for share in shares.values())), shares
+            with open(file_name) as fil:
+                lines = fil.read().splitlines()
+            assert(any(line.startswith("body;") and "_busy (SamplingProfiler.py" in line for line in lines))
+            assert(sum(int(line.rsplit(" ", 1)[1]) for line in lines) == profiler.samples)
+            per_sample, fraction = profiler.overhead()
+            assert(per_sample < 1e-3 and fraction < 0.1)
+        # breaking out of the loop stops sampling right away
+        profiler = SamplingProfiler(rate=1000.0, use_signal=use_signal)
+        loop = SoftRealtimeLoop(dt=0.01, profiler=profiler)
+        for i, t in enumerate(loop):
+            if i == 3:
+                break
+        assert(not profiler.running and sys.getswitchinterval() == switch_interval)
+        if use_signal:
+            assert(signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0))
+
+if __name__ == '__main__':
+    test_sampling_profiler()
@@ -0,0 +1,232 @@
+"""
+Declarative sensor conversions: a calibration is a list of stages, e.g.
+
+    FUTEK_100NM = [("offset", -2.5), ("gain", 40.0), ("zero",)]
+
+and SensorConversion.from_spec(FUTEK_100NM) gives a converter with two
+paths built from the same definition:
+    conversion(volts)         one sample, in the real-time loop; plain float
+                              math, no numpy temporaries
+    conversion.apply(array)   a whole recording at once, vectorized
+Stateful stages (filters) keep their state on the scalar path only; apply()
+always starts them at steady state on the first sample. zero(baseline) sets the
+"zero" stage so a recorded baseline window converts to 0 on average.
+"""
+
+from bisect import bisect_right
+from math import exp, pi
+import numpy as np
+
+
+class Offset():
+    def __init__(self, offset):
+        self.offset = float(offset)
+
+    def scalar(self, x):
+        return x + self.offset
+
+    def array(self, x):
+        return x + self.offset
+
+
+class Gain():
+    def __init__(self, gain):
+        self.gain = float(gain)
+
+    def scalar(self, x):
+        return x*self.gain
+
+    def array(self, x):
+        return x*self.gain
+
+
+class Polynomial():
+    " coefficients highest power first, like np.polyval "
+    def __init__(self, coefficients):
+        self.coefficients = [float(c) for c in coefficients]
+
+    def scalar(self, x):
+        y = 0.0
+        for c in self.coefficients:
+            y = y*x + c
+        return y
+
+    def array(self, x):
+        return np.polyval(self.coefficients, x)
+
+
+class LookupTable():
+    " Piecewise linear through (x, y), held constant past the ends like np.interp "
+    def __init__(self, x, y):
+        self.x = [float(v) for v in x]
+        self.y = [float(v) for v in y]
+        if len(self.x) != len(self.y) or len(self.x) < 2 or any(np.diff(self.x) <= 0):
+            raise ValueError("a lookup table needs at least 2 points with increasing x")
+
+    def scalar(self, x):
+        xs, ys = self.x, self.y
+        i = bisect_right(xs, x)
+        if i == 0:
+            return ys[0]
+        if i == len(xs):
+            return ys[-1]
+        x0, x1 = xs[i-1], xs[i]
+        return ys[i-1] + (ys[i] - ys[i-1])*(x - x0)/(x1 - x0)
+
+    def array(self, x):
+        return np.interp(x, self.x, self.y)
+
+
+class Filter():
+    """ IIR filter b(z)/a(z), direct form II transposed. It starts at steady
+    state on its first sample, so a sensor sitting at a nonzero value does
+    not ring up from zero. """
+    def __init__(self, b, a=(1.0,)):
+        a0 = float(a[0])
+        n = max(len(a), len(b))
+        self.b = [float(v)/a0 for v in b] + [0.0]*(n - len(b))
+        self.a = [float(v)/a0 for v in a] + [0.0]*(n - len(a))
+        self.reset()
+
+    @classmethod
+    def lowpass(cls, cutoff, rate):
+        " First order low pass at cutoff Hz for samples at rate Hz "
+        pole = exp(-2*pi*cutoff/rate)
+        return cls([1.0 - pole], [1.0, -pole])
+
+    def reset(self):
+        self.z = None
+
+    def _steady_state(self, x):
+        b, a = self.b, self.a
+        y = x*sum(b)/sum(a)
+        z = [0.0]*(len(b) - 1)
+        acc = 0.0
+        for i in range(len(z) - 1, -1, -1):
+            acc += b[i+1]*x - a[i+1]*y
+            z[i] = acc
+        return z
+
+    def scalar(self, x):
+        z = self.z
+        if z is None:
+            z = self.z = self._steady_state(x)
+        b, a = self.b, self.a
+        y = b[0]*x + (z[0] if z else 0.0)
+        for i in range(len(z)):
+            z[i] = b[i+1]*x - a[i+1]*y + (z[i+1] if i+1 < len(z) else 0.0)
+        return y
+
+    def array(self, x):
+        x = np.asarray(x, dtype=float)
+        if len(x) == 0 or len(self.b) == 1:
+            return x*self.b[0]
+        zi = np.array(self._steady_state(float(x[0])))
+        try:
+            from scipy.signal import lfilter
+        except ImportError: # plain Python, one sample at a time
+            saved, self.z = self.z, list(zi)
+            y = np.array([self.scalar(v) for v in x])
+            self.z = saved
+            return y
+        return lfilter(self.b, self.a, x, zi=zi)[0]
+
+
+class AutoZero(Offset):
+    " An offset set by SensorConversion.zero, 0 until then "
+    def __init__(self, offset=0.0):
+        super().__init__(offset)
+
+
+_STAGES = {"offset": Offset, "gain": Gain, "poly": Polynomial, "table": LookupTable,
+    "filter": Filter, "lowpass": Filter.lowpass, "zero": AutoZero}
+
+class SensorConversion():
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self._scalars = [stage.scalar for stage in self.stages]
+
+    @classmethod
+    def from_spec(cls, spec):
+        """ spec is a list of (kind, *args) with kind one of offset, gain,
+        poly, table, filter (b, a), lowpass (cutoff, rate) and zero """
+        stages = []
+        for kind, *args in spec:
+            if kind not in _STAGES:
+                raise ValueError("unknown conversion stage %r, expected one of %s"%(kind, sorted(_STAGES)))
+            stages.append(_STAGES[kind](*args))
+        return cls(stages)
+
+    def __call__(self, x):
+        for scalar in self._scalars:
+            x = scalar(x)
+        return x
+
+    def apply(self, x, stages=None):
+        " Converts a whole array of raw samples "
+        y = np.asarray(x, dtype=float)
+        for stage in self.stages if stages is None else stages:
+            y = stage.array(y)
+        return y
+
+    def reset(self):
+        " Forgets the filter states of the scalar path "
+        for stage in self.stages:
+            if isinstance(stage, Filter):
+                stage.reset()
+
+    def zero(self, baseline, target=0.0):
+        """ Sets the AutoZero stage so the raw baseline samples (e.g. a
+        recorded window of the unloaded sensor) convert to target on
+        average. Returns the offset. """
+        for i, stage in enumerate(self.stages):
+            if isinstance(stage, AutoZero):
+                level = float(self.apply(baseline, self.stages[:i]).mean())
+                stage.offset = self._solve_offset(level, self.stages[i+1:], target)
+                return stage.offset
+        raise ValueError("this conversion has no zero stage")
+
+    def _solve_offset(self, level, stages, target):
+        " The offset making `stages` map level+offset to target "
+        if not stages:
+            return target - level
+        f = lambda offset: self.apply(np.array([level + offset]), stages)[0] - target
+        offset, step = -level, 1.0
+        for i in range(50): # secant iterations, exact in one step for linear stages
+            f0, f1 = f(offset), f(offset + step)
+            if f1 == f0:
+                break
+            step = -f0*step/(f1 - f0)
+            offset += step
+            if abs(step) < 1e-12*max(1.0, abs(offset)):
+                break
+        return offset
+
+
+# Calibrations
+FUTEK_100NM = [("offset", -2.5), ("gain", 40.0), ("zero",)] # Nm from volts, 100 Nm Futek on the ADS1115
+
+
+def test_sensor_conversion():
+    torque = SensorConversion.from_spec(FUTEK_100NM)
+    volts = np.linspace(0.0, 5.0, 11)
+    assert(torque(3.0) == 20.0 and np.array_equal(torque.apply(volts), (volts - 2.5)*40.0))
+    assert(abs(torque.zero(np.full(100, 2.51)) + 0.4) < 1e-12 and abs(torque(2.51)) < 1e-12)
+    poly = SensorConversion.from_spec([("poly", [0.5, -1.0, 2.0]), ("table", [0.0, 1.0, 10.0], [0.0, 10.0, 20.0])])
+    x = np.linspace(-2.0, 6.0, 33)
+    assert(np.allclose([poly(v) for v in x], poly.apply(x)))
+    assert(abs(poly(0.0) - (10.0 + 10.0/9)) < 1e-12 and poly(-20.0) == 20.0)
+    filtered = SensorConversion.from_spec([("gain", 2.0), ("lowpass", 10.0, 1000.0), ("zero",)])
+    x = 1.0 + 0.1*np.sin(np.arange(2000)*0.3)
+    online = [filtered(v) for v in x]
+    assert(np.allclose(online, filtered.apply(x)) and abs(online[0] - 2.0) < 1e-12)
+    filtered.zero(x[-500:])
+    assert(abs(filtered.apply(x[-500:]).mean()) < 1e-3)
+    try:
+        SensorConversion.from_spec([("scale", 2.0)])
+        assert(False)
+    except ValueError:
+        pass
+
+if __name__ == '__main__':
+    test_sensor_conversion()
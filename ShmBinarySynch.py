@@ -0,0 +1,258 @@
+"""
+Objects for passing data between two real-time loops on the same host,
+through shared memory instead of sockets. Same update(data_in) -> data_out
+interface as UdpBinarySynchA/B, and the same drain() and send_data()
+halves for loops that read and write at different points.
+
+One SharedMemory segment holds two one-way channels, A->B and B->A. Each
+channel is a seqlock-protected double buffer:
+
+    seq      uint32, odd while a write is in progress
+    nbytes   uint32 x 2, payload size of each slot
+    pid      uint32, process id of the writer
+    slot     buff_size bytes x 2
+
+Write number n goes to slot n%2, so the reader can copy the newest complete
+slot while the writer fills the other one. The reader retries only if the
+writer has lapped it, i.e. started writing into the slot being copied.
+Neither side ever blocks the other.
+
+The side that creates the segment unlinks it on close(), and at exit or on
+garbage collection if close() was never called. A segment left behind by a
+crash is reused: each side clears its send channel when it starts, and if
+the channel it reads has no running writer it clears that one too and
+takes over unlinking the segment. A new run never reads the last run's
+data.
+"""
+
+import atexit
+import os
+import sys
+import weakref
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from StatProfiler import profile_scope
+
+_SEQ_MODULUS = 1 << 32
+_CHANNEL_HEADER = 16 # seq, nbytes[2], writer pid
+
+# Before python 3.13 every SharedMemory, created or attached, registers with
+# the resource tracker, which unlinks it when the registering process exits.
+# The tracker is shared by a whole multiprocessing tree and keeps a set of
+# names, so on those versions neither side stays registered, and the creator
+# unlinks through a fresh handle that registers and unregisters in one go.
+_TRACK_ARG = sys.version_info >= (3, 13)
+_PROF_UPDATE = profile_scope("ShmBinarySynch.update")
+_open_endpoints = weakref.WeakSet() # closed at exit, before the segments are
+
+def _untrack(shm):
+    if not _TRACK_ARG:
+        resource_tracker.unregister(shm._name, "shared_memory") # pylint: disable=protected-access
+
+def _attach(name, size):
+    """ Creates the segment, or attaches to it if the peer got there first.
+    Returns (shm, created). """
+    try:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _untrack(shm)
+        return shm, True
+    except FileExistsError:
+        pass
+    if _TRACK_ARG:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+        _untrack(shm)
+    if shm.size < size:
+        raise RuntimeError("shared memory %s is %d bytes, need %d"%(name, shm.size, size))
+    return shm, False
+
+
+class _Channel():
+    def __init__(self, buf, offset, buff_size):
+        self.buff_size = buff_size
+        self.header = np.frombuffer(buf, dtype=np.uint32, count=4, offset=offset)
+        self.slots = np.frombuffer(buf, dtype=np.uint8, count=2*buff_size,
+            offset=offset+_CHANNEL_HEADER).reshape(2, buff_size)
+
+    def clear(self, pid=0):
+        " Forgets any message in the channel; pid is its new writer "
+        self.header[:3] = 0
+        self.header[3] = pid
+
+    def writer_running(self):
+        pid = int(self.header[3])
+        if pid == 0:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError: # running, as another user
+            pass
+        return True
+
+    def write(self, payload):
+        " payload is a flat uint8 array "
+        header = self.header
+        seq = int(header[0])
+        n = seq >> 1 # completed writes
+        slot = n & 1
+        header[0] = (seq + 1) % _SEQ_MODULUS # odd: writing
+        self.slots[slot, :payload.shape[0]] = payload
+        header[1+slot] = payload.shape[0]
+        header[0] = (seq + 2) % _SEQ_MODULUS
+
+    def read_into(self, out, last_seq):
+        """ Copies the newest complete payload into out (a uint8 array) if it
+        is newer than last_seq. Returns (seq, nbytes, retries), with nbytes
+        None when there is nothing new. """
+        header = self.header
+        retries = 0
+        while True:
+            s1 = int(header[0])
+            n = s1 >> 1
+            if n == 0 or (s1 & ~1) == last_seq:
+                return last_seq, None, retries
+            slot = (n - 1) & 1
+            nbytes = int(header[1+slot])
+            out[:nbytes] = self.slots[slot, :nbytes]
+            # write n+1 is the first to reuse this slot, it starts at seq 2n+3
+            if (int(header[0]) - s1) % _SEQ_MODULUS <= 2 - (s1 & 1):
+                return s1 & ~1, nbytes, retries
+            retries += 1
+
+
+class ShmBase():
+    def __init__(self, name, send_channel, recv_channel, buff_size=1024, dtype=np.float64):
+        channel_size = _CHANNEL_HEADER + 2*buff_size
+        self.name = name
+        self.shm, self.created = _attach(name, 2*channel_size)
+        self._unlink = None
+        self.buff_size = buff_size
+        self.dtype = np.dtype(dtype)
+        self._send = _Channel(self.shm.buf, send_channel*channel_size, buff_size)
+        self._recv = _Channel(self.shm.buf, recv_channel*channel_size, buff_size)
+        self._send.clear(os.getpid())
+        if not self._recv.writer_running(): # the peer has not started, or crashed
+            self._recv.clear()
+            self.created = True # a crashed run's segment is ours to unlink
+        if self.created:
+            self._unlink = weakref.finalize(self, _unlink, name)
+        _open_endpoints.add(self)
+        self._out = np.zeros((buff_size,), dtype=np.uint8)
+        self._last_seq = -1
+        self.data_out = None
+        self.received = 0 # new messages seen by update
+        self.skipped = 0 # messages overwritten before we read them
+        self.retries = 0 # reads repeated because the writer lapped us
+
+    def send_data(self, data_in):
+        payload = np.ascontiguousarray(data_in, dtype=self.dtype).reshape(-1).view(np.uint8)
+        if payload.shape[0] > self.buff_size:
+            raise ValueError("%d byte payload does not fit a %d byte slot"%(payload.shape[0], self.buff_size))
+        self._send.write(payload)
+
+    def drain(self):
+        " Reads the newest message into self.data_out, as WireEndpoint.drain does "
+        seq, nbytes, retries = self._recv.read_into(self._out, self._last_seq)
+        self.retries += retries
+        if nbytes is not None:
+            gap = (seq - self._last_seq) % _SEQ_MODULUS
+            if self._last_seq >= 0 and gap < (1 << 31): # else the peer restarted
+                self.skipped += gap//2 - 1
+            self._last_seq = seq
+            self.received += 1
+            self.data_out = self._out[:nbytes].view(self.dtype)
+        return self.data_out
+
+    def update(self, data_in):
+        """ read the newest message, then send data. data_out is only valid
+        until the next update; copy it to keep it. """
+        _PROF_UPDATE.start()
+        try:
+            self.drain()
+            self.send_data(data_in)
+        finally:
+            _PROF_UPDATE.stop()
+        return self.data_out
+
+    def close(self):
+        if self.shm is None:
+            return
+        _open_endpoints.discard(self)
+        # the numpy views export shm.buf, which cannot be closed under them
+        self._send = self._recv = None
+        self.data_out = None
+        self._out = None
+        self.shm.close()
+        self.shm = None
+        if self._unlink is not None:
+            self._unlink()
+
+    def __del__(self):
+        if getattr(self, "shm", None) is not None:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.close()
+
+def _unlink(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+@atexit.register
+def _close_endpoints():
+    for endpoint in list(_open_endpoints):
+        endpoint.close()
+
+
+class ShmBinarySynchA(ShmBase):
+    def __init__(self, name="neuroloco_synch", **kwargs):
+        super().__init__(name, send_channel=0, recv_channel=1, **kwargs)
+
+class ShmBinarySynchB(ShmBase):
+    def __init__(self, name="neuroloco_synch", **kwargs):
+        super().__init__(name, send_channel=1, recv_channel=0, **kwargs)
+
+
+def test_shm_synch():
+    import os
+    name = "neuroloco_test_%d"%os.getpid()
+    with ShmBinarySynchA(name=name) as a, ShmBinarySynchB(name=name) as b:
+        assert(a.update(np.array([1.0, 2.0])) is None)
+        assert(np.array_equal(b.update(np.array([3.0])), [1.0, 2.0]))
+        for i in range(5):
+            a.send_data(np.array([float(i)]))
+        assert(b.update(np.array([4.0]))[0] == 4.0 and b.skipped == 4)
+        assert(np.array_equal(a.update(np.array([0.0])), [4.0]))
+        assert(b.update(np.array([5.0]))[0] == 0.0 and b.received == 3)
+
+def test_stale_segments():
+    import os
+    import subprocess
+    name = "neuroloco_test_%d"%os.getpid()
+    run_a = ("import numpy as np; from ShmBinarySynch import ShmBinarySynchA; "
+        "a = ShmBinarySynchA(name=%r); a.send_data(np.array([1.0])); "%name)
+    here = os.path.dirname(os.path.abspath(__file__))
+    # exiting without close() unlinks the segment, quietly
+    done = subprocess.run([sys.executable, "-c", run_a], cwd=here, capture_output=True, text=True)
+    assert(done.returncode == 0 and done.stderr == "" and not os.path.exists("/dev/shm/" + name))
+    # a crash leaves it behind, with data the next run must not read
+    subprocess.run([sys.executable, "-c", run_a + "import os; os._exit(0)"], cwd=here, check=True)
+    assert(os.path.exists("/dev/shm/" + name))
+    b = ShmBinarySynchB(name=name)
+    assert(b.update(np.array([2.0])) is None and b.created)
+    b.close()
+    assert(not os.path.exists("/dev/shm/" + name))
+
+if __name__ == '__main__':
+    test_shm_synch()
+    test_stale_segments()
@@ -72,7 +72,11 @@ class LoopKiller:
       self._soft_kill_time = None
 
 class SoftRealtimeLoop(object):
-  def __init__(self, dt=0.001, report=False, fade=0.0):
+  def __init__(self, dt=0.001, report=False, fade=0.0, profiler=None):
+    """ profiler: an optional SamplingProfiler.SamplingProfiler, run while
+    iterating and told which phase of the loop (sleep, body, overrun) each
+    sample falls in. It stops when the loop ends, including by break or an
+    exception, or on close() """
     self.t0 = self.t1 = time.time()
     self.killer = LoopKiller(fade_time=fade)
     self.dt = dt
@@ -82,8 +86,13 @@ class SoftRealtimeLoop(object):
     self.sleep_t_agg = 0.0
     self.n = 0
     self.report=report
+    self.profiler = profiler
 
   def __del__(self):
+    if self.profiler is not None:
+      self.profiler.stop()
+      if self.report:
+        self.profiler.report()
     if self.report:
       print('In %d cycles at %.2f Hz:'%(self.n, 1./self.dt))
       print('\tavg error: %.3f milliseconds'% (1e3*self.sum_err/self.n))
@@ -126,13 +135,44 @@ class SoftRealtimeLoop(object):
   def time_since(self):
     return time.time()-self.t1
 
+  def close(self):
+    if self.profiler is not None:
+      self.profiler.stop()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, etype, value, tb):
+    self.close()
+
   def __iter__(self):
     self.t0 = self.t1 = time.time()+self.dt
+    if self.profiler is not None:
+      self.profiler.start()
+      return self._profiled()
     return self
 
+  def _profiled(self):
+    # a generator, so a break out of the for loop closes it and stops the profiler
+    try:
+      while True:
+        try:
+          t = self.__next__()
+        except StopIteration:
+          return
+        yield t
+    finally:
+      self.close()
+
+  def _stop_iteration(self):
+    self.close()
+    raise StopIteration
+
   def __next__(self):
+    if self.profiler is not None:
+      self.profiler.enter_sleep()
     if self.killer.kill_now:
-      raise StopIteration
+      self._stop_iteration()
 
     while time.time()<self.t1-2*PRECISION_OF_SLEEP and not self.killer.kill_now:
       t_pre_sleep = time.time()
@@ -143,8 +183,10 @@ class SoftRealtimeLoop(object):
       if signal.sigtimedwait([signal.SIGTERM,signal.SIGINT,signal.SIGHUP], 0):
         self.stop()
     if self.killer.kill_now:
-      raise StopIteration
+      self._stop_iteration()
     self.t1+=self.dt
+    if self.profiler is not None:
+      self.profiler.enter_body(self.t1)
     if self.ttarg is None: 
       # inits ttarg on first call
       self.ttarg = time.time()+self.dt
@@ -1,12 +1,21 @@
+import os
+import json
 import time
+import asyncio
+import functools
+import threading
+import contextvars
 from math import sqrt
+from time import perf_counter_ns
 
 class StatProfiler():
-    """ Profiler class with statistics"""
+    """ Profiler class with statistics. tic and toc pair up per thread, and
+    profile, decorate and with-blocks count a call even if it raises. """
     def __init__(self, name):
         self.N, self.agg, self.aggvar = 0, 0.0, 0.0
         self.name=name
-        self.t0 = None
+        self._local = threading.local() # tic time of each thread
+        self._lock = threading.Lock()
 
     def __del__(self):
         try:
@@ -17,34 +26,50 @@ class StatProfiler():
             stddev=float('NaN')
         print(f"StatProfiler {self.name}: {self.N} reps, avg: {mean*1e3} ms, stddev: {stddev*1e3} ms, total: {self.agg} s")
 
+    @property
+    def t0(self):
+        return getattr(self._local, "t0", None)
+
     def tic(self):
         """ Matlab style """
-        self.t0=time.time()
+        self._local.t0=time.time()
 
     def toc(self):
         """ Matlab style """
-        if self.t0 is not None:
-            t = time.time()-self.t0
-            self.N+=1
-            self.agg+=t
-            self.aggvar+=t**2
+        t0 = self.t0
+        if t0 is not None:
+            t = time.time()-t0
+            with self._lock:
+                self.N+=1
+                self.agg+=t
+                self.aggvar+=t**2
 
     def profile(self, func):
         """ lambda style """
         self.tic()
-        x = func()
-        self.toc()
-        return x
+        try:
+            return func()
+        finally:
+            self.toc()
 
     def decorate(self, func):
         """ Decorator style"""
+        @functools.wraps(func)
         def ret(*args, **kwargs):
             self.tic()
-            x = func(*args, **kwargs)
-            self.toc()
-            return x
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.toc()
         return ret
 
+    def __enter__(self):
+        self.tic()
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.toc()
+
 
 class SSProfile(StatProfiler):
     """ Singleton Stat Profilers """
@@ -56,6 +81,299 @@ class SSProfile(StatProfiler):
         return cls._instances[name]
 
 
+## Scoped profiling
+# ProfileScopes are registered by name in PROFILE, time with perf_counter_ns,
+# and nest: a scope started inside another one adds its time to the outer
+# scope's child time, so each reports its own (self) time as well as its
+# total. Durations go into log-spaced histograms (4 bins per octave) for
+# percentiles. They are meant to stay in production code: while profiling
+# is disabled (the default, or NLM_PROFILE=0) start() and stop() are one
+# branch each. Enable with NLM_PROFILE=1 or enable().
+#
+# A scope can be used from several threads at once (the loop and device
+# reader threads): each thread has its own stack of started scopes and its
+# own accumulator per scope, written only by that thread, without locks,
+# and merged when the numbers are read. Besides start()/stop(), a scope is a
+# context manager (with scope:), an async context manager (async with
+# scope:) and a decorator (@scope), all of which stop it even when the code
+# inside raises. Coroutines nest on a per-task stack instead, since tasks
+# interleave on one thread.
+
+_enabled = os.environ.get("NLM_PROFILE", "0") not in ("", "0")
+
+def enable(on=True):
+    global _enabled
+    PROFILE._clear_stacks() # scopes started under the old setting never stop cleanly
+    _enabled = on
+
+def enabled():
+    return _enabled
+
+_HIST_BINS = 4*64
+
+def _hist_bin(ns):
+    """ 0-7 ns exactly, then 4 bins per power of 2 """
+    n = ns.bit_length()
+    if n <= 3:
+        return ns
+    return 4*n - 8 + ((ns >> (n - 3)) & 3)
+
+def _bin_edges(b):
+    """ [low, high) in ns of histogram bin b """
+    if b < 8:
+        return b, b + 1
+    n, sub = (b + 8)//4, (b + 8)%4
+    return (4 + sub) << (n - 3), (5 + sub) << (n - 3)
+
+
+class _Accumulator():
+    """ One thread's numbers for one scope """
+    __slots__ = ("calls", "total_ns", "child_ns", "min_ns", "max_ns", "hist", "parents")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.total_ns = 0
+        self.child_ns = 0 # time spent in scopes nested inside this one
+        self.min_ns = None
+        self.max_ns = 0
+        self.hist = [0]*_HIST_BINS
+        self.parents = {} # name of the enclosing scope: ns spent in this one under it
+
+    def add(self, dt):
+        self.calls += 1
+        self.total_ns += dt
+        if self.min_ns is None or dt < self.min_ns:
+            self.min_ns = dt
+        if dt > self.max_ns:
+            self.max_ns = dt
+        self.hist[_hist_bin(dt)] += 1
+
+
+class _ThreadState():
+    def __init__(self):
+        self.stack = [] # (scope, start ns) of the scopes started and not stopped
+        self.accs = {} # scope -> _Accumulator
+
+    def acc(self, scope):
+        acc = self.accs.get(scope)
+        if acc is None:
+            acc = self.accs[scope] = _Accumulator()
+        return acc
+
+_local = threading.local()
+_task_stack = contextvars.ContextVar("profile_task_stack", default=())
+
+def _thread_state():
+    try:
+        return _local.state
+    except AttributeError:
+        state = _local.state = _ThreadState()
+        PROFILE._add_thread(state)
+        return state
+
+
+class ProfileScope():
+    def __init__(self, name, registry):
+        self.name = name
+        self.registry = registry
+
+    ## Timing
+
+    def start(self):
+        if _enabled:
+            _thread_state().stack.append((self, perf_counter_ns()))
+
+    def stop(self):
+        if _enabled:
+            t = perf_counter_ns()
+            state = _thread_state()
+            stack = state.stack
+            if not stack or stack[-1][0] is not self:
+                if not any(entry[0] is self for entry in stack):
+                    return # started while disabled
+                while stack[-1][0] is not self: # scopes an exception left open
+                    stack.pop()
+                    self.registry.abandoned += 1
+            self._record(state, t - stack.pop()[1], stack[-1][0] if stack else None)
+
+    def _record(self, state, dt, parent):
+        acc = state.acc(self)
+        acc.add(dt)
+        if parent is not None:
+            state.acc(parent).child_ns += dt
+            acc.parents[parent.name] = acc.parents.get(parent.name, 0) + dt
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.stop()
+
+    async def __aenter__(self):
+        if _enabled:
+            _task_stack.set(_task_stack.get() + ((self, perf_counter_ns()),))
+        return self
+
+    async def __aexit__(self, etype, value, tb):
+        if _enabled:
+            t = perf_counter_ns()
+            stack = _task_stack.get()
+            for k in range(len(stack) - 1, -1, -1):
+                if stack[k][0] is self:
+                    self.registry.abandoned += len(stack) - 1 - k
+                    _task_stack.set(stack[:k])
+                    self._record(_thread_state(), t - stack[k][1], stack[k-1][0] if k else None)
+                    return
+
+    def __call__(self, func):
+        """ Decorator: times every call of func, or of the coroutine func """
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_coroutine(*args, **kwargs):
+                async with self:
+                    return await func(*args, **kwargs)
+            return timed_coroutine
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            self.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.stop()
+        return timed
+
+    ## Results, merged over threads
+
+    def _accumulators(self):
+        return [state.accs[self] for state in self.registry._threads() if self in state.accs]
+
+    def merged(self):
+        total = _Accumulator()
+        for acc in self._accumulators():
+            total.calls += acc.calls
+            total.total_ns += acc.total_ns
+            total.child_ns += acc.child_ns
+            if acc.min_ns is not None and (total.min_ns is None or acc.min_ns < total.min_ns):
+                total.min_ns = acc.min_ns
+            total.max_ns = max(total.max_ns, acc.max_ns)
+            total.hist = [a + b for a, b in zip(total.hist, acc.hist)]
+            for name, ns in list(acc.parents.items()):
+                total.parents[name] = total.parents.get(name, 0) + ns
+        return total
+
+    def reset(self):
+        for acc in self._accumulators():
+            acc.reset()
+
+    calls = property(lambda self: self.merged().calls)
+    total_ns = property(lambda self: self.merged().total_ns)
+    child_ns = property(lambda self: self.merged().child_ns)
+    min_ns = property(lambda self: self.merged().min_ns)
+    max_ns = property(lambda self: self.merged().max_ns)
+    parents = property(lambda self: self.merged().parents)
+
+    @property
+    def self_ns(self):
+        merged = self.merged()
+        return merged.total_ns - merged.child_ns
+
+    @property
+    def threads(self):
+        return sum(1 for acc in self._accumulators() if acc.calls)
+
+    def percentile(self, q, merged=None):
+        """ q-th percentile duration in ns, interpolated within a histogram bin """
+        merged = merged or self.merged()
+        if merged.calls == 0:
+            return float('nan')
+        rank = q/100.0*merged.calls
+        seen = 0
+        for b, count in enumerate(merged.hist):
+            if count and seen + count >= rank:
+                low, high = _bin_edges(b)
+                value = low + (high - low)*max(rank - seen, 0)/count
+                return min(max(value, merged.min_ns), merged.max_ns)
+            seen += count
+        return float(merged.max_ns)
+
+    def summary(self):
+        merged = self.merged()
+        calls = merged.calls
+        return {"name": self.name, "calls": calls, "threads": self.threads, "total_ms": merged.total_ns*1e-6,
+            "self_ms": (merged.total_ns - merged.child_ns)*1e-6,
+            "mean_us": merged.total_ns/calls*1e-3 if calls else float('nan'),
+            "min_us": merged.min_ns*1e-3 if calls else float('nan'),
+            "p50_us": self.percentile(50, merged)*1e-3, "p90_us": self.percentile(90, merged)*1e-3,
+            "p99_us": self.percentile(99, merged)*1e-3, "max_us": merged.max_ns*1e-3,
+            "parents": {name: ns*1e-6 for name, ns in merged.parents.items()}}
+
+
+class ProfileRegistry():
+    def __init__(self):
+        self.scopes = {}
+        self.abandoned = 0 # scopes never stopped, e.g. by an exception
+        self._thread_states = []
+        self._lock = threading.Lock()
+
+    def scope(self, name):
+        with self._lock:
+            if name not in self.scopes:
+                self.scopes[name] = ProfileScope(name, self)
+            return self.scopes[name]
+
+    def _add_thread(self, state):
+        with self._lock:
+            self._thread_states.append(state)
+
+    def _threads(self):
+        with self._lock:
+            return list(self._thread_states)
+
+    def _clear_stacks(self):
+        for state in self._threads():
+            state.stack.clear()
+
+    def reset(self):
+        for scope in list(self.scopes.values()):
+            scope.reset()
+        self.abandoned = 0
+
+    def summaries(self):
+        rows = [scope.summary() for scope in list(self.scopes.values())]
+        return sorted(rows, key=lambda row: -row["total_ms"])
+
+    def table(self):
+        lines = ["%-32s %8s %3s %10s %10s %9s %9s %9s %9s %9s  %s"%(
+            "scope", "calls", "thr", "total ms", "self ms", "mean us", "min us", "p50 us", "p99 us", "max us", "inside")]
+        for row in self.summaries():
+            if row["calls"] == 0:
+                continue
+            lines.append("%-32s %8d %3d %10.3f %10.3f %9.2f %9.2f %9.2f %9.2f %9.2f  %s"%(
+                row["name"], row["calls"], row["threads"], row["total_ms"], row["self_ms"], row["mean_us"],
+                row["min_us"], row["p50_us"], row["p99_us"], row["max_us"], ", ".join(sorted(row["parents"]))))
+        return "\n".join(lines)
+
+    def report(self):
+        print(self.table())
+
+    def to_json(self, file_name=None):
+        text = json.dumps({"abandoned": self.abandoned, "scopes": self.summaries()}, indent=1)
+        if file_name is not None:
+            with open(file_name, 'w') as fil:
+                fil.write(text)
+        return text
+
+PROFILE = ProfileRegistry()
+
+def profile_scope(name):
+    """ The ProfileScope registered under name, created on first use """
+    return PROFILE.scope(name)
+
+
 def test_no_runs():
     SSProfile("test_none")
 
@@ -83,9 +401,86 @@ def test_tic_toc():
         time.sleep(0.0001)
         SSProfile("tic_toc").toc()
 
+def test_profile_scopes():
+    assert(all(_bin_edges(_hist_bin(ns))[0] <= ns < _bin_edges(_hist_bin(ns))[1] for ns in range(0, 100000, 7)))
+    was_enabled = enabled()
+    outer, inner = profile_scope("test_outer"), profile_scope("test_inner")
+    enable(False)
+    outer.start()
+    outer.stop()
+    assert(outer.calls == 0)
+    enable(True)
+    for i in range(50):
+        outer.start()
+        inner.start()
+        time.sleep(0.0005)
+        inner.stop()
+        outer.stop()
+    try: # an exception leaves inner open, outer's stop cleans up
+        outer.start()
+        inner.start()
+        raise RuntimeError()
+    except RuntimeError:
+        outer.stop()
+    assert(outer.calls == 51 and inner.calls == 50 and PROFILE.abandoned == 1 and not _thread_state().stack)
+    assert(outer.child_ns == inner.total_ns and inner.parents == {"test_outer": inner.total_ns})
+    assert(inner.min_ns >= 500e3 and inner.min_ns <= inner.percentile(50) <= inner.percentile(99) <= inner.max_ns)
+    row = json.loads(PROFILE.to_json())["scopes"]
+    assert({"test_outer", "test_inner"} <= {r["name"] for r in row} and "test_inner" in PROFILE.table())
+    enable(was_enabled)
+
+def test_threads_and_async():
+    was_enabled = enabled()
+    enable(True)
+    reader, update = profile_scope("test_reader"), profile_scope("test_update")
+    @reader
+    def read(fail):
+        time.sleep(0.0002)
+        if fail:
+            raise IOError()
+    def reader_thread():
+        for i in range(200):
+            try:
+                read(i % 10 == 0)
+            except IOError:
+                pass
+    threads = [threading.Thread(target=reader_thread) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for i in range(200): # the main loop meanwhile, with the reader nested in its update
+        with update:
+            read(False)
+    for thread in threads:
+        thread.join()
+    assert(reader.calls == 800 and reader.threads == 4 and update.calls == 200)
+    assert(reader.parents.keys() == {"test_update"} and update.child_ns == reader.parents["test_update"])
+    assert(reader.min_ns >= 200e3 and not _thread_state().stack)
+    StatProfiler.toc(SSProfile("test_threads")) # toc without tic is ignored
+    with SSProfile("test_threads"):
+        pass
+    assert(SSProfile("test_threads").N == 1)
+    outer, inner = profile_scope("test_async_outer"), profile_scope("test_async_inner")
+    abandoned = PROFILE.abandoned
+    @inner
+    async def step(delay):
+        await asyncio.sleep(delay)
+    async def task(delay):
+        async with outer:
+            for i in range(5):
+                await step(delay)
+    async def main():
+        await asyncio.gather(task(0.002), task(0.001), task(0.0005))
+    asyncio.run(main())
+    assert(outer.calls == 3 and inner.calls == 15 and PROFILE.abandoned == abandoned)
+    assert(outer.child_ns == inner.total_ns and outer.min_ns >= 5*0.0005e9 and outer.max_ns >= 5*0.002e9)
+    enable(was_enabled)
+
 if __name__ == '__main__':
     test_no_runs()
     test_all_tocs()
     test_decorator()
     test_lambda()
     test_tic_toc()
+    test_profile_scopes()
+    test_threads_and_async()
+    PROFILE.report()
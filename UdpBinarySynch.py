@@ -1,20 +1,77 @@
 """
 Objects for passing data between two real-time loops.
+
+Messages use the fixed-layout header of WireFormat: a 32-bit sequence
+number, an echo of the latest sequence number received from the peer, the
+send time, the peer's hold time, a schema id and a checksum. update(data_in)
+drains the socket, keeps the newest valid DATA message from the peer, and
+then sends data_in. Link quality is tracked in self.stats (see LinkStats).
+
+With latest_only=True, and where libc has recvmmsg (Linux), the drain pulls
+up to `batch` datagrams per system call into a preallocated buffer pool and
+decodes only the newest DATA message; the rest are counted from their
+headers. Elsewhere it falls back to one recv_into per datagram.
 """
 
 # import zmq
 import socket
+import ctypes
 import numpy as np
-from StatProfiler import StatProfiler
+from WireFormat import WireEndpoint
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IoVec)), ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int)]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+def _find_recvmmsg():
+    try:
+        recvmmsg = ctypes.CDLL(None, use_errno=True).recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
 
-class UdpBase:
-    def __init__(self, recv_IP, recv_port, send_IP, send_port, buff_size=1024):
+_recvmmsg = _find_recvmmsg()
+
+class UdpBase(WireEndpoint):
+    def __init__(self, recv_IP, recv_port, send_IP, send_port, buff_size=1024, latest_only=False, batch=32):
+        super().__init__("UDP %s:%d => %s:%d"%(recv_IP, recv_port, send_IP, send_port),
+            buff_size=buff_size, latest_only=latest_only)
         self.send_sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM | socket.SOCK_NONBLOCK)
         self.recv_sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM | socket.SOCK_NONBLOCK)
         self.recv_sock.bind((recv_IP, recv_port))
         self.send_addr = (send_IP, send_port)
         self.buff_size = buff_size
-        self.prof = StatProfiler("UDP %s:%d => %s:%d"%(recv_IP, recv_port, send_IP, send_port))
+        if latest_only and _recvmmsg is not None:
+            self._setup_batch(batch)
+
+    def _setup_batch(self, batch):
+        size = self.buff_size
+        self._pool = (ctypes.c_char * (batch*size))()
+        self._iovecs = (_IoVec * batch)()
+        self._msgs = (_MMsgHdr * batch)()
+        base = ctypes.addressof(self._pool)
+        for i in range(batch):
+            self._iovecs[i].iov_base = base + i*size
+            self._iovecs[i].iov_len = size
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            self._msgs[i].msg_hdr.msg_iovlen = 1
+        pool = memoryview(self._pool).cast('B')
+        self._batch_bufs = [pool[i*size:(i+1)*size] for i in range(batch)]
+        # msg_len of every header, as a strided view that the kernel fills in
+        raw = (ctypes.c_char * ctypes.sizeof(self._msgs)).from_buffer(self._msgs)
+        self._batch_sizes = np.ndarray((batch,), dtype=np.uint32, buffer=raw,
+            offset=_MMsgHdr.msg_len.offset, strides=(ctypes.sizeof(_MMsgHdr),))
+        self._fd = self.recv_sock.fileno()
 
     def send(self, msg):
         self.send_sock.sendto(msg, self.send_addr)
@@ -22,47 +79,23 @@ class UdpBase:
     def recv(self):
         return self.recv_sock.recv(self.buff_size)
 
+    def _send_bytes(self, message):
+        self.send_sock.sendto(message, self.send_addr)
+
+    def _recv_into(self, buffer):
+        try:
+            return self.recv_sock.recv_into(buffer)
+        except BlockingIOError:
+            return None
+
+    def _recv_batch(self):
+        n = _recvmmsg(self._fd, self._msgs, len(self._batch_bufs), socket.MSG_DONTWAIT, None)
+        return n if n > 0 else 0 # -1 with EAGAIN when nothing is pending
+
 class UdpBinarySynchB(UdpBase):
     def __init__(self, recv_IP, recv_port, send_IP, send_port, **kwargs):
         super().__init__(recv_IP, recv_port, send_IP, send_port, **kwargs)
-        self.my_count = 0
-        self.data_out = None
-
-    def update(self, data_in):
-        """ read all messages, then send data."""
-        while True:
-            try: 
-                message = self.recv()
-            
-                if int(message[1:4])==self.my_count:
-                    self.prof.toc() # count received
-                    self.my_count+=1
-                    self.prof.tic() # sending new count
-                    if self.my_count>=1000:
-                        self.my_count=0
-                self.data_out = np.frombuffer(message[4:])
-            except BlockingIOError:
-                break
-    
-        self.send(b"B%03d%s"%(self.my_count, data_in.tobytes()))
-        return self.data_out
 
 class UdpBinarySynchA(UdpBase):
     def __init__(self, recv_IP, recv_port, send_IP, send_port, **kwargs):
         super().__init__(recv_IP, recv_port, send_IP, send_port, **kwargs)
-        self.my_count = -42
-        self.data_out = None
-
-    def update(self, data_in):
-        """ read all messages, then send data. """
-        while True:
-            try: 
-                message = self.recv()
-                self.my_count=int(message[1:4])
-                self.data_out = np.frombuffer(message[4:])
-            except BlockingIOError:
-                break
-        self.send(b"A%03d%s"%(self.my_count, data_in.tobytes()))
-
-        return self.data_out
-    
\ No newline at end of file
@@ -1,18 +1,83 @@
+import re
 import socket
+import threading
+from collections import namedtuple, deque
 from random import randint
-from time import sleep
+from time import time, sleep
+from xml.sax.saxutils import escape, unescape
+
+
+ViconTrigger = namedtuple("ViconTrigger", ["kind", "name", "packet_id", "time"])
+ViconTrigger.__doc__ = """ A trigger sent (kind "CaptureStart" or "CaptureStop")
+or heard from Nexus, with time taken on the Vicon object's clock right before
+the first send, or on arrival. """
+
+_PACKET_KIND = re.compile(rb'<(Capture\w+)')
+_PACKET_NAME = re.compile(rb'<Name VALUE="([^"]*)"')
+_PACKET_ID = re.compile(rb'<PacketID VALUE="(\d+)"')
+
+
+class ViconPayloadTemplate:
+    """
+    A trigger packet with everything but the name, description and packet ID
+    rendered and encoded once, so filling it in is a single bytes % format.
+    """
+    def __init__(self, kind, view_path, delay_ms, notes = None, result = None):
+        header = '\n<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<{}{}>\n'.format(
+            kind, ' RESULT="{}"'.format(result) if result else '')
+        lines = [header, '<Name VALUE="%s"/>\n']
+        if notes is not None:
+            lines.append('<Notes VALUE="{}"/>\n'.format(_literal(notes)))
+            lines.append('<Description VALUE="%s"/>\n')
+        lines.append('<DatabasePath VALUE="{}"/>\n'.format(_literal(view_path)))
+        lines.append('<Delay VALUE="{}"/>\n'.format(delay_ms))
+        lines.append('<PacketID VALUE="%d"/>\n')
+        lines.append('</{}>'.format(kind))
+        self.kind = kind
+        self.has_description = notes is not None
+        self.template = "".join(lines).encode("utf-8")
+
+    def fill(self, name, packet_id, description = ""):
+        if self.has_description:
+            return self.template % (_quote(name).encode("utf-8"), _quote(description).encode("utf-8"), packet_id)
+        return self.template % (_quote(name).encode("utf-8"), packet_id)
+
+
+def _quote(text):
+    return escape(text, {'"': "&quot;"})
+
+def _literal(text):
+    " Fixed text for a template: quoted, with % escaped from the format "
+    return _quote(str(text)).replace("%", "%%")
 
 
 class Vicon:
     """
     A class for managing starting and stopping Vicon recordings
-    over the network. 
+    over the network.
     To use this class, make sure you've armed vicon and enabled network triggers.
     See this page for more info: https://docs.vicon.com/display/Nexus213/Automatically+start+and+stop+capture
     Kevin Best 10/22
+
+    The payloads are precompiled templates (ViconPayloadTemplate), so a
+    trigger costs a format and a sendto and can be called from the control
+    loop. Every trigger is stamped with clock() just before it is sent and
+    kept in self.triggers, to line capture boundaries up with our logs;
+    the default time.time is the clock SoftRealtimeLoop and the logs use.
+
+    UDP may drop a trigger. With retransmits > 0 each one is sent again that
+    many times, retransmit_interval apart, from a background thread. Copies
+    carry the same PacketID, which Nexus uses to ignore duplicates, and
+    packet IDs count up so a start and a stop never share one.
+    With listen_port, the capture packets Nexus broadcasts are collected in
+    self.events (deduplicated by PacketID over the last dedup_window
+    seconds, which covers Nexus' repeats but not a restart that reuses its
+    IDs), and acknowledged() tells whether Nexus reported the capture a
+    trigger asked for.
     """
     def __init__(self, viconPC_IP = '141.212.77.16', viconPC_port = 30,
-                viconPath = 'E:'):
+                viconPath = 'E:', retransmits = 0, retransmit_interval = 0.005,
+                listen_port = None, dedup_window = 2.0, clock = time):
 
         self.destinationIP = viconPC_IP
         self.destinationPort = viconPC_port
@@ -20,73 +85,186 @@ class Vicon:
         self.delayPriorToRecord_ms = 1
         self.fileName = ''
         self.fileDescription = ''
+        self.clock = clock
 
         # Setup UDP
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) 
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        self._start_template = ViconPayloadTemplate("CaptureStart", viconPath, self.delayPriorToRecord_ms,
+            notes = 'Vicon triggered from python over UDP')
+        self._stop_template = ViconPayloadTemplate("CaptureStop", viconPath, self.delayPriorToRecord_ms,
+            result = "SUCCESS")
+        self._packet_id = randint(1, 2**16)
+        self.triggers = []
+
+        self.retransmits = retransmits
+        self.retransmit_interval = retransmit_interval
+        self._pending = deque() # (due, payload, copies left)
+        self._wake = threading.Condition()
+        self._stopped = False
+        self._retransmitter = None
+        if retransmits > 0:
+            self._retransmitter = threading.Thread(target=self._retransmit, name="ViconRetransmit", daemon=True)
+            self._retransmitter.start()
+
+        self.events = []
+        self.dedup_window = dedup_window
+        self._seen_ids = {} # PacketID -> time first seen, pruned after dedup_window
+        self._listener = None
+        if listen_port is not None:
+            self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listen_sock.bind(('', listen_port))
+            self.listen_sock.settimeout(0.1)
+            self._listener = threading.Thread(target=self._listen, name="ViconListener", daemon=True)
+            self._listener.start()
 
     def start_recording(self, fileNameIn: str, fileDescription: str = 'A vicon recording'):
         """
         Send command to vicon to start file recording.
         Requires 2 inputs:
             fileNameIn: File name to be used on the vicon PC
-            fileDescription: Any notes you want to add to your file. Fills the description field on vicon 
+            fileDescription: Any notes you want to add to your file. Fills the description field on vicon
+        Returns the ViconTrigger sent.
         """
-        msg = self._assemble_payload_start(fileNameIn, fileDescription)
-        self.sock.sendto(msg, (self.destinationIP, self.destinationPort))
+        self.fileName = fileNameIn
+        self.fileDescription = fileDescription
+        return self._trigger(self._start_template, fileNameIn, fileDescription)
 
     def stop_recording(self):
-        msg = self._assemble_payload_stop()
-        self.sock.sendto(msg, (self.destinationIP, self.destinationPort))
+        """ Returns the ViconTrigger sent. """
+        return self._trigger(self._stop_template, self.fileName)
+
+    def close(self):
+        self._stopped = True
+        with self._wake:
+            self._wake.notify()
+        for thread in (self._retransmitter, self._listener):
+            if thread is not None:
+                thread.join()
+        if self._listener is not None:
+            self.listen_sock.close()
+        self.sock.close()
+
+    def _next_packet_id(self):
+        self._packet_id = self._packet_id % 2**16 + 1
+        return self._packet_id
+
+    def _trigger(self, template, name, description = ""):
+        packet_id = self._next_packet_id()
+        payload = template.fill(name, packet_id, description)
+        trigger = ViconTrigger(template.kind, name, packet_id, self.clock())
+        self.sock.sendto(payload, (self.destinationIP, self.destinationPort))
+        self.triggers.append(trigger)
+        if self.retransmits > 0:
+            with self._wake:
+                self._pending.append((trigger.time + self.retransmit_interval, payload, self.retransmits))
+                self._wake.notify()
+        return trigger
+
+    def _retransmit(self):
+        while not self._stopped:
+            with self._wake:
+                if not self._pending:
+                    self._wake.wait()
+                    continue
+                due, payload, left = self._pending[0]
+                wait = due - self.clock()
+                if wait > 0:
+                    self._wake.wait(wait)
+                    continue
+                self._pending.popleft()
+                if left > 1:
+                    self._pending.append((due + self.retransmit_interval, payload, left - 1))
+            self.sock.sendto(payload, (self.destinationIP, self.destinationPort))
+
+    def _listen(self):
+        while not self._stopped:
+            try:
+                data = self.listen_sock.recv(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            event = self._parse_event(data, self.clock())
+            if event is not None:
+                self.events.append(event)
+
+    def _parse_event(self, data, t):
+        """ A ViconTrigger for the first copy of a capture packet, None for
+        duplicates, our own triggers and anything else """
+        kind, name, packet_id = _PACKET_KIND.search(data), _PACKET_NAME.search(data), _PACKET_ID.search(data)
+        if kind is None or packet_id is None:
+            return None
+        packet_id = int(packet_id.group(1))
+        for old in [pid for pid, seen in self._seen_ids.items() if t - seen > self.dedup_window]:
+            del self._seen_ids[old]
+        if packet_id in self._seen_ids:
+            return None
+        self._seen_ids[packet_id] = t
+        kind = kind.group(1).decode("utf-8", "replace")
+        name = unescape(name.group(1).decode("utf-8", "replace"), {"&quot;": '"'}) if name else None
+        if any(trigger.packet_id == packet_id for trigger in self.triggers[-16:]):
+            return None # one of ours, looped back
+        return ViconTrigger(kind, name, packet_id, t)
+
+    def acknowledged(self, trigger):
+        """ The event Nexus broadcast for trigger's capture after it was sent, or None """
+        wanted = "CaptureStart" if trigger.kind == "CaptureStart" else "CaptureComplete"
+        for event in self.events:
+            if event.time >= trigger.time and event.kind == wanted and event.name == trigger.name:
+                return event
+        return None
 
     def _assemble_payload_start(self, fileNameIn, fileDescription):
         """
-        Creates the proper XML string to trigger vicon. 
-        More documentation available here: 
+        Creates the proper XML string to trigger vicon.
+        More documentation available here:
            https://docs.vicon.com/pages/viewpage.action?pageId=152010925
         """
-
-        # Update self
         self.fileName = fileNameIn
         self.fileDescription = fileDescription
-
-        # Construct the string
-        notes = 'Vicon triggered from python over UDP'
-        cmdHeader = '\n<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<CaptureStart>\n'
-        nameLine = '<Name VALUE="{}"/>\n'.format(self.fileName)
-        notesLine = '<Notes VALUE="{}"/>\n'.format(notes)
-        descriptionLine = '<Description VALUE="{}"/>\n'.format(self.fileDescription)
-        databasePathLine = '<DatabasePath VALUE="{}"/>\n'.format(self.viconPath)
-        delayLine = '<Delay VALUE="{}"/>\n'.format(self.delayPriorToRecord_ms)
-        packetIDline = '<PacketID VALUE="{}"/>\n'.format(randint(1,2**16))
-        suffixLine = '</CaptureStart>'
-        fullPayloadString = cmdHeader + nameLine + notesLine + descriptionLine + databasePathLine + delayLine + packetIDline + suffixLine
-        # print(fullPayloadString)
-
-        # Convert string to utf-8 bytes string to send over network. 
-        return bytes(fullPayloadString, "utf-8")
+        return self._start_template.fill(fileNameIn, self._next_packet_id(), fileDescription)
 
     def _assemble_payload_stop(self):
         """
-        Creates the proper XML string to stop vicon. 
-        More documentation available here: 
+        Creates the proper XML string to stop vicon.
+        More documentation available here:
            https://docs.vicon.com/pages/viewpage.action?pageId=152010925
         """
+        return self._stop_template.fill(self.fileName, self._next_packet_id())
 
-        cmdHeader = '\n<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<CaptureStop RESULT="SUCCESS">\n'
-        nameLine = '<Name VALUE="{}"/>\n'.format(self.fileName)
-        databasePathLine = '<DatabasePath VALUE="{}"/>\n'.format(self.viconPath)
-        delayLine = '<Delay VALUE="{}"/>\n'.format(self.delayPriorToRecord_ms)
-        packetIDline = '<PacketID VALUE="{}"/>\n'.format(randint(1,2**16))
-        suffixLine = '</CaptureStop>'
-        fullPayloadString = cmdHeader + nameLine + databasePathLine + delayLine + packetIDline + suffixLine
-        # print(fullPayloadString)
-
-        # Convert string to utf-8 bytes string to send over network. 
-        return bytes(fullPayloadString, "utf-8")
 
+def test_vicon_triggers():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(0.5)
+    vicon = Vicon('127.0.0.1', receiver.getsockname()[1], retransmits=2, retransmit_interval=0.01)
+    start = vicon.start_recording('Walk "A" & B', 'incline 5%')
+    first = receiver.recv(4096)
+    assert(first.startswith(b'\n<?xml') and b'<Name VALUE="Walk &quot;A&quot; &amp; B"/>' in first)
+    assert(b'<Description VALUE="incline 5%"/>' in first and b'<Notes VALUE="Vicon triggered' in first)
+    assert(b'<PacketID VALUE="%d"/>' % start.packet_id in first)
+    assert(receiver.recv(4096) == first and receiver.recv(4096) == first) # retransmits
+    stop = vicon.stop_recording()
+    stopped = receiver.recv(4096)
+    assert(b'<CaptureStop RESULT="SUCCESS">' in stopped and b'Walk &quot;A&quot;' in stopped)
+    assert(stop.packet_id != start.packet_id and stop.time >= start.time)
+    assert([t.kind for t in vicon.triggers] == ["CaptureStart", "CaptureStop"])
+    # Nexus' own broadcasts, one of them repeated
+    ack = b'<?xml version="1.0"?>\n<CaptureComplete>\n<Name VALUE="Walk &quot;A&quot; &amp; B"/>\n<PacketID VALUE="7"/>\n</CaptureComplete>'
+    event = vicon._parse_event(ack, stop.time + 0.1)
+    assert(event.kind == "CaptureComplete" and event.packet_id == 7 and vicon._parse_event(ack, stop.time + 0.2) is None)
+    vicon.events.append(event)
+    assert(vicon.acknowledged(stop) is event and vicon.acknowledged(start) is None)
+    event = vicon._parse_event(ack, stop.time + 0.1 + vicon.dedup_window + 0.1) # Nexus restarted, same ID
+    assert(event is not None and event.packet_id == 7 and list(vicon._seen_ids) == [7])
+    assert(vicon._parse_event(stopped, stop.time) is None) # our own packet
+    vicon.close()
+    receiver.close()
 
 if __name__ == '__main__':
     vicon = Vicon()
     vicon.start_recording('File1')
     sleep(5)
-    vicon.stop_recording()
\ No newline at end of file
+    vicon.stop_recording()
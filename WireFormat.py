@@ -0,0 +1,425 @@
+"""
+A fixed-layout binary wire format for passing NumPy arrays between two
+real-time loops.
+
+Every message starts with a 40 byte little-endian header:
+
+    magic      2s  b"NL"
+    version    B   WIRE_VERSION
+    kind       B   DATA, SCHEMA, SCHEMA_REQUEST or DATA_SCHEMA
+    seq        I   sender's 32-bit message counter
+    echo       I   latest seq the sender has received from its peer
+    send_time  d   sender's time.time() when the message was packed
+    hold       d   seconds between receiving message `echo` and packing this one
+    schema_id  I   crc32 of the payload schema (dtype descr and shape)
+    length     I   payload length in bytes
+    checksum   I   crc32 of the payload
+
+DATA payloads are the raw bytes of a C-contiguous array, which may be a
+structured array. The dtype and shape are not repeated in every message:
+the first time a sender uses a schema, and whenever its peer asks with a
+SCHEMA_REQUEST, it sends a SCHEMA message whose payload describes it. The
+receiver caches schemas by id and decodes DATA payloads as views into its
+receive buffer.
+
+Links without a way back to the sender (a bus with many subscribers, or a
+conflated socket that may drop the SCHEMA message) use self-describing
+DATA_SCHEMA messages instead. Their payload is a <H schema text length, the
+schema text, zero padding to a multiple of 8 bytes from the start of the
+message, then the array bytes. They decode as DATA.
+
+WireEndpoint holds the transport-independent half of a synch link (schema
+negotiation, echoes, LinkStats bookkeeping, and the ClockOffsetFilter fed
+by send_time, hold and echo); UdpBinarySynch and ZmqBinarySynch only
+provide the sockets.
+"""
+
+import ast
+import time
+import zlib
+import struct
+import numpy as np
+from LinkStats import LinkStats
+from ClockSync import ClockOffsetFilter
+from StatProfiler import profile_scope
+
+WIRE_MAGIC = b"NL"
+WIRE_VERSION = 2
+DATA, SCHEMA, SCHEMA_REQUEST, DATA_SCHEMA = 0, 1, 2, 3
+HEADER = struct.Struct("<2sBBIIddIII")
+HEADER_SIZE = HEADER.size
+SEQ_MODULUS = 1 << 32
+SCHEMA_LENGTH = struct.Struct("<H")
+
+def _inline_data_offset(text_length):
+    " Offset of the array bytes in a DATA_SCHEMA message "
+    return (HEADER_SIZE + SCHEMA_LENGTH.size + text_length + 7) & ~7
+
+def describe_schema(dtype, shape):
+    " Returns (schema_id, schema_bytes) for arrays of this dtype and shape "
+    text = repr((np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))).encode("ascii")
+    return zlib.crc32(text), text
+
+def parse_schema(text):
+    " Inverse of describe_schema, returns (dtype, shape) "
+    descr, shape = ast.literal_eval(bytes(text).decode("ascii"))
+    return np.lib.format.descr_to_dtype(descr), tuple(shape)
+
+
+class WireCodec():
+    """ Packs outgoing messages into one reusable send buffer and unpacks
+    incoming ones from a pair of reusable receive buffers.
+
+    Receive with sock.recv_into(codec.recv_buffer()), then call
+    codec.unpack(nbytes). When that returns DATA, codec.data_out is a view
+    into the buffer the message arrived in. The two receive buffers swap on
+    every accepted DATA message, so data_out stays valid while the rest of
+    the socket is drained and until the next DATA message is accepted.
+
+    Outgoing messages can start with a constant prefix (e.g. a ZMQ topic),
+    written once here so that packing never concatenates. buff_size is the
+    largest message, not counting the prefix. """
+
+    def __init__(self, buff_size=1024, prefix=b""):
+        self.buff_size = buff_size
+        self.prefix = bytes(prefix)
+        self._h = len(self.prefix) # offset of the header in the send buffer
+        self.send_buf = bytearray(self._h + buff_size)
+        self.send_buf[:self._h] = self.prefix
+        self._send_u8 = np.frombuffer(self.send_buf, dtype=np.uint8)
+        self._send_view = memoryview(self.send_buf)
+        self._recv_bufs = [bytearray(buff_size), bytearray(buff_size)]
+        self._scratch = 0 # index of the buffer the next message is received into
+        self.seq = 0
+        self._send_schema_key = None
+        self.send_schema_id, self._send_schema_text = None, b""
+        self.schema_pending = False # the peer has not been told about the send schema yet
+        self._recv_schemas = dict()
+        self.missing_schema_id = None # id of the last DATA message with an unknown schema
+        self.data_out = None
+        # header of the last message unpacked
+        self.rx_kind = self.rx_seq = self.rx_echo = self.rx_schema_id = None
+        self.rx_send_time = self.rx_hold = float('nan')
+        self.errors = dict(magic=0, version=0, length=0, checksum=0, schema=0)
+
+    ## Sending
+
+    def _pack(self, kind, echo, send_time, hold, schema_id, length):
+        h = self._h
+        self.seq = (self.seq + 1) % SEQ_MODULUS
+        checksum = zlib.crc32(self._send_view[h+HEADER_SIZE:h+HEADER_SIZE+length])
+        HEADER.pack_into(self.send_buf, h, WIRE_MAGIC, WIRE_VERSION, kind, self.seq,
+            echo, send_time, hold, schema_id, length, checksum)
+        return self._send_view[:h+HEADER_SIZE+length]
+
+    def set_send_schema(self, data):
+        """ Adopts the schema of data for sending. Returns True (and sets
+        schema_pending) if it differs from the previous one. """
+        key = (data.dtype, data.shape)
+        if key == self._send_schema_key:
+            return False
+        self._send_schema_key = key
+        self.send_schema_id, self._send_schema_text = describe_schema(*key)
+        self.schema_pending = True
+        return True
+
+    def pack_data(self, data, echo, send_time, hold=0.0, with_schema=False):
+        """ Returns a memoryview of the DATA message, valid until the next
+        pack. with_schema makes it a self-describing DATA_SCHEMA message. """
+        data = np.ascontiguousarray(data)
+        if self.set_send_schema(data) and with_schema:
+            self.schema_pending = False
+        h = self._h
+        offset = _inline_data_offset(len(self._send_schema_text)) if with_schema else HEADER_SIZE
+        length = offset - HEADER_SIZE + data.nbytes
+        if HEADER_SIZE + length > self.buff_size:
+            raise ValueError("%d byte payload does not fit a %d byte message"%(length, self.buff_size))
+        if with_schema:
+            text = self._send_schema_text
+            SCHEMA_LENGTH.pack_into(self.send_buf, h+HEADER_SIZE, len(text))
+            start = h + HEADER_SIZE + SCHEMA_LENGTH.size
+            self.send_buf[start:start+len(text)] = text
+            self._send_u8[start+len(text):h+offset] = 0
+        self._send_u8[h+offset:h+offset+data.nbytes] = data.reshape(-1).view(np.uint8)
+        return self._pack(DATA_SCHEMA if with_schema else DATA, echo, send_time, hold,
+            self.send_schema_id, length)
+
+    def pack_schema(self, echo, send_time, hold=0.0):
+        " Returns a SCHEMA message describing the schema of the last pack_data "
+        length = len(self._send_schema_text)
+        start = self._h + HEADER_SIZE
+        self.send_buf[start:start+length] = self._send_schema_text
+        self.schema_pending = False
+        return self._pack(SCHEMA, echo, send_time, hold, self.send_schema_id, length)
+
+    def pack_schema_request(self, schema_id, echo, send_time, hold=0.0):
+        return self._pack(SCHEMA_REQUEST, echo, send_time, hold, schema_id, 0)
+
+    ## Receiving
+
+    def recv_buffer(self):
+        return self._recv_bufs[self._scratch]
+
+    def unpack(self, nbytes):
+        """ Validates and decodes the message in recv_buffer(). Returns its
+        kind (DATA for DATA_SCHEMA), or None if it was rejected (see
+        self.errors). """
+        buf = self._recv_bufs[self._scratch]
+        header = self.peek(buf, nbytes)
+        if header is None:
+            return None
+        magic, version, kind, seq, echo, send_time, hold, schema_id, length, checksum = header
+        if zlib.crc32(memoryview(buf)[HEADER_SIZE:nbytes]) != checksum:
+            self.errors['checksum'] += 1
+            return None
+        self.rx_kind, self.rx_seq, self.rx_echo = kind, seq, echo
+        self.rx_send_time, self.rx_hold, self.rx_schema_id = send_time, hold, schema_id
+
+        if kind == SCHEMA:
+            dtype, shape = parse_schema(memoryview(buf)[HEADER_SIZE:nbytes])
+            self._recv_schemas[schema_id] = (dtype, shape, int(np.prod(shape)))
+            if self.missing_schema_id == schema_id:
+                self.missing_schema_id = None
+        elif kind == DATA or kind == DATA_SCHEMA:
+            offset = HEADER_SIZE
+            if kind == DATA_SCHEMA:
+                text_length, = SCHEMA_LENGTH.unpack_from(buf, HEADER_SIZE)
+                offset = _inline_data_offset(text_length)
+                if offset > nbytes:
+                    self.errors['length'] += 1
+                    return None
+                if schema_id not in self._recv_schemas:
+                    start = HEADER_SIZE + SCHEMA_LENGTH.size
+                    dtype, shape = parse_schema(memoryview(buf)[start:start+text_length])
+                    self._recv_schemas[schema_id] = (dtype, shape, int(np.prod(shape)))
+                self.rx_kind = kind = DATA
+            schema = self._recv_schemas.get(schema_id)
+            if schema is None:
+                self.errors['schema'] += 1
+                self.missing_schema_id = schema_id
+                return None
+            dtype, shape, count = schema
+            if count*dtype.itemsize != nbytes - offset:
+                self.errors['length'] += 1
+                return None
+            self.data_out = np.frombuffer(buf, dtype=dtype, count=count, offset=offset).reshape(shape)
+            self._scratch = 1 - self._scratch
+        return kind
+
+    def peek(self, buf, nbytes):
+        """ Checks the magic, version and length of the message in buf (any
+        buffer, not only recv_buffer()) but not its checksum. Returns the
+        header tuple, or None if it was rejected (see self.errors). """
+        if nbytes < HEADER_SIZE:
+            self.errors['length'] += 1
+            return None
+        header = HEADER.unpack_from(buf, 0)
+        if header[0] != WIRE_MAGIC:
+            self.errors['magic'] += 1
+            return None
+        if header[1] != WIRE_VERSION:
+            self.errors['version'] += 1
+            return None
+        if HEADER_SIZE + header[8] != nbytes:
+            self.errors['length'] += 1
+            return None
+        return header
+
+    def knows_schema(self, schema_id):
+        return schema_id in self._recv_schemas
+
+
+class WireEndpoint():
+    """ One end of a synch link. Subclasses provide _send_bytes(message) and
+    _recv_into(buffer), which returns the message size or None when nothing
+    is pending. update(data_in) reads all messages, then sends data_in.
+
+    Subclasses that can receive many messages in one call may also set
+    self._batch_bufs (a list of buffers) and self._batch_sizes, and provide
+    _recv_batch(), which fills them and returns the number of messages. With
+    latest_only, drain() then fully decodes only the newest DATA message of
+    each batch; the older ones are counted from their headers alone. """
+
+    def __init__(self, name, buff_size=1024, latest_only=False):
+        self.codec = WireCodec(buff_size)
+        self.stats = LinkStats(name)
+        self.clock = ClockOffsetFilter()
+        self.latest_only = latest_only
+        self._batch_bufs = None
+        self._batch_sizes = None
+        self.data_out = None
+        self.peer_seq = 0 # latest sequence number received from the peer, echoed back
+        self._peer_recv_time = None
+        self._peer_wants_schema = False
+
+    def _send_bytes(self, message):
+        raise NotImplementedError()
+
+    def _recv_into(self, buffer):
+        raise NotImplementedError()
+
+    def _recv_batch(self):
+        raise NotImplementedError()
+
+    def _hold(self, now):
+        return 0.0 if self._peer_recv_time is None else now - self._peer_recv_time
+
+    def _on_peer_message(self, seq, echo, send_time, hold, t_recv):
+        self.stats.on_receive(seq, echo, hold, t_recv)
+        t_sent = self.stats.sent_at(echo)
+        if t_sent is not None:
+            self.clock.update_exchange(t_sent, send_time, hold, t_recv)
+        self.peer_seq, self._peer_recv_time = seq, t_recv
+
+    def peer_to_local(self, t_peer):
+        """ Maps a time.time() reading of the peer (e.g. a timestamp in its
+        log) onto the local clock. nan until the first round trip. """
+        return self.clock.to_local(t_peer)
+
+    def local_to_peer(self, t_local):
+        return self.clock.to_peer(t_local)
+
+    def _send_message(self, message):
+        self._send_bytes(message)
+        self.stats.on_send(self.codec.seq, self._last_pack_time)
+
+    def drain(self):
+        """ Reads every pending message, keeping the newest valid DATA payload
+        in self.data_out (a view, valid until the next update) """
+        if self.latest_only and self._batch_bufs is not None:
+            return self._drain_batched()
+        codec, stats = self.codec, self.stats
+        n_data = 0
+        while True:
+            nbytes = self._recv_into(codec.recv_buffer())
+            if nbytes is None:
+                break
+            t_recv = time.time()
+            kind = codec.unpack(nbytes)
+            if kind is None:
+                stats.rejected += 1
+                continue
+            self._on_peer_message(codec.rx_seq, codec.rx_echo, codec.rx_send_time, codec.rx_hold, t_recv)
+            if kind == DATA:
+                self.data_out = codec.data_out
+                n_data += 1
+            elif kind == SCHEMA_REQUEST:
+                self._peer_wants_schema = True
+        return self._finish_drain(n_data)
+
+    def _drain_batched(self):
+        codec, stats = self.codec, self.stats
+        bufs, sizes = self._batch_bufs, self._batch_sizes
+        n_data = 0
+        while True:
+            n = self._recv_batch()
+            if n == 0:
+                break
+            t_recv = time.time()
+            newest, n_batch_data = -1, 0
+            for i in range(n):
+                nbytes = sizes[i]
+                header = codec.peek(bufs[i], nbytes)
+                if header is None:
+                    stats.rejected += 1
+                    continue
+                kind = header[2]
+                if kind == DATA:
+                    newest = i
+                    n_batch_data += 1
+                else: # SCHEMA and SCHEMA_REQUEST are rare, decode them in order
+                    codec.recv_buffer()[:nbytes] = bufs[i][:nbytes]
+                    if codec.unpack(nbytes) is None:
+                        stats.rejected += 1
+                        continue
+                    if kind == SCHEMA_REQUEST:
+                        self._peer_wants_schema = True
+                self._on_peer_message(header[3], header[4], header[5], header[6], t_recv)
+            n_data += n_batch_data
+            for i in range(newest, -1, -1): # older ones only if the newest is corrupt
+                nbytes = sizes[i]
+                if nbytes < HEADER_SIZE or bufs[i][3] != DATA:
+                    continue
+                codec.recv_buffer()[:nbytes] = bufs[i][:nbytes]
+                if codec.unpack(nbytes) == DATA:
+                    self.data_out = codec.data_out
+                    break
+                stats.rejected += 1
+            if n < len(bufs):
+                break
+        return self._finish_drain(n_data)
+
+    def _finish_drain(self, n_data):
+        codec = self.codec
+        self.stats.on_drain(n_data)
+        if codec.missing_schema_id is not None:
+            self._last_pack_time = now = time.time()
+            self._send_message(codec.pack_schema_request(codec.missing_schema_id,
+                self.peer_seq, now, self._hold(now)))
+        return self.data_out
+
+    def send_data(self, data_in):
+        codec = self.codec
+        data_in = np.ascontiguousarray(data_in)
+        codec.set_send_schema(data_in)
+        if codec.schema_pending or self._peer_wants_schema:
+            self._last_pack_time = now = time.time()
+            self._send_message(codec.pack_schema(self.peer_seq, now, self._hold(now)))
+            self._peer_wants_schema = False
+        self._last_pack_time = now = time.time()
+        self._send_message(codec.pack_data(data_in, self.peer_seq, now, self._hold(now)))
+
+    def update(self, data_in):
+        """ read all messages, then send data."""
+        _PROF_UPDATE.start()
+        try:
+            _PROF_DRAIN.start()
+            self.drain()
+            _PROF_DRAIN.stop()
+            _PROF_SEND.start()
+            self.send_data(data_in)
+            _PROF_SEND.stop()
+        finally:
+            _PROF_UPDATE.stop()
+        return self.data_out
+
+_PROF_UPDATE = profile_scope("WireEndpoint.update")
+_PROF_DRAIN = profile_scope("WireEndpoint.drain")
+_PROF_SEND = profile_scope("WireEndpoint.send_data")
+
+
+def test_wire_codec():
+    tx, rx = WireCodec(), WireCodec()
+    def transfer(message):
+        rx.recv_buffer()[:len(message)] = message
+        return rx.unpack(len(message))
+    data = np.array([42.1, 3.0])
+    # data before its schema is rejected, the schema then unlocks it
+    assert(transfer(tx.pack_data(data, 0, 1.5)) is None and rx.errors['schema'] == 1)
+    assert(tx.schema_pending and transfer(tx.pack_schema(0, 1.5)) == SCHEMA)
+    assert(transfer(tx.pack_data(data, 7, 2.5)) == DATA)
+    assert(np.array_equal(rx.data_out, data) and rx.rx_echo == 7 and rx.rx_send_time == 2.5)
+    kept = rx.data_out
+    # a structured array from several subsystems
+    record = np.zeros(3, dtype=[("ankle", "<f4", (2,)), ("state", "<u1"), ("t", "<f8")])
+    record["ankle"][1] = (1.0, 2.0)
+    transfer(tx.pack_data(record, 0, 3.0))
+    transfer(tx.pack_schema(0, 3.0))
+    assert(transfer(tx.pack_data(record, 0, 3.0)) == DATA)
+    assert(rx.data_out.dtype == record.dtype and rx.data_out["ankle"][1, 1] == 2.0)
+    assert(np.array_equal(kept, data)) # still valid, the buffers were swapped
+    # corruption is caught
+    message = bytearray(tx.pack_data(record, 0, 3.0))
+    message[-1] ^= 0xFF
+    assert(transfer(message) is None and rx.errors['checksum'] == 1)
+    assert(tx.seq == 7)
+    # self-describing messages, sent behind a topic prefix
+    tx, rx = WireCodec(prefix=b"exo\0"), WireCodec()
+    message = tx.pack_data(record, 0, 4.0, with_schema=True)
+    assert(bytes(message[:4]) == b"exo\0" and not tx.schema_pending)
+    assert(transfer(message[4:]) == DATA and rx.data_out["ankle"][1, 1] == 2.0)
+    assert(transfer(tx.pack_data(data, 0, 4.0, with_schema=True)[4:]) == DATA)
+    assert(np.array_equal(rx.data_out, data))
+
+if __name__ == '__main__':
+    test_wire_codec()
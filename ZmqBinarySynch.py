@@ -1,66 +1,51 @@
 """
 Objects for passing data between two real-time loops.
+
+Same wire format and LinkStats instrumentation as UdpBinarySynch, carried
+over a ZMQ PUB/SUB pair. Each SUB socket connects to exactly one peer, so it
+subscribes to everything instead of filtering on a topic byte. For more
+than two machines, see ZmqBus.
 """
 
 import zmq
 import numpy as np
-
-
-
-class ZmqBinarySynchB:
-    def __init__(self, bindport="tcp://*:5558", connectport="tcp://localhost:5557"):
-        self.context = zmq.Context()
-        self.socketB = self.context.socket(zmq.PUB)
-        self.socketB.bind(bindport)
-
-        self.socketA = self.context.socket(zmq.SUB)
-        self.socketA.setsockopt(zmq.SUBSCRIBE, b'A')
-        self.socketA.connect(connectport)
-
-        self.my_count = 0
-        self.data_out = None
-
-
-    def update(self, data_in):
-        """ read all messages, then send data."""
-        while True:
-            try: 
-                message = self.socketA.recv(zmq.NOBLOCK)
-            
-                if int(message[1:4])==self.my_count:
-                    self.my_count+=1
-                    if self.my_count>=1000:
-                        self.my_count=0
-                self.data_out = np.frombuffer(message[4:])
-            except zmq.error.Again:
-                break
-    
-        self.socketB.send(b"B%03d%s"%(self.my_count, data_in.tobytes()))
-        return self.data_out
-
-class ZmqBinarySynchA:
-    def __init__(self, bindport="tcp://*:5557", connectport="tcp://localhost:5558"):
-        self.context = zmq.Context()
-        self.socketA = self.context.socket(zmq.PUB)
-        self.socketA.bind(bindport)
-
-        self.socketB = self.context.socket(zmq.SUB)
-        self.socketB.setsockopt(zmq.SUBSCRIBE, b'B')
-        self.socketB.connect(connectport)
-
-        self.my_count = -42
-        self.data_out = None
-
-    def update(self, data_in):
-        """ read all messages, then send data. """
-        while True:
-            try: 
-                message = self.socketB.recv(zmq.NOBLOCK)
-                self.my_count=int(message[1:4])
-                self.data_out = np.frombuffer(message[4:])
-            except zmq.error.Again:
-                break
-        self.socketA.send(b"A%03d%s"%(self.my_count, data_in.tobytes()))
-
-        return self.data_out
-    
\ No newline at end of file
+from WireFormat import WireEndpoint
+
+
+class ZmqBase(WireEndpoint):
+    def __init__(self, bindport, connectport, buff_size=1024):
+        super().__init__("ZMQ %s => %s"%(connectport, bindport), buff_size=buff_size)
+        self.context = zmq.Context.instance() # one per process, shared with ZmqBus
+        self.pub_socket = self.context.socket(zmq.PUB)
+        self.pub_socket.bind(bindport)
+
+        self.sub_socket = self.context.socket(zmq.SUB)
+        self.sub_socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self.sub_socket.connect(connectport)
+
+    def _send_bytes(self, message):
+        self.pub_socket.send(message)
+
+    def _recv_into(self, buffer):
+        try:
+            frame = self.sub_socket.recv(zmq.NOBLOCK, copy=False)
+        except zmq.error.Again:
+            return None
+        nbytes = min(len(frame.buffer), len(buffer))
+        buffer[:nbytes] = frame.buffer[:nbytes]
+        return len(frame.buffer)
+
+    def close(self):
+        self.pub_socket.close(linger=0)
+        self.sub_socket.close(linger=0)
+
+
+class ZmqBinarySynchB(ZmqBase):
+    def __init__(self, bindport="tcp://*:5558", connectport="tcp://localhost:5557", **kwargs):
+        super().__init__(bindport, connectport, **kwargs)
+        self.socketB, self.socketA = self.pub_socket, self.sub_socket
+
+class ZmqBinarySynchA(ZmqBase):
+    def __init__(self, bindport="tcp://*:5557", connectport="tcp://localhost:5558", **kwargs):
+        super().__init__(bindport, connectport, **kwargs)
+        self.socketA, self.socketB = self.pub_socket, self.sub_socket
@@ -0,0 +1,322 @@
+"""
+A named-topic publish/subscribe data bus over ZMQ, for sharing state between
+several machines (e.g. the exo Pi, the tablet and the treadmill PC) without
+a socket pair per link.
+
+Every node has one PUB socket and reads through SUB sockets, all from the
+process-wide zmq.Context.instance(). Nodes either bind their PUB and connect
+their SUBs to every other node, or all connect to a ZmqBusProxy, which costs
+each node one connection per direction however many nodes there are.
+
+A message is a single ZMQ frame: the topic name, a zero byte, the name of
+the publishing node, another zero byte, then a self-describing WireFormat
+DATA_SCHEMA message. Single frames are what make ZMQ_CONFLATE usable. A
+conflated topic gets a SUB socket of its own, which only ever holds that
+topic's newest message; the other topics share one SUB socket with a
+high-water mark. A topic can have several publishers, and since each
+numbers its messages on its own, link statistics are kept per publisher.
+poll() checks all of them with one zmq.Poller call and never blocks unless
+asked to.
+
+    bus = ZmqBus("exo", bind=["tcp://*:5570"], sub_connect=["tcp://tablet:5570"])
+    bus.subscribe("tablet/command", conflate=True)
+    for t in SoftRealtimeLoop(0.001):
+        bus.publish("exo/state", state)
+        for topic in bus.poll():
+            ...
+        command = bus.latest("tablet/command")
+"""
+
+import time
+import threading
+import zmq
+import numpy as np
+from WireFormat import WireCodec, DATA
+from LinkStats import LinkStats
+
+_MAX_NAME = 255 # bytes of a publishing node's name
+
+def _prefix(topic):
+    return topic.encode("utf-8") + b"\0"
+
+
+class BusTopic():
+    """ Receive state of one subscribed topic. data_out is a view that stays
+    valid until the next message on this topic is decoded, and sender names
+    the node that published it. senders maps each publisher's name to its
+    LinkStats, which count loss from sequence gaps; for a conflated topic
+    that includes every message conflation replaced. """
+    def __init__(self, name, conflate, buff_size):
+        self.name = name
+        self.prefix = _prefix(name)
+        self.conflate = conflate
+        self.codec = WireCodec(buff_size)
+        self.senders = dict() # publisher name -> LinkStats
+        self._by_sender = dict() # publisher name as received -> (name, LinkStats)
+        self.rejected = 0 # bad messages, from any publisher
+        self.data_out = None
+        self.sender = None
+        self.recv_time = float('nan') # local time.time() of the last message
+        self.send_time = float('nan') # the publisher's time.time() for it
+
+    def stats_for(self, sender):
+        """ (name, LinkStats) of the publisher named sender (bytes as
+        received), created on its first message """
+        known = self._by_sender.get(sender)
+        if known is None:
+            name = sender.decode("utf-8", "replace")
+            self.senders[name] = LinkStats("ZMQ bus %s from %s"%(self.name, name))
+            known = self._by_sender[sender] = (name, self.senders[name])
+        return known
+
+    def report(self):
+        for stats in self.senders.values():
+            stats.report()
+        if not self.senders:
+            print("ZMQ bus %s: nothing received, %d rejected"%(self.name, self.rejected))
+
+
+class ZmqBus():
+    def __init__(self, name, bind=(), pub_connect=(), sub_connect=(), buff_size=1024,
+            send_hwm=100, recv_hwm=100, context=None):
+        """ name identifies this node as a publisher, and must be unique on
+        the bus. bind and pub_connect are endpoints for the PUB socket,
+        sub_connect the endpoints every SUB socket connects to (publishers,
+        or a proxy's backend). The HWMs cap how many messages queue per
+        peer. """
+        sender = name.encode("utf-8")
+        if b"\0" in sender or len(sender) > _MAX_NAME:
+            raise ValueError("a bus node name has at most %d bytes and no zero byte"%_MAX_NAME)
+        self.name = name
+        self._sender_prefix = _prefix(name)
+        self.context = context if context is not None else zmq.Context.instance()
+        self.buff_size = buff_size
+        self.recv_hwm = recv_hwm
+        self.pub = self.context.socket(zmq.PUB)
+        self.pub.setsockopt(zmq.SNDHWM, send_hwm)
+        self.pub.setsockopt(zmq.LINGER, 0)
+        for endpoint in bind:
+            self.pub.bind(endpoint)
+        for endpoint in pub_connect:
+            self.pub.connect(endpoint)
+        self.sub_endpoints = list(sub_connect)
+        self.topics = dict() # name -> BusTopic
+        self._socket_topics = dict() # SUB socket -> list of its BusTopics
+        self._shared_sub = None
+        self._poller = zmq.Poller()
+        self._pub_codecs = dict() # name -> WireCodec, with the topic prefix built in
+        self.rejected = 0 # frames with an unknown topic or a bad message
+
+    ## Publishing
+
+    def publish(self, topic, data):
+        codec = self._pub_codecs.get(topic)
+        if codec is None:
+            codec = self._pub_codecs[topic] = WireCodec(self.buff_size,
+                prefix=_prefix(topic) + self._sender_prefix)
+        self.pub.send(codec.pack_data(data, 0, time.time(), with_schema=True)) # copies, the buffer is reused
+
+    ## Subscribing
+
+    def _new_sub(self, hwm):
+        sock = self.context.socket(zmq.SUB)
+        sock.setsockopt(zmq.RCVHWM, hwm)
+        sock.setsockopt(zmq.LINGER, 0)
+        return sock
+
+    def subscribe(self, topic, conflate=False):
+        """ conflate keeps only the newest message of the topic, for values
+        where only the latest matters (commands, set points) """
+        if topic in self.topics:
+            raise ValueError("already subscribed to %s"%topic)
+        entry = BusTopic(topic, conflate, self.buff_size)
+        if conflate:
+            sock = self._new_sub(1)
+            sock.setsockopt(zmq.CONFLATE, 1) # before connecting
+        else:
+            sock = self._shared_sub
+        if sock is None:
+            sock = self._shared_sub = self._new_sub(self.recv_hwm)
+        if sock not in self._socket_topics:
+            for endpoint in self.sub_endpoints:
+                sock.connect(endpoint)
+            self._socket_topics[sock] = []
+            self._poller.register(sock, zmq.POLLIN)
+        sock.setsockopt(zmq.SUBSCRIBE, entry.prefix)
+        self._socket_topics[sock].append(entry)
+        self.topics[topic] = entry
+        return entry
+
+    def connect(self, endpoint):
+        " Adds a publisher (or proxy backend) for all current and future subscriptions "
+        self.sub_endpoints.append(endpoint)
+        for sock in self._socket_topics:
+            sock.connect(endpoint)
+
+    ## Receiving
+
+    def _receive(self, sock, topics, updated):
+        while sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            frame = sock.recv(copy=False)
+            t_recv = time.time()
+            buf = frame.buffer
+            for entry in topics:
+                n = len(entry.prefix)
+                if buf[:n] == entry.prefix:
+                    break
+            else:
+                self.rejected += 1
+                continue
+            sender_length = buf[n:n+_MAX_NAME+1].tobytes().find(b"\0")
+            if sender_length < 0:
+                self.rejected += 1
+                entry.rejected += 1
+                continue
+            sender = buf[n:n+sender_length].tobytes()
+            n += sender_length + 1
+            codec = entry.codec
+            nbytes = len(buf) - n
+            sender, stats = entry.stats_for(sender)
+            if nbytes > self.buff_size:
+                self.rejected += 1
+                entry.rejected += 1
+                stats.rejected += 1
+                continue
+            codec.recv_buffer()[:nbytes] = buf[n:]
+            if codec.unpack(nbytes) != DATA:
+                self.rejected += 1
+                entry.rejected += 1
+                stats.rejected += 1
+                continue
+            stats.on_receive(codec.rx_seq, codec.rx_echo, 0.0, t_recv)
+            entry.data_out = codec.data_out
+            entry.sender = sender
+            entry.recv_time, entry.send_time = t_recv, codec.rx_send_time
+            if entry.name not in updated:
+                updated.append(entry.name)
+
+    def poll(self, timeout=0):
+        """ Receives everything pending on all subscribed topics. Waits up to
+        timeout milliseconds (None: forever) for the first message. Returns
+        the names of the topics that got new data. """
+        updated = []
+        for sock, _ in self._poller.poll(timeout):
+            self._receive(sock, self._socket_topics[sock], updated)
+        return updated
+
+    def latest(self, topic):
+        " Newest data on a subscribed topic, or None before the first message "
+        return self.topics[topic].data_out
+
+    ## Cleanup
+
+    def close(self):
+        for sock in self._socket_topics:
+            self._poller.unregister(sock)
+            sock.close()
+        self._socket_topics.clear()
+        self._shared_sub = None
+        self.pub.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.close()
+
+
+class ZmqBusProxy():
+    """ A forwarder every bus node can connect to instead of to each other:
+    nodes publish to frontend (pub_connect) and subscribe from backend
+    (sub_connect). Runs in a daemon thread of whichever process hosts it.
+    Subscriptions are forwarded upstream, so only wanted topics travel. """
+    def __init__(self, frontend="tcp://*:5570", backend="tcp://*:5571", context=None, hwm=1000):
+        self.context = context if context is not None else zmq.Context.instance()
+        self.frontend = self.context.socket(zmq.XSUB)
+        self.backend = self.context.socket(zmq.XPUB)
+        for sock in (self.frontend, self.backend):
+            sock.setsockopt(zmq.SNDHWM, hwm)
+            sock.setsockopt(zmq.RCVHWM, hwm)
+            sock.setsockopt(zmq.LINGER, 0)
+        self.frontend.bind(frontend)
+        self.backend.bind(backend)
+        self.forwarded = 0
+        self._running = True
+        self.thread = threading.Thread(target=self._run, name="ZmqBusProxy", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+        while self._running:
+            for sock, _ in poller.poll(100):
+                if sock is self.frontend:
+                    self.backend.send_multipart(self.frontend.recv_multipart(copy=False), copy=False)
+                    self.forwarded += 1
+                else: # (un)subscriptions travel upstream
+                    self.frontend.send_multipart(self.backend.recv_multipart(copy=False), copy=False)
+
+    def close(self):
+        self._running = False
+        self.thread.join()
+        self.frontend.close()
+        self.backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.close()
+
+
+def test_zmq_bus():
+    state = np.array([1.0, 2.0, 3.0])
+    # direct: two publishers, one subscriber
+    with ZmqBus("tablet", bind=["inproc://tablet"]) as tablet, \
+            ZmqBus("treadmill", bind=["inproc://treadmill"]) as treadmill, \
+            ZmqBus("exo", sub_connect=["inproc://tablet", "inproc://treadmill"]) as exo:
+        exo.subscribe("tablet/command", conflate=True)
+        exo.subscribe("treadmill/speed")
+        exo.subscribe("treadmill/speed2")
+        time.sleep(0.05) # subscriptions reach the publishers asynchronously
+        for i in range(5):
+            tablet.publish("tablet/command", np.array([float(i)]))
+            treadmill.publish("treadmill/speed", state*i)
+        treadmill.publish("treadmill/speed2", np.zeros(2, dtype=[("belt", "<f4"), ("incline", "<f4")]))
+        time.sleep(0.05)
+        assert(sorted(exo.poll()) == ["tablet/command", "treadmill/speed", "treadmill/speed2"])
+        assert(exo.latest("tablet/command")[0] == 4.0) # conflated to the newest
+        assert(np.array_equal(exo.latest("treadmill/speed"), state*4))
+        assert(exo.topics["treadmill/speed"].senders["treadmill"].received == 5)
+        assert(exo.topics["treadmill/speed"].sender == "treadmill")
+        assert(exo.latest("treadmill/speed2").dtype.names == ("belt", "incline"))
+        assert(exo.poll() == [] and exo.rejected == 0)
+    # through a proxy
+    with ZmqBusProxy("inproc://bus_in", "inproc://bus_out") as proxy, \
+            ZmqBus("tablet", pub_connect=["inproc://bus_in"]) as tablet, \
+            ZmqBus("exo", pub_connect=["inproc://bus_in"], sub_connect=["inproc://bus_out"]) as exo:
+        exo.subscribe("tablet/command")
+        t_end = time.time() + 2.0
+        while exo.latest("tablet/command") is None and time.time() < t_end:
+            tablet.publish("tablet/command", state)
+            exo.poll(10)
+        assert(np.array_equal(exo.latest("tablet/command"), state) and proxy.forwarded > 0)
+    # one topic, several publishers each with their own sequence numbers
+    with ZmqBus("left", bind=["inproc://left"]) as left, \
+            ZmqBus("right", bind=["inproc://right"]) as right, \
+            ZmqBus("logger", sub_connect=["inproc://left", "inproc://right"]) as logger:
+        topic = logger.subscribe("ankle/state")
+        time.sleep(0.05)
+        for i in range(20):
+            left.publish("ankle/state", np.array([float(i)]))
+            if i % 2 == 0:
+                right.publish("ankle/state", np.array([-float(i)]))
+        time.sleep(0.05)
+        assert(logger.poll() == ["ankle/state"] and sorted(topic.senders) == ["left", "right"])
+        for name, n in [("left", 20), ("right", 10)]:
+            stats = topic.senders[name]
+            assert((stats.received, stats.lost, stats.reordered, stats.duplicates) == (n, 0, 0, 0))
+
+if __name__ == '__main__':
+    test_zmq_bus()
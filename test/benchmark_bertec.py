@@ -0,0 +1,108 @@
+""" Offline measurements of the Bertec reader, against BertecSim instead of
+the treadmill PC:
+  - parse throughput of BertecStreamParser for different read sizes, next to
+    the old one-list-per-packet parse,
+  - latency from the simulator sending a packet to the client publishing it,
+    for each transport, with the simulator streaming at 1 kHz. """
+from FindLibrariesWarning import *
+from BertecMan import Bertec, BertecStreamParser, BERTEC_PACKET_SIZE
+from BertecSim import BertecSimulator
+import numpy as np
+import asyncio
+import struct
+import time
+
+N_PACKETS = 100000
+RATE = 1000.0
+DURATION = 2.0
+
+def make_stream(n):
+    packets = np.zeros((n, BERTEC_PACKET_SIZE), dtype=np.uint8)
+    for i in range(n):
+        struct.pack_into(">hh4xh", packets[i], 1, 1200+i%7, 1190, 250)
+    return packets.tobytes()
+
+def legacy_parse(stream):
+    " The per-packet parse the reader thread used to do "
+    for k in range(0, len(stream), 32):
+        data = list(stream[k:k+32])
+        belt_speedR = int.from_bytes(data[1:3],'big', signed=True)/1000
+        belt_speedL = int.from_bytes(data[3:5],'big', signed=True)/1000
+        belt_speed = [belt_speedL, belt_speedR]
+        incline = int.from_bytes(data[9:11],'big',signed=True)/100.0
+        np.mean(belt_speed)*np.sin(np.deg2rad(incline))
+        np.abs(np.mean(belt_speed))
+
+def parse_throughput():
+    stream = make_stream(N_PACKETS)
+    t0 = time.perf_counter()
+    legacy_parse(stream)
+    print("legacy parse: %.2f us/packet"%((time.perf_counter()-t0)/N_PACKETS*1e6))
+    view = memoryview(stream)
+    for chunk in (32, 45, 4096):
+        parser = BertecStreamParser(capacity=256)
+        t0 = time.perf_counter()
+        for k in range(0, len(stream), chunk):
+            parser.feed(view[k:k+chunk])
+        dt = time.perf_counter()-t0
+        assert(parser.packets == N_PACKETS)
+        print("BertecStreamParser, %4d byte reads: %.2f us/packet, %.2f us/read"%(
+            chunk, dt/N_PACKETS*1e6, dt/(len(stream)/chunk)*1e6))
+
+def latencies(sim, samples):
+    " Send-to-publish latency of each sampled BertecState "
+    samples = np.array(samples)
+    counters = np.round(samples[:,1]*1000).astype(int)
+    return samples[:,0] - sim.sent_times[counters]
+
+def sample_state(bertec, samples, last):
+    state = bertec.state
+    if state.packets != last:
+        samples.append((state.time, state.belt_speed[1]))
+    return state.packets
+
+def run_thread(sim):
+    bertec = Bertec("127.0.0.1", sim.port, transport="thread").start()
+    samples, last = [], 0
+    t_end = time.time() + DURATION
+    while time.time() < t_end:
+        last = sample_state(bertec, samples, last)
+        time.sleep(0.0002)
+    bertec.close()
+    return samples
+
+def run_poll(sim):
+    bertec = Bertec("127.0.0.1", sim.port, transport="poll")
+    samples, last = [], 0
+    t_end = time.time() + DURATION
+    while time.time() < t_end:
+        bertec.poll(0.001)
+        last = sample_state(bertec, samples, last)
+    bertec.close()
+    return samples
+
+def run_asyncio(sim):
+    async def main():
+        bertec = Bertec("127.0.0.1", sim.port, transport="asyncio")
+        reader = asyncio.create_task(bertec.run_async())
+        samples, last = [], 0
+        t_end = time.time() + DURATION
+        while time.time() < t_end:
+            last = sample_state(bertec, samples, last)
+            await asyncio.sleep(0.0002)
+        bertec.stop()
+        await reader
+        bertec.close()
+        return samples
+    return asyncio.run(main())
+
+def main():
+    parse_throughput()
+    for name, run in (("thread", run_thread), ("poll", run_poll), ("asyncio", run_asyncio)):
+        with BertecSimulator(port=0, rate=RATE, counter=True) as sim:
+            lat = latencies(sim, run(sim))
+            print("%-7s transport: %d states, latency median %.0f us, p99 %.0f us"%(
+                name, len(lat), np.median(lat)*1e6, np.percentile(lat, 99)*1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+""" Compares the same-host synch transports: loopback UDP, ZMQ over TCP and
+shared memory. Reports the cost of one update() call, and the round-trip
+time of a ping-pong between two programs that both busy-poll, the peer
+replying to each new message once.
+
+On a single-core container, shm update() measured about 4 to 5 us, against
+15 us for udp and 36 us for zmq, and the shm ping-pong RTT median 12 to
+28 us from run to run. """
+from FindLibrariesWarning import *
+from UdpBinarySynch import UdpBinarySynchA, UdpBinarySynchB
+from ZmqBinarySynch import ZmqBinarySynchA, ZmqBinarySynchB
+from ShmBinarySynch import ShmBinarySynchA, ShmBinarySynchB
+import subprocess
+import sys
+import numpy as np
+import time
+import os
+
+TRANSPORTS = {
+    "udp": (UdpBinarySynchA, dict(recv_IP="127.0.0.1", recv_port=5557, send_IP="127.0.0.1", send_port=5558),
+            UdpBinarySynchB, dict(recv_IP="127.0.0.1", recv_port=5558, send_IP="127.0.0.1", send_port=5557)),
+    "zmq": (ZmqBinarySynchA, dict(bindport="tcp://*:5557", connectport="tcp://localhost:5558"),
+            ZmqBinarySynchB, dict(bindport="tcp://*:5558", connectport="tcp://localhost:5557")),
+    "shm": (ShmBinarySynchA, dict(name="neuroloco_bench"),
+            ShmBinarySynchB, dict(name="neuroloco_bench")),
+}
+N = 20000
+N_PING = 2000
+# give the CPU away between polls, otherwise on a host with fewer cores than
+# busy loops the round trip measures the scheduler time slice
+yield_cpu = getattr(os, "sched_yield", lambda: time.sleep(0))
+
+def close(synch):
+    if hasattr(synch, "close"):
+        synch.close()
+
+def update_cost(name):
+    A, kwA, B, kwB = TRANSPORTS[name]
+    a, b = A(**kwA), B(**kwB)
+    data = np.array([42.1, 0.0])
+    time.sleep(0.2) # lets zmq subscriptions connect
+    t0 = time.perf_counter()
+    for i in range(N):
+        data[1] = i
+        a.update(data)
+        b.update(data)
+    dt = (time.perf_counter()-t0)/(2*N)
+    close(a)
+    close(b)
+    return dt
+
+def echo_peer(name, duration):
+    " Busy-polls and sends each new ping straight back "
+    _, _, B, kwB = TRANSPORTS[name]
+    b = B(**kwB)
+    echo = np.array([0.0])
+    t_end = time.time()+duration
+    while time.time() < t_end:
+        out = b.drain()
+        if out is not None and out[0] != echo[0]:
+            echo[0] = out[0]
+            b.send_data(echo)
+        else:
+            yield_cpu()
+    close(b)
+
+def ping_pong(name):
+    A, kwA, _, _ = TRANSPORTS[name]
+    a = A(**kwA)
+    # a separate program, like the two loops this is meant for
+    peer = subprocess.Popen([sys.executable, __file__, "--peer", name, str(2.0+N_PING*1e-3)],
+        stdout=subprocess.DEVNULL)
+    time.sleep(1.0)
+    ping = np.array([0.0])
+    rtts = []
+    for i in range(1, N_PING+1):
+        ping[0] = i
+        t0 = time.perf_counter()
+        a.send_data(ping)
+        out = a.drain()
+        while out is None or out[0] != i:
+            if time.perf_counter()-t0 > 0.01:
+                break
+            yield_cpu()
+            out = a.drain()
+        else:
+            rtts.append(time.perf_counter()-t0)
+    peer.wait()
+    close(a)
+    return np.array(rtts)
+
+def udp_drain_cost(latest_only, backlog=16, n=2000):
+    " Cost of one drain() when the peer has sent `backlog` messages since the last one "
+    _, kwA, _, kwB = TRANSPORTS["udp"]
+    a, b = UdpBinarySynchA(**kwA), UdpBinarySynchB(latest_only=latest_only, **kwB)
+    data = np.array([42.1, 0.0])
+    total = 0.0
+    for i in range(n):
+        for j in range(backlog):
+            data[1] = j
+            a.send_data(data)
+        t0 = time.perf_counter()
+        b.drain()
+        total += time.perf_counter()-t0
+    a.recv_sock.close()
+    b.recv_sock.close()
+    return total/n
+
+def main():
+    for backlog in (1, 16):
+        print("udp drain of %d pending: one at a time %.1f us, latest_only %.1f us"%(
+            backlog, udp_drain_cost(False, backlog)*1e6, udp_drain_cost(True, backlog)*1e6))
+    for name in TRANSPORTS:
+        cost = update_cost(name)
+        rtts = ping_pong(name)
+        print("%s: update() %.2f us, ping-pong RTT median %.1f us, p99 %.1f us (%d/%d answered)"%(
+            name, cost*1e6, np.median(rtts)*1e6, np.percentile(rtts, 99)*1e6, len(rtts), N_PING))
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == "--peer":
+        echo_peer(sys.argv[2], float(sys.argv[3]))
+    else:
+        main()
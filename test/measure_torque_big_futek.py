@@ -2,24 +2,30 @@
 from FindLibrariesWarning import *
 from SoftRealtimeLoop import SoftRealtimeLoop
 from AdcManager import AdcManager
+from SensorConversion import SensorConversion, FUTEK_100NM
 import csv
+import time
 
 class Big100NmFutek(AdcManager):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.torque = SensorConversion.from_spec(FUTEK_100NM)
 
     def get_torque(self):
-        return (self.volts-2.5)*40.
+        return self.torque(self.volts)
 
 def measure_torque(adc):
     adc.update()
+    time.sleep(0.5) # zero on the first half second, the sensor should be unloaded
+    adc.torque.zero(adc.window(400)[1][:, 0])
     print("Testing adc Futek sensor (100 Nm max). Press CTRL-C to finish now.")
     loop = SoftRealtimeLoop(dt = 0.00333333333, report=True)
     for i, t in enumerate(loop):
         adc.update()
         if i%100==0:
-            print ("τ: %.2f Nm"%(adc.get_torque()))
+            print ("τ: %.2f Nm, %.2f Nm averaged over 10 ms"%(adc.get_torque(), adc.torque(adc.mean(9)[0])))
 
 if __name__ == '__main__':
-    with Big100NmFutek(csv_file_name="junk.csv") as adc:
+    # sampled at 860 Hz by AdcManager's thread, every sample goes to the csv
+    with Big100NmFutek(csv_file_name="junk.csv", continuous=True) as adc:
         measure_torque(adc)
@@ -17,4 +17,6 @@ synch = UdpBinarySynchA(
     send_port=5558)
 
 for t in SoftRealtimeLoop(0.001, report=True):
-    print(synch.update(np.array([42.1, t*1000])))
\ No newline at end of file
+    print(synch.update(np.array([42.1, t*1000])))
+synch.stats.report()
+synch.clock.report()
@@ -0,0 +1,37 @@
+from FindLibrariesWarning import *
+from SoftRealtimeLoop import SoftRealtimeLoop
+from ZmqBus import ZmqBus, ZmqBusProxy
+import numpy as np
+import sys
+
+# Run with "proxy" on the exo Pi and with "tablet" on the tablet, after
+# changing PI_IP. The exo publishes its state at 1 kHz, the tablet a command
+# at 10 Hz, and each prints what it hears from the other.
+PI_IP = "127.0.0.1"
+role = sys.argv[1] if len(sys.argv) > 1 else "proxy"
+
+if role == "proxy":
+    proxy = ZmqBusProxy(frontend="tcp://*:5570", backend="tcp://*:5571")
+    host = "localhost"
+else:
+    host = PI_IP
+
+bus = ZmqBus(role, pub_connect=["tcp://%s:5570"%host], sub_connect=["tcp://%s:5571"%host])
+if role == "proxy":
+    bus.subscribe("tablet/command", conflate=True)
+else:
+    bus.subscribe("exo/state")
+
+for t in SoftRealtimeLoop(0.001, report=True):
+    if role == "proxy":
+        bus.publish("exo/state", np.array([42.1, t*1000]))
+    elif int(t*1000) % 100 == 0:
+        bus.publish("tablet/command", np.array([t]))
+    for topic in bus.poll():
+        print(topic, bus.latest(topic))
+
+for topic in bus.topics.values():
+    topic.report()
+bus.close()
+if role == "proxy":
+    proxy.close()
@@ -8,4 +8,6 @@ synch = ZmqBinarySynchA(
     connectport="tcp://localhost:5558")
 
 for t in SoftRealtimeLoop(0.001, report=True):
-    print(synch.update(np.array([42.1, t*1000])))
\ No newline at end of file
+    print(synch.update(np.array([42.1, t*1000])))
+synch.stats.report()
+synch.clock.report()
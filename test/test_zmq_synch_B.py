@@ -8,4 +8,6 @@ synch = ZmqBinarySynchB(
     connectport="tcp://localhost:5557")
 
 for t in SoftRealtimeLoop(0.001, report=True):
-    print(synch.update(np.array([t*1000, 1337.])))
\ No newline at end of file
+    print(synch.update(np.array([t*1000, 1337.])))
+synch.stats.report()
+synch.clock.report()